@@ -7,7 +7,14 @@ import configparser
 import logging
 import coloredlogs
 import itertools
-from delight.utils import approx_DL
+import json
+import hashlib
+import shutil
+import time as _time
+import queue
+import threading
+from delight.utils import approx_DL, TemplateFluxTable
+from delight.photoz_kernels import KernelGridCache
 from scipy.interpolate import interp1d
 
 logger = logging.getLogger(__name__)
@@ -19,6 +26,8 @@ def parseParamFile(fileName, verbose=True, catFilesNeeded=True):
     Parser for configuration inputtype parameter files,
     see examples for details. A bunch of them ar parsed.
     """
+    if isModelBundle(fileName):
+        return loadModelBundle(fileName, verbose=verbose)
     config = configparser.ConfigParser()
     if not os.path.isfile(fileName):
         raise Exception(fileName+' : file not found')
@@ -93,7 +102,7 @@ def parseParamFile(fileName, verbose=True, catFilesNeeded=True):
     params['training_numChunks'] = config.getint('Training', 'numChunks')
     params['training_paramFile'] = config.get('Training', 'paramFile')
     params['training_catFile'] = config.get('Training', 'catFile')
-    if catFilesNeeded and not os.path.isfile(params['training_catFile']):
+    if catFilesNeeded and not os.path.exists(params['training_catFile']):
         raise Exception(params['training_catFile']+' : file does not exist')
     params['training_referenceBand'] = config.get('Training', 'referenceBand')
     if params['training_referenceBand'] not in params['bandNames']:
@@ -134,8 +143,12 @@ def parseParamFile(fileName, verbose=True, catFilesNeeded=True):
     params['target_extraFracFluxError']\
         = config.getfloat('Target', 'extraFracFluxError')
     params['target_catFile'] = config.get('Target', 'catFile')
-    if catFilesNeeded and not os.path.isfile(params['target_catFile']):
+    if catFilesNeeded and not os.path.exists(params['target_catFile']):
         raise Exception(params['target_catFile']+' : file does not exist')
+    if 'blockSize' in config['Target']:
+        params['target_blockSize'] = config.getint('Target', 'blockSize')
+    else:
+        params['target_blockSize'] = 0
     params['target_bandOrder']\
         = config.get('Target', 'bandOrder').split(' ')
     params['target_referenceBand'] = config.get('Target', 'referenceBand')
@@ -161,6 +174,17 @@ def parseParamFile(fileName, verbose=True, catFilesNeeded=True):
     params['redshiftpdfFileTemp'] = config.get('Target', 'redshiftpdfFileTemp')
     params['metricsFile'] = config.get('Target', 'metricsFile')
     params['metricsFileTemp'] = config.get('Target', 'metricsFileTemp')
+    if 'pdfCodec' in config['Target']:
+        params['pdfCodec'] = config.get('Target', 'pdfCodec')
+    else:
+        params['pdfCodec'] = 'text'
+    if params['pdfCodec'] not in PDF_CODECS:
+        raise Exception(params['pdfCodec']+' : is not a valid PDF codec')
+    if 'pdfSparseThreshold' in config['Target']:
+        params['pdfSparseThreshold'] =\
+            config.getfloat('Target', 'pdfSparseThreshold')
+    else:
+        params['pdfSparseThreshold'] = 1e-3
 
     # Parsing other parameters
     #--------------------------
@@ -189,6 +213,27 @@ def parseParamFile(fileName, verbose=True, catFilesNeeded=True):
     params['confidenceLevels']\
         = [float(x) for x in
            config.get('Other', 'confidenceLevels').split(' ')]
+    if 'kernelCacheDir' in config['Other']:
+        params['kernelCacheDir'] = config.get('Other', 'kernelCacheDir')
+    else:
+        params['kernelCacheDir'] = ''
+    if 'kernelCacheSize' in config['Other']:
+        params['kernelCacheSize'] =\
+            config.getfloat('Other', 'kernelCacheSize')
+    else:
+        params['kernelCacheSize'] = 2000.
+    if 'shareKernelGrids' in config['Other']:
+        params['shareKernelGrids'] =\
+            config.getboolean('Other', 'shareKernelGrids')
+    else:
+        params['shareKernelGrids'] = False
+    if 'kernelGridDtype' in config['Other']:
+        params['kernelGridDtype'] = config.get('Other', 'kernelGridDtype')
+    else:
+        params['kernelGridDtype'] = 'float64'
+    if params['kernelGridDtype'] not in ['float64', 'float32']:
+        raise Exception(params['kernelGridDtype']
+                        + ' : kernelGridDtype should be float64 or float32')
 
     if verbose:
         #print('Input parameter file:', fileName)
@@ -205,6 +250,19 @@ def parseParamFile(fileName, verbose=True, catFilesNeeded=True):
     return params
 
 
+def getKernelGridCache(params):
+    """
+    Kernel grid cache described by the parameter file
+    (kernelCacheDir, and kernelCacheSize in megabytes),
+    or None if no cache directory is set.
+    """
+    cacheDir = params.get('kernelCacheDir', '')
+    if cacheDir == '':
+        return None
+    return KernelGridCache(cacheDir,
+                           maxSize=params.get('kernelCacheSize', 2000.)*1e6)
+
+
 def readColumnPositions(params, prefix="training_", refFlux=True):
     """
     Read column/band information needed for parsing catalog file,
@@ -231,10 +289,29 @@ def readColumnPositions(params, prefix="training_", refFlux=True):
             redshiftColumn
 
 
+def readBandSubset(params):
+    """
+    Sorted indices of the bands used by the training and target catalogs,
+    and by the cross-validation if enabled.
+    """
+    prefixes = ['training_', 'target_']
+    if params['training_crossValidate']:
+        prefixes.append('training_CV_')
+    bandIndices = set()
+    for prefix in prefixes:
+        bandIndices.update(readColumnPositions(params, prefix=prefix,
+                                               refFlux=False)[0])
+    return np.array(sorted(bandIndices), dtype=int)
+
+
 def readBandCoefficients(params):
     """
     Read band/filter information, in particular the Gaussian Mixture coefs.
     """
+    if 'modelBundle' in params:
+        return tuple(readModelBundleArray(params, name) for name in
+                     ['bandCoefAmplitudes', 'bandCoefPositions',
+                      'bandCoefWidths', 'norms'])
     bandCoefAmplitudes = []
     bandCoefPositions = []
     bandCoefWidths = []
@@ -257,6 +334,9 @@ def createGrids(params):
     """
     Create redshift grids from parameters in file.
     """
+    if 'modelBundle' in params:
+        return tuple(readModelBundleArray(params, name) for name in
+                     ['redshiftDistGrid', 'redshiftGrid', 'redshiftGridGP'])
     redshiftDistGrid = np.arange(0, params['redshiftMax'],
                                  params['redshiftDisBinSize'])
     if True:
@@ -278,134 +358,1109 @@ def createGrids(params):
 def readSEDs(params):
     """
     Read SED parameters.
+    Returns a TemplateFluxTable, i.e. the template fluxes on the redshift grid,
+    evaluated as ``f_mod[it, ib](z)`` or for all templates and bands at once.
     """
     redshiftDistGrid, redshiftGrid, redshiftGridGP = createGrids(params)
-    f_mod = np.zeros((len(params['templates_names']),
-                      len(params['bandNames'])), dtype=object)
+    return TemplateFluxTable(redshiftGrid, readTemplateFluxGrid(params))
+
+
+def readTemplateFluxGrid(params):
+    """
+    Read the template fluxes on the redshift grid, i.e. the
+    ``_fluxredshiftmod.txt`` files produced by processSEDs.
+    Returns an array of shape (numZ, numTemplates, numBands).
+    """
+    if 'modelBundle' in params:
+        return readModelBundleArray(params, 'templateFluxes')
+    redshiftDistGrid, redshiftGrid, redshiftGridGP = createGrids(params)
+    f_mod_grid = np.zeros((redshiftGrid.size, len(params['templates_names']),
+                           len(params['bandNames'])))
     for it, sed_name in enumerate(params['templates_names']):
-        data = np.loadtxt(params['templates_directory'] +
-                          '/' + sed_name + '_fluxredshiftmod.txt')
-        for jf in range(len(params['bandNames'])):
-            f_mod[it, jf] = interp1d(redshiftGrid, data[:, jf],
-                                     kind='linear', bounds_error=False,
-                                     fill_value='extrapolate')
-    return f_mod
+        f_mod_grid[:, it, :] = np.loadtxt(params['templates_directory'] +
+                                          '/' + sed_name +
+                                          '_fluxredshiftmod.txt')
+    return f_mod_grid
+
+
+MODEL_BUNDLE_VERSION = 1
+MODEL_BUNDLE_ARRAYS = ['bandCoefAmplitudes', 'bandCoefPositions',
+                       'bandCoefWidths', 'norms',
+                       'redshiftDistGrid', 'redshiftGrid', 'redshiftGridGP',
+                       'templateFluxes']
+
+
+def isModelBundle(fileName):
+    """
+    Returns True if fileName is a model bundle, see buildModelBundle.
+    """
+    return os.path.isfile(os.path.join(fileName, 'manifest.json'))
+
+
+def modelBundleHash(paramsDict, arrays):
+    """
+    Content hash (sha256) of the parameters and arrays of a model bundle.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(paramsDict, sort_keys=True).encode())
+    for name in MODEL_BUNDLE_ARRAYS:
+        arr = np.ascontiguousarray(arrays[name])
+        h.update(name.encode())
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def buildModelBundle(params, outDir):
+    """
+    Build a model bundle from parsed parameters: a directory holding
+    a ``manifest.json`` file (format version, parameters, content hash)
+    and one ``.npy`` file per array (band coefficients and norms,
+    redshift grids, template flux grid).
+    The bundle can be passed to any script instead of the parameter file,
+    arrays are then memory-mapped instead of recomputed.
+
+    Args:
+        params: parameters, as returned by parseParamFile
+        outDir: output directory of the bundle
+    """
+    arrays = collections.OrderedDict()
+    arrays['bandCoefAmplitudes'], arrays['bandCoefPositions'],\
+        arrays['bandCoefWidths'], arrays['norms']\
+        = readBandCoefficients(params)
+    arrays['redshiftDistGrid'], arrays['redshiftGrid'],\
+        arrays['redshiftGridGP'] = createGrids(params)
+    arrays['templateFluxes'] = readTemplateFluxGrid(params)
+
+    paramsDict = collections.OrderedDict()
+    ndarrayParams = []
+    for k, v in params.items():
+        # bundle-specific entries and the state of output files are
+        # not part of the model
+        if k in ['modelBundle', 'modelBundleHash', 'compressionFilesFound']:
+            continue
+        if isinstance(v, np.ndarray):
+            ndarrayParams.append(k)
+            v = v.tolist()
+        paramsDict[k] = v
+
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    for name in MODEL_BUNDLE_ARRAYS:
+        np.save(os.path.join(outDir, name + '.npy'),
+                np.ascontiguousarray(arrays[name]))
+    manifest = collections.OrderedDict()
+    manifest['version'] = MODEL_BUNDLE_VERSION
+    manifest['hash'] = modelBundleHash(paramsDict, arrays)
+    manifest['arrays'] = MODEL_BUNDLE_ARRAYS
+    manifest['ndarrayParams'] = ndarrayParams
+    manifest['params'] = paramsDict
+    # the manifest is written last: a bundle without it is incomplete
+    with open(os.path.join(outDir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest['hash']
+
+
+def loadModelBundle(fileName, verbose=False, checkHash=False):
+    """
+    Load the parameters of a model bundle, see buildModelBundle.
+    The arrays are read lazily (memory-mapped) by readBandCoefficients,
+    createGrids, readSEDs and readTemplateFluxGrid.
+
+    Args:
+        fileName: bundle directory
+        verbose: print the parameters
+        checkHash: recompute the content hash and compare it
+    """
+    with open(os.path.join(fileName, 'manifest.json')) as f:
+        manifest = json.load(f, object_pairs_hook=collections.OrderedDict)
+    if manifest['version'] != MODEL_BUNDLE_VERSION:
+        raise Exception(fileName+' : model bundle version ' +
+                        str(manifest['version'])+' not supported')
+    paramsDict = manifest['params']
+    if checkHash:
+        arrays = {name: np.load(os.path.join(fileName, name + '.npy'),
+                                mmap_mode='r')
+                  for name in MODEL_BUNDLE_ARRAYS}
+        if modelBundleHash(paramsDict, arrays) != manifest['hash']:
+            raise Exception(fileName+' : model bundle hash mismatch')
+    params = collections.OrderedDict()
+    for k, v in paramsDict.items():
+        params[k] = np.array(v) if k in manifest['ndarrayParams'] else v
+    params['modelBundle'] = fileName
+    params['modelBundleHash'] = manifest['hash']
+    # output files may have appeared since the bundle was built
+    params['compressionFilesFound'] =\
+        os.path.isfile(params['compressIndicesFile'])\
+        and os.path.isfile(params['compressMargLikFile'])
+    if verbose:
+        logger.warning('Model bundle:{} ({})'.format(fileName,
+                                                     manifest['hash']))
+    return params
+
+
+def readModelBundleArray(params, name):
+    """
+    Memory-map one array of the model bundle the parameters come from.
+    The mapping is copy-on-write: pages are shared between processes
+    and the arrays can be passed to the Cython kernels.
+    """
+    return np.load(os.path.join(params['modelBundle'], name + '.npy'),
+                   mmap_mode='c')
+
+
+def isColumnarCatalog(fileName):
+    """
+    Returns True if the catalog is in the binary columnar format, i.e.
+    a directory containing one ``.npy`` file per named column.
+    """
+    return os.path.isdir(fileName)
+
+
+def rowIndexFileName(fileName):
+    """
+    Name of the row index sidecar of a text file, see getRowIndex.
+    """
+    return fileName + '.rowindex.npy'
+
+
+def buildRowIndex(fileName, chunkSize=2**26):
+    """
+    Build the row index of a text file: an integer array containing
+    the size and modification time (ns) of the file, followed by
+    the byte offsets of the start of each row, and the file size.
+    It is saved as a sidecar next to the file, if possible.
+    """
+    stat = os.stat(fileName)
+    offsets = [np.zeros((1, ), dtype=np.int64)]
+    with open(fileName, 'rb') as f:
+        pos = 0
+        while True:
+            chunk = f.read(chunkSize)
+            if len(chunk) == 0:
+                break
+            newlines = np.flatnonzero(
+                np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            offsets.append(pos + newlines.astype(np.int64) + 1)
+            pos += len(chunk)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != stat.st_size:
+        offsets = np.append(offsets, stat.st_size)
+    index = np.concatenate(([stat.st_size, stat.st_mtime_ns], offsets))
+    indexFile = rowIndexFileName(fileName)
+    tmpFile = indexFile + '.' + str(os.getpid()) + '.tmp.npy'
+    try:
+        np.save(tmpFile, index)
+        os.replace(tmpFile, indexFile)
+    except OSError:
+        logger.warning('Could not save the row index of ' + fileName)
+    return index
+
+
+def getRowIndex(fileName):
+    """
+    Returns the row index of a text file (see buildRowIndex),
+    memory-mapped from its sidecar if it exists and is up to date
+    (same file size and modification time), and (re)built otherwise.
+    """
+    indexFile = rowIndexFileName(fileName)
+    if os.path.isfile(indexFile):
+        stat = os.stat(fileName)
+        try:
+            index = np.load(indexFile, mmap_mode='r')
+            if index.size >= 3 and index[0] == stat.st_size\
+                    and index[1] == stat.st_mtime_ns:
+                return index
+        except (OSError, ValueError):
+            pass
+    return buildRowIndex(fileName)
+
+
+def iterFileLines(fileName, firstLine, lastLine):
+    """
+    Returns an iterator over lines [firstLine, lastLine) of a text file,
+    seeking directly to firstLine using the row index.
+    """
+    index = getRowIndex(fileName)
+    numLines = index.size - 3
+    firstLine = min(firstLine, numLines)
+    lastLine = max(firstLine, min(lastLine, numLines))
+    with open(fileName) as f:
+        f.seek(int(index[2+firstLine]))
+        for line in itertools.islice(f, lastLine - firstLine):
+            yield line
+
+
+def getNumberOfLines(fileName):
+    """
+    Number of rows of a catalog or output file, text or binary.
+    For text files the row index is used, see getRowIndex.
+    """
+    if isBinaryFile(fileName):
+        return np.load(fileName, mmap_mode='r').shape[0]
+    if isPDFCodecFile(fileName):
+        return readPDFCodecManifest(fileName)['numRows']
+    if isColumnarCatalog(fileName):
+        for name in sorted(os.listdir(fileName)):
+            if name.endswith('.npy'):
+                return np.load(os.path.join(fileName, name),
+                               mmap_mode='r').shape[0]
+        return 0
+    return getRowIndex(fileName).size - 3
+
+
+def convertCatalogToColumns(catFile, bandOrders, outDir, chunkSize=100000):
+    """
+    Convert a space-separated text catalog into the binary columnar format.
+    One ``.npy`` file per named column is written in outDir,
+    named after the entries of the band orders (e.g. ``U_SDSS_var.npy``).
+    Columns marked with ``_`` are not written.
+
+    Args:
+        catFile: input text catalog.
+        bandOrders: list of band orders (lists of column names) describing
+            the catalog, e.g. the training and cross-validation ones.
+        outDir: output directory.
+        chunkSize (Optional): number of rows parsed at once.
+    """
+    columnNames = {}
+    for bandOrder in bandOrders:
+        for pos, name in enumerate(bandOrder):
+            if name == '_':
+                continue
+            if columnNames.get(name, pos) != pos:
+                raise Exception(name+' appears at different positions')
+            columnNames[name] = pos
+    numLines = getNumberOfLines(catFile)
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    columns = {}
+    for name in columnNames:
+        columns[name] = np.lib.format.open_memmap(
+            os.path.join(outDir, name + '.npy'), mode='w+',
+            dtype=np.float64, shape=(numLines, ))
+    with open(catFile) as f:
+        for first in range(0, numLines, chunkSize):
+            data = np.loadtxt(itertools.islice(f, chunkSize), ndmin=2)
+            for name, pos in columnNames.items():
+                columns[name][first:first+data.shape[0]] = data[:, pos]
+    for name in columns:
+        columns[name].flush()
+    return outDir
+
+
+def readCatalogColumns(catFile, columnNames):
+    """
+    Memory-map columns of a binary columnar catalog.
+
+    Args:
+        catFile: directory of the columnar catalog.
+        columnNames: dictionary of column positions to column names.
+
+    Returns a dictionary of column positions to (memory-mapped) arrays.
+    """
+    columns = {}
+    for pos, name in columnNames.items():
+        fname = os.path.join(catFile, name + '.npy')
+        if not os.path.isfile(fname):
+            raise Exception(fname+' : column file not found')
+        columns[pos] = np.load(fname, mmap_mode='r')
+    return columns
+
+
+def readCatalogBlock(catFile, firstLine, lastLine, columnNames):
+    """
+    Read rows [firstLine, lastLine) of a catalog, text or columnar,
+    as an array of size (numRows, numColumns) indexed by column position.
+    For columnar catalogs only the columns in columnNames are read,
+    the others are set to NaN.
+
+    Args:
+        catFile: catalog file or directory.
+        firstLine, lastLine: range of rows to read.
+        columnNames: dictionary of column positions to column names.
+    """
+    numCols = max(columnNames.keys()) + 1
+    if not isColumnarCatalog(catFile):
+        block = np.loadtxt(iterFileLines(catFile, firstLine, lastLine),
+                           ndmin=2)
+        if block.shape[0] == 0:
+            block = np.zeros((0, numCols))
+        return block
+    columns = readCatalogColumns(catFile, columnNames)
+    lastLine = max(firstLine, min(lastLine, getNumberOfLines(catFile)))
+    block = np.full((lastLine - firstLine, numCols), np.nan)
+    for pos, col in columns.items():
+        block[:, pos] = col[firstLine:lastLine]
+    return block
+
+
+def iterCatalogRows(catFile, firstLine, lastLine, columnNames,
+                    chunkSize=10000):
+    """
+    Returns an iterator over the rows of a catalog, text or columnar.
+    Each row is an array indexed by column position.
+    See readCatalogBlock.
+
+    Args:
+        catFile: catalog file or directory.
+        firstLine, lastLine: range of rows to read.
+        columnNames: dictionary of column positions to column names.
+        chunkSize (Optional): number of rows read at once.
+    """
+    for first in range(firstLine, lastLine, chunkSize):
+        last = min(lastLine, first + chunkSize)
+        block = readCatalogBlock(catFile, first, last, columnNames)
+        for data in block:
+            yield data
+        if block.shape[0] < last - first:
+            break
+
+
+def catalogColumnNames(params, prefix, CV=False):
+    """
+    Dictionary of column positions to column names
+    needed for parsing a catalog with the given prefix.
+    """
+    bandOrders = [params[prefix+'bandOrder']]
+    if CV:
+        bandOrders.append(params[prefix+'CV_bandOrder'])
+    columnNames = {}
+    for bandOrder in bandOrders:
+        for pos, name in enumerate(bandOrder):
+            if name != '_' and pos not in columnNames:
+                columnNames[pos] = name
+    return columnNames
+
+
+def getDataBlockFromFile(params, firstLine, lastLine, prefix="", CV=False):
+    """
+    Parse rows [firstLine, lastLine) of an input catalog file at once.
+    All the selection and processing of getDataFromFile is done with array
+    operations, and invalid objects are flagged instead of skipped.
+
+    Returns:
+        z: redshifts, of size (nobj, ), -1 if not in the catalog.
+        normedRefFlux: normalized reference fluxes, of size (nobj, ).
+        ell: luminosities, of size (nobj, ), NaN if z is unknown.
+        fluxes: array of size (nobj, numBands) for the bands
+            in bandIndices (see readColumnPositions).
+        fluxesVar: flux variances of size (nobj, numBands),
+            including the extra fractional flux error.
+        mask: boolean array of size (nobj, numBands) of valid fluxes.
+        valid: boolean array of size (nobj, ) of valid objects,
+            i.e. the ones getDataFromFile would not skip.
+        fluxesCV, fluxesCVVar, maskCV: same for the cross-validation
+            bands if CV=True, None otherwise.
+    """
+    DL = approx_DL()
+    bandIndices, bandNames, bandColumns, bandVarColumns, redshiftColumn,\
+        refBandColumn = readColumnPositions(params, prefix=prefix)
+    bandCoefAmplitudes, bandCoefPositions, bandCoefWidths, norms\
+        = readBandCoefficients(params)
+    refBandNorm = norms[params['bandNames']
+                        .index(params[prefix+'referenceBand'])]
+
+    columnNames = catalogColumnNames(params, prefix, CV=CV)
+    data = readCatalogBlock(params[prefix+'catFile'],
+                            firstLine, lastLine, columnNames)
+
+    refFlux = data[:, refBandColumn]
+    normedRefFlux = refFlux * refBandNorm
+    if redshiftColumn >= 0:
+        z = data[:, redshiftColumn]
+    else:
+        z = -np.ones((data.shape[0], ))
+
+    # flag bad values and find how many bands are valid
+    fluxes = data[:, bandColumns]
+    fluxesVar = data[:, bandVarColumns]
+    with np.errstate(invalid='ignore'):
+        mask = np.isfinite(fluxes) & np.isfinite(fluxesVar)
+        mask &= (fluxes > 0.0) & (fluxesVar > 0.0)
+    fluxesVar = fluxesVar +\
+        (params['training_extraFracFluxError'] * fluxes)**2
+
+    hasz = z > -1
+    zsafe = np.where(hasz, z, 0)
+    ell = np.where(hasz, normedRefFlux * 4 * np.pi
+                   * params['fluxLuminosityNorm'] * DL(zsafe)**2 * (1+zsafe),
+                   np.nan)
+
+    with np.errstate(invalid='ignore'):
+        valid = (refFlux > 0) & np.isfinite(refFlux) & (z >= 0)
+    valid &= mask.sum(axis=1) > 1
+
+    fluxesCV, fluxesCVVar, maskCV = None, None, None
+    if CV:
+        bandIndicesCV, bandNamesCV, bandColumnsCV,\
+            bandVarColumnsCV, redshiftColumnCV =\
+            readColumnPositions(params, prefix=prefix+'CV_', refFlux=False)
+        fluxesCV = data[:, bandColumnsCV]
+        fluxesCVVar = data[:, bandVarColumnsCV]
+        with np.errstate(invalid='ignore'):
+            maskCV = np.isfinite(fluxesCV) & np.isfinite(fluxesCVVar)
+            maskCV &= (fluxesCV > 0.0) & (fluxesCVVar > 0.0)
+        fluxesCVVar = fluxesCVVar +\
+            (params['training_extraFracFluxError'] * fluxesCV)**2
+
+    return z, normedRefFlux, ell, fluxes, fluxesVar, mask, valid,\
+        fluxesCV, fluxesCVVar, maskCV
+
+
+def isBinaryFile(fileName):
+    """
+    Returns True if the file is in the binary (``.npy``) format,
+    e.g. a GP core store (see createGPCoreStore).
+    """
+    return fileName.endswith('.npy')
+
+
+def gpCoreDtype(numBandsMax, numTemplates):
+    """
+    Fixed-layout record of the GP core of one training object:
+    number of bands B, redshift z, luminosity ell, band indices,
+    template coefficients betas, Cholesky factor L, data vector D
+    and GP weights beta. Arrays are zero-padded to numBandsMax bands.
+    """
+    return np.dtype([('B', np.int64),
+                     ('z', np.float64),
+                     ('ell', np.float64),
+                     ('bands', np.int64, (numBandsMax, )),
+                     ('betas', np.float64, (numTemplates, )),
+                     ('L', np.float64, (numBandsMax, numBandsMax)),
+                     ('D', np.float64, (numBandsMax, )),
+                     ('beta', np.float64, (numBandsMax, ))])
+
+
+def createGPCoreStore(fileName, numObjects, numBandsMax, numTemplates):
+    """
+    Create a binary GP core store, i.e. a ``.npy`` file containing
+    numObjects records (see gpCoreDtype), and return it memory-mapped.
+    """
+    return np.lib.format.open_memmap(
+        fileName, mode='w+', shape=(numObjects, ),
+        dtype=gpCoreDtype(numBandsMax, numTemplates))
+
+
+def openGPCoreStore(fileName, mode='r'):
+    """
+    Memory-map an existing binary GP core store.
+    """
+    return np.load(fileName, mmap_mode=mode)
+
+
+def writeGPCore(store, loc, z, ell, bands, betas, L, D, beta):
+    """
+    Write the GP core of one object at position loc of a GP core store.
+    """
+    B = bands.size
+    store['B'][loc] = B
+    store['z'][loc] = z
+    store['ell'][loc] = ell
+    store['bands'][loc, :B] = bands
+    store['betas'][loc] = betas
+    store['L'][loc, :B, :B] = np.tril(L)
+    store['D'][loc, :B] = D.ravel()
+    store['beta'][loc, :B] = beta.ravel()
+
+
+def flattenGPCores(cores, numCol):
+    """
+    Rows of the text GP core files written by delight-learn,
+    from GP core records (see gpCoreDtype): number of bands B, redshift z,
+    luminosity ell, band indices, then the template coefficients betas,
+    the lower triangle of L and D (as in PhotozGP.getCore),
+    zero-padded to numCol columns.
+    """
+    rows = np.zeros((cores.shape[0], numCol))
+    rows[:, 0] = cores['B']
+    rows[:, 1] = cores['z']
+    rows[:, 2] = cores['ell']
+    nt = cores['betas'].shape[1]
+    for B in np.unique(cores['B']):
+        ind = np.where(cores['B'] == B)[0]
+        halfL = cores['L'][ind][:, :B, :B][(slice(None), ) +
+                                           np.tril_indices(B)]
+        rows[ind, 3:3+B] = cores['bands'][ind, :B]
+        rows[ind, 3+B:3+B+nt] = cores['betas'][ind]
+        rows[ind, 3+B+nt:3+B+nt+B*(B+1)//2] = halfL
+        rows[ind, 3+B+nt+B*(B+1)//2:3+B+nt+B*(B+1)//2+B] =\
+            cores['D'][ind, :B]
+    return rows
+
+
+class RowSlabWriter():
+    """
+    Streaming writer of an output array (PDFs, metrics, compression
+    indices or evidences) of which each MPI process writes the rows
+    [firstLine, lastLine), in order, block by block.
+    Memory use depends on the block size only.
+    Binary (``.npy``) files are preallocated by the first process and
+    written in place, memory-mapped. Text files are written by each process
+    into a part file, concatenated by the first process on close.
+    PDF codecs other than text (see PDF_CODECS) write a directory,
+    see writePDFSlabs.
+    The constructor and close must be called by all the processes of comm
+    (None for a serial run), write is independent.
+
+    Args:
+        fileName: output file or directory
+        shape: shape of the full output, (numRows, ...)
+        firstLine, lastLine: range of rows written by this process
+        comm: MPI communicator, or None
+        dtype: type of the entries
+        codec: one of PDF_CODECS, for PDFs
+        threshold: fraction of the row maximum kept by the sparse codec
+        fmt: number format of text files
+    """
+    def __init__(self, fileName, shape, firstLine, lastLine, comm=None,
+                 dtype=float, codec='text', threshold=1e-3, fmt='%.2e'):
+        """ Constructor."""
+        if codec not in PDF_CODECS:
+            raise Exception(codec+' : is not a valid PDF codec')
+        self.fileName = fileName
+        self.shape = tuple(shape)
+        self.firstLine, self.lastLine = firstLine, lastLine
+        self.nextLine = firstLine
+        self.comm = comm
+        self.threadNum = 0 if comm is None else comm.Get_rank()
+        self.codec = codec
+        self.threshold = threshold
+        self.fmt = fmt
+        self.arrays = {}
+        self.parts = {}
+        if codec == 'text' and not isBinaryFile(fileName):
+            self.parts['text'] = open(self._partName(fileName), 'w')
+            return
+        if codec == 'text':
+            self._createArrays({fileName: (self.shape, dtype)})
+            self.arrays['values'] = self.arrays.pop(fileName)
+            return
+        if self.threadNum == 0:
+            if os.path.isfile(os.path.join(fileName, 'codec.json')):
+                os.remove(os.path.join(fileName, 'codec.json'))
+            if not os.path.isdir(fileName):
+                os.makedirs(fileName)
+        self._barrier()
+        toCreate = {'scales': ((self.shape[0], ), np.float64)}
+        if codec == 'sparse':
+            toCreate['counts'] = ((self.shape[0], ), np.int64)
+            for name in ['values', 'indices']:
+                self.parts[name] = open(self._partName(
+                    os.path.join(fileName, name)), 'wb')
+        else:
+            toCreate['values'] = (self.shape,
+                                  np.float16 if codec == 'float16'
+                                  else codec)
+        self._createArrays({os.path.join(fileName, name + '.npy'): v
+                            for name, v in toCreate.items()})
+        for name in toCreate:
+            self.arrays[name] = self.arrays.pop(
+                os.path.join(fileName, name + '.npy'))
+
+    def _partName(self, fileName):
+        return fileName + '.part' + str(self.firstLine)
+
+    def _barrier(self):
+        if self.comm is not None:
+            self.comm.Barrier()
+
+    def _createArrays(self, toCreate):
+        # preallocated by the first process, then mapped by all
+        if self.threadNum == 0:
+            for name, (shape, dtype) in toCreate.items():
+                out = np.lib.format.open_memmap(name, mode='w+',
+                                                dtype=dtype, shape=shape)
+                del out
+        self._barrier()
+        for name in toCreate:
+            self.arrays[name] = np.load(name, mmap_mode='r+')
+
+    def write(self, block):
+        """
+        Write the next rows of this process.
+        """
+        block = np.asarray(block)
+        first, last = self.nextLine, self.nextLine + block.shape[0]
+        if last > self.lastLine:
+            raise Exception(self.fileName+' : too many rows written')
+        self.nextLine = last
+        if 'text' in self.parts:
+            np.savetxt(self.parts['text'], block, fmt=self.fmt)
+        elif self.codec == 'text':
+            self.arrays['values'][first:last] = block
+        else:
+            encoded = encodePDFs(block, self.codec, self.threshold)
+            for name, arr in encoded.items():
+                if name in self.parts:
+                    self.parts[name].write(np.ascontiguousarray(arr).tobytes())
+                else:
+                    self.arrays[name][first:last] = arr
+
+    def close(self, chunkSize=2**24):
+        """
+        Finalize the output: concatenate the parts, write the manifest.
+        """
+        for arr in self.arrays.values():
+            arr.flush()
+        for part in self.parts.values():
+            part.close()
+        if 'text' in self.parts:
+            self._closeText()
+        elif self.codec == 'sparse':
+            self._closeSparse(chunkSize)
+        self.arrays = {}
+        if self.codec != 'text':
+            # the manifest is written last: PDFs without it are incomplete
+            if self.threadNum == 0:
+                with open(os.path.join(self.fileName, 'codec.json'),
+                          'w') as f:
+                    json.dump({'codec': self.codec, 'numRows': self.shape[0],
+                               'numZ': self.shape[1],
+                               'threshold': self.threshold}, f, indent=1)
+        self._barrier()
+
+    def _closeText(self):
+        if self.comm is None:
+            partNames = [self.parts['text'].name]
+        else:
+            partNames = self.comm.gather(
+                (self.firstLine, self.parts['text'].name), root=0)
+            partNames = None if partNames is None else\
+                [name for first, name in sorted(partNames)]
+        if self.threadNum == 0:
+            with open(self.fileName, 'w') as f:
+                for name in partNames:
+                    with open(name) as part:
+                        shutil.copyfileobj(part, f)
+                    os.remove(name)
+
+    def _closeSparse(self, chunkSize):
+        # concatenate the values and indices of the processes and
+        # build the CSR row pointer from the counts, by chunks
+        counts = self.arrays['counts'][self.firstLine:self.lastLine]
+        localSize = int(np.sum(counts))
+        if self.comm is None:
+            slabs = [(self.firstLine, localSize)]
+        else:
+            slabs = self.comm.allgather((self.firstLine, localSize))
+        offset = sum([n for first, n in slabs if first < self.firstLine])
+        totalSize = sum([n for first, n in slabs])
+        dtypes = {'values': np.float16, 'indices': np.int32}
+        self.arrays = {}
+        self._createArrays(collections.OrderedDict(
+            [(os.path.join(self.fileName, name + '.npy'),
+              ((totalSize, ), dtypes[name])) for name in dtypes] +
+            [(os.path.join(self.fileName, 'indptr.npy'),
+              ((self.shape[0] + 1, ), np.int64))]))
+        for name, dtype in dtypes.items():
+            out = self.arrays[os.path.join(self.fileName, name + '.npy')]
+            partName = self._partName(os.path.join(self.fileName, name))
+            if localSize > 0:
+                part = np.memmap(partName, dtype=dtype, mode='r')
+                for i in range(0, localSize, chunkSize):
+                    out[offset+i:offset+min(localSize, i+chunkSize)] =\
+                        part[i:i+chunkSize]
+                del part
+            os.remove(partName)
+        indptr = self.arrays[os.path.join(self.fileName, 'indptr.npy')]
+        for i in range(0, counts.size, chunkSize):
+            cumCounts = offset + np.cumsum(counts[i:i+chunkSize])
+            indptr[self.firstLine+1+i:
+                   self.firstLine+1+i+cumCounts.size] = cumCounts
+            offset = cumCounts[-1]
+        for arr in self.arrays.values():
+            arr.flush()
+        self.arrays = {}
+        self._barrier()
+        if self.threadNum == 0:
+            os.remove(os.path.join(self.fileName, 'counts.npy'))
+
+
+def writeRowSlabs(fileName, localArray, firstLine, numRows,
+                  comm=None, fmt='%.2e'):
+    """
+    Write an output array of numRows rows (PDFs, metrics, compression
+    indices or evidences) of which each MPI process holds the slab
+    starting at row firstLine, see RowSlabWriter.
+    Must be called by all the processes of comm (None for a serial run).
+
+    Args:
+        fileName: output file, ``.npy`` for the binary format
+        localArray: array holding the local slab
+        firstLine: index of the first row of the slab
+        numRows: total number of rows of the output
+        comm: MPI communicator, or None
+        fmt: number format of text files
+    """
+    localArray = np.asarray(localArray)
+    writer = RowSlabWriter(fileName, (numRows, ) + localArray.shape[1:],
+                           firstLine, firstLine + localArray.shape[0],
+                           comm=comm, dtype=localArray.dtype, fmt=fmt)
+    writer.write(localArray)
+    writer.close()
+
+
+def readRowRange(fileName, firstLine, lastLine, dtype=float):
+    """
+    Lazily read rows [firstLine, lastLine) of an output array
+    written by writeRowSlabs, in text or binary (``.npy``) format.
+    Binary files are memory-mapped and only the requested rows are read.
+
+    Args:
+        fileName: text or ``.npy`` file
+        firstLine, lastLine: range of rows
+        dtype: type of the entries of text files
+    """
+    if isBinaryFile(fileName):
+        return np.load(fileName, mmap_mode='r')[firstLine:lastLine]
+    return np.loadtxt(iterFileLines(fileName, firstLine, lastLine),
+                      dtype=dtype, ndmin=2)
+
+
+PDF_CODECS = ['text', 'float16', 'uint8', 'uint16', 'sparse']
+
+
+def isPDFCodecFile(fileName):
+    """
+    Returns True if fileName holds PDFs written with a compact codec,
+    i.e. is a directory with a ``codec.json`` manifest (see writePDFSlabs).
+    """
+    return os.path.isfile(os.path.join(fileName, 'codec.json'))
+
+
+def readPDFCodecManifest(fileName):
+    """
+    Read the manifest (codec, numRows, numZ, threshold) of PDFs
+    written with a compact codec.
+    """
+    with open(os.path.join(fileName, 'codec.json')) as f:
+        return json.load(f)
+
+
+def encodePDFs(pdfs, codec, threshold=1e-3):
+    """
+    Encode PDFs (array of size (numRows, numZ)) relative to their row maxima.
+    Returns a dictionary of arrays: the row maxima 'scales' and
+    - 'values' of size (numRows, numZ) for codecs float16, uint8 and uint16
+      (quantized to 8 or 16 bits for the latter two),
+    - 'values', 'indices' and 'counts' of the grid cells above
+      threshold times the row maximum for codec sparse.
+    """
+    pdfs = np.asarray(pdfs, dtype=float)
+    scales = pdfs.max(axis=1)
+    relPdfs = np.clip(pdfs / np.where(scales > 0, scales, 1)[:, None], 0, 1)
+    arrays = {'scales': scales}
+    if codec in ['uint8', 'uint16']:
+        qmax = np.iinfo(codec).max
+        arrays['values'] = np.round(relPdfs * qmax).astype(codec)
+    elif codec == 'float16':
+        arrays['values'] = relPdfs.astype(np.float16)
+    elif codec == 'sparse':
+        mask = (relPdfs >= threshold) & (relPdfs > 0)
+        rows, indices = np.nonzero(mask)
+        arrays['values'] = relPdfs[rows, indices].astype(np.float16)
+        arrays['indices'] = indices.astype(np.int32)
+        arrays['counts'] = mask.sum(axis=1)
+    else:
+        raise Exception(codec+' : is not a valid PDF codec')
+    return arrays
+
+
+def decodePDFs(codec, numZ, scales, values, indices=None, indptr=None):
+    """
+    Decode a block of PDFs encoded with encodePDFs into an array
+    of size (numRows, numZ). For codec sparse, indptr gives the
+    positions of the rows in values and indices, as in a CSR matrix.
+    """
+    scales = np.asarray(scales, dtype=float)
+    if codec in ['uint8', 'uint16']:
+        pdfs = values.astype(float) / np.iinfo(codec).max
+    elif codec == 'float16':
+        pdfs = values.astype(float)
+    elif codec == 'sparse':
+        indptr = np.asarray(indptr) - indptr[0]
+        rows = np.repeat(np.arange(scales.size), np.diff(indptr))
+        pdfs = np.zeros((scales.size, numZ))
+        pdfs[rows, indices] = values
+    else:
+        raise Exception(codec+' : is not a valid PDF codec')
+    return pdfs * scales[:, None]
+
+
+def writePDFSlabs(fileName, localPDFs, firstLine, numRows, comm=None,
+                  codec='text', threshold=1e-3, fmt='%.2e'):
+    """
+    Write PDFs of which each MPI process holds the slab starting
+    at row firstLine, with one of the PDF_CODECS.
+    The text codec is the format of writeRowSlabs (``.npy`` or text).
+    The other codecs write fileName as a directory holding a
+    ``codec.json`` manifest and ``.npy`` arrays (see encodePDFs),
+    the sparse codec as a CSR matrix (values, indices, indptr).
+    Must be called by all the processes of comm (None for a serial run).
+
+    Args:
+        fileName: output file or directory
+        localPDFs: array of size (number of local rows, numZ)
+        firstLine: index of the first row of the slab
+        numRows: total number of rows of the output
+        comm: MPI communicator, or None
+        codec: one of PDF_CODECS
+        threshold: fraction of the row maximum kept by the sparse codec
+        fmt: number format of the text codec
+    """
+    writer = RowSlabWriter(fileName, (numRows, localPDFs.shape[1]),
+                           firstLine, firstLine + localPDFs.shape[0],
+                           comm=comm, codec=codec, threshold=threshold,
+                           fmt=fmt)
+    writer.write(localPDFs)
+    writer.close()
+
+
+def readPDFRows(fileName, firstLine, lastLine):
+    """
+    Read rows [firstLine, lastLine) of PDFs written by writePDFSlabs,
+    with any codec, decompressed into an array of size (numRows, numZ).
+    """
+    if not isPDFCodecFile(fileName):
+        return readRowRange(fileName, firstLine, lastLine)
+    manifest = readPDFCodecManifest(fileName)
+    lastLine = max(firstLine, min(lastLine, manifest['numRows']))
+
+    def load(name):
+        return np.load(os.path.join(fileName, name + '.npy'), mmap_mode='r')
+
+    scales = load('scales')[firstLine:lastLine]
+    if manifest['codec'] == 'sparse':
+        indptr = load('indptr')[firstLine:lastLine+1]
+        return decodePDFs('sparse', manifest['numZ'], scales,
+                          load('values')[indptr[0]:indptr[-1]],
+                          indices=load('indices')[indptr[0]:indptr[-1]],
+                          indptr=indptr)
+    return decodePDFs(manifest['codec'], manifest['numZ'], scales,
+                      load('values')[firstLine:lastLine])
+
+
+class BlockPrefetcher():
+    """
+    Iterator reading the blocks of an iterable in a background thread,
+    at most numBuffered blocks ahead, so that block N+1 is read and parsed
+    while block N is processed (e.g. by the Cython kernels, which release
+    the GIL).
+    The time spent producing the blocks and the time spent waiting for them
+    are added to times['io'] and times['wait'] when the iteration ends,
+    their difference is the I/O time hidden behind computation.
+
+    Args:
+        blocks: iterable of blocks
+        numBuffered (Optional): maximum number of blocks read in advance
+        times (Optional): dictionary accumulating the timings
+    """
+    def __init__(self, blocks, numBuffered=2, times=None):
+        """ Constructor."""
+        self.queue = queue.Queue(maxsize=numBuffered)
+        self.stopEvent = threading.Event()
+        self.times = times
+        self.ioTime = 0.
+        self.waitTime = 0.
+        self.closed = False
+        self.thread = threading.Thread(target=self._produce,
+                                       args=(iter(blocks), ), daemon=True)
+        self.thread.start()
+
+    def _produce(self, blocks):
+        try:
+            while not self.stopEvent.is_set():
+                t1 = _time.time()
+                try:
+                    block = next(blocks)
+                except StopIteration:
+                    break
+                self.ioTime += _time.time() - t1
+                self._put((True, block))
+        except Exception as e:
+            self._put((False, e))
+            return
+        self._put((False, None))
+
+    def _put(self, item):
+        while not self.stopEvent.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t1 = _time.time()
+        ok, block = self.queue.get()
+        self.waitTime += _time.time() - t1
+        if ok:
+            return block
+        self.close()
+        if block is not None:
+            raise block
+        raise StopIteration
+
+    def close(self):
+        """
+        Stop the background thread and record the timings.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.stopEvent.set()
+        self.thread.join()
+        if self.times is not None:
+            self.times['io'] = self.times.get('io', 0.) + self.ioTime
+            self.times['wait'] = self.times.get('wait', 0.) + self.waitTime
 
 
 def getDataFromFile(params, firstLine, lastLine,
-                    prefix="", ftype="catalog", getXY=True, CV=False):
+                    prefix="", ftype="catalog", getXY=True, CV=False,
+                    chunkSize=10000, prefetch=False, prefetchTimes=None):
     """
     Returns an iterator to parse an input catalog file.
     Returns the fluxes, redshifts, etc, and also GP inputs if getXY=True.
+    The catalog is read by chunks of chunkSize rows,
+    see getDataBlockFromFile.
+    With ftype="gpparams", returns the GP cores written by delight-learn.
+    For binary GP core stores (see createGPCoreStore) the last element
+    is the record of the object instead of a flat array.
+    With prefetch=True, chunks are read in a background thread while
+    the previous one is processed (see BlockPrefetcher), and the timings
+    are accumulated in the prefetchTimes dictionary.
     """
 
-    if ftype == "gpparams":
+    def iterBlocks(readBlock, lastLine):
+        blocks = (readBlock(first, min(lastLine, first + chunkSize))
+                  for first in range(firstLine, lastLine, chunkSize))
+        if prefetch:
+            return BlockPrefetcher(blocks, times=prefetchTimes)
+        return blocks
 
-        with open(params[prefix+'paramFile']) as f:
-            for line in itertools.islice(f, firstLine, lastLine):
-                data = np.fromstring(line, dtype=float, sep=' ')
-                B = int(data[0])
-                z = data[1]
-                ell = data[2]
-                bands = data[3:3+B]
-                flatarray = data[3+B:]
-                X = np.zeros((B, 3))
-                for off, iband in enumerate(bands):
-                    X[off, 0] = iband
-                    X[off, 1] = z
-                    X[off, 2] = ell
+    if ftype == "gpparams" and isBinaryFile(params[prefix+'paramFile']):
 
-                yield z, ell, bands, X, B, flatarray
+        store = openGPCoreStore(params[prefix+'paramFile'])
+
+        def readBlock(first, last):
+            return np.array(store[first:last])
+
+        blocks = iterBlocks(readBlock, min(lastLine, store.shape[0]))
+        try:
+            for cores in blocks:
+                for core in cores:
+                    B = int(core['B'])
+                    z = core['z']
+                    ell = core['ell']
+                    bands = core['bands'][:B]
+                    X = np.zeros((B, 3))
+                    X[:, 0] = bands
+                    X[:, 1] = z
+                    X[:, 2] = ell
+
+                    yield z, ell, bands, X, B, core
+        finally:
+            if prefetch:
+                blocks.close()
+
+    elif ftype == "gpparams":
+
+        nt = len(params['templates_names'])
+
+        def readBlock(first, last):
+            return [np.fromstring(line, dtype=float, sep=' ') for line in
+                    iterFileLines(params[prefix+'paramFile'], first, last)]
+
+        blocks = iterBlocks(readBlock, lastLine)
+        try:
+            for block in blocks:
+                for data in block:
+                    B = int(data[0])
+                    z = data[1]
+                    ell = data[2]
+                    bands = data[3:3+B]
+                    flatarray = data[3+B:3+B+nt+B+B*(B+1)//2]
+                    X = np.zeros((B, 3))
+                    X[:, 0] = bands
+                    X[:, 1] = z
+                    X[:, 2] = ell
+
+                    yield z, ell, bands, X, B, flatarray
+        finally:
+            if prefetch:
+                blocks.close()
 
     if ftype == "catalog":
 
-        DL = approx_DL()
         bandIndices, bandNames, bandColumns, bandVarColumns, redshiftColumn,\
             refBandColumn = readColumnPositions(params, prefix=prefix)
+        if CV:
+            bandIndicesCV, bandNamesCV, bandColumnsCV,\
+                bandVarColumnsCV, redshiftColumnCV =\
+                readColumnPositions(params, prefix=prefix+'CV_', refFlux=False)
         bandCoefAmplitudes, bandCoefPositions, bandCoefWidths, norms\
             = readBandCoefficients(params)
         refBandNorm = norms[params['bandNames']
                             .index(params[prefix+'referenceBand'])]
 
-        if CV:
-            bandIndicesCV, bandNamesCV, bandColumnsCV,\
-                bandVarColumnsCV, redshiftColumnCV =\
-                readColumnPositions(params, prefix=prefix+'CV_', refFlux=False)
+        def readBlock(first, last):
+            return (first, last) + getDataBlockFromFile(params, first, last,
+                                                        prefix=prefix, CV=CV)
 
-        with open(params[prefix+'catFile']) as f:
-            for line in itertools.islice(f, firstLine, lastLine):
+        blocks = iterBlocks(readBlock, lastLine)
+        try:
+            for first, last, zs, normedRefFluxes, ells, allFluxes,\
+                    allFluxesVar, masks, valids, allFluxesCV,\
+                    allFluxesCVVar, masksCV in blocks:
 
-                data = np.array(line.split(' '), dtype=float)
-                refFlux = data[refBandColumn]
-                normedRefFlux = refFlux * refBandNorm
-                if redshiftColumn >= 0:
-                    z = data[redshiftColumn]
-                else:
-                    z = -1
-
-                # drop bad values and find how many bands are valid
-                mask = np.isfinite(data[bandColumns])
-                mask &= np.isfinite(data[bandVarColumns])
-                mask &= data[bandColumns] > 0.0
-                mask &= data[bandVarColumns] > 0.0
-                bandsUsed = np.where(mask)[0]
-                numBandsUsed = mask.sum()
-
-                if z > -1:
-                    ell = normedRefFlux * 4 * np.pi \
-                        * params['fluxLuminosityNorm'] * DL(z)**2 * (1+z)
-
-                if (refFlux <= 0) or (not np.isfinite(refFlux))\
-                        or (z < 0) or (numBandsUsed <= 1):
-                    print("Skipping galaxy: refflux=", refFlux,
-                          "z=", z, "numBandsUsed=", numBandsUsed)
-                    continue  # not valid data - skip to next valid object
-
-                fluxes = data[bandColumns[mask]]
-                fluxesVar = data[bandVarColumns[mask]] +\
-                    (params['training_extraFracFluxError'] * fluxes)**2
-
-                if CV:
-                    maskCV = np.isfinite(data[bandColumnsCV])
-                    maskCV &= np.isfinite(data[bandVarColumnsCV])
-                    maskCV &= data[bandColumnsCV] > 0.0
-                    maskCV &= data[bandVarColumnsCV] > 0.0
-                    bandsUsedCV = np.where(maskCV)[0]
-                    numBandsUsedCV = maskCV.sum()
-                    fluxesCV = data[bandColumnsCV[maskCV]]
-                    fluxesCVVar = data[bandVarColumnsCV[maskCV]] +\
-                        (params['training_extraFracFluxError'] * fluxesCV)**2
-
-                if not getXY:
+                for o in range(zs.size):
+
+                    z, normedRefFlux, ell, mask =\
+                        zs[o], normedRefFluxes[o], ells[o], masks[o]
+                    if not valids[o]:
+                        print("Skipping galaxy: refflux=",
+                              normedRefFlux / refBandNorm,
+                              "z=", z, "numBandsUsed=", mask.sum())
+                        continue  # not valid data - skip to next valid object
 
+                    fluxes = allFluxes[o, mask]
+                    fluxesVar = allFluxesVar[o, mask]
                     if CV:
-                        yield z, normedRefFlux,\
-                            bandIndices[mask], fluxes, fluxesVar,\
-                            bandIndicesCV[maskCV], fluxesCV, fluxesCVVar
+                        maskCV = masksCV[o]
+                        fluxesCV = allFluxesCV[o, maskCV]
+                        fluxesCVVar = allFluxesCVVar[o, maskCV]
+                        bandsCV = bandIndicesCV[maskCV]
                     else:
+                        bandsCV, fluxesCV, fluxesCVVar = None, None, None
+
+                    if not getXY:
+
                         yield z, normedRefFlux,\
                             bandIndices[mask], fluxes, fluxesVar,\
-                            None, None, None
+                            bandsCV, fluxesCV, fluxesCVVar
 
-                if getXY:
+                    if getXY:
 
-                    Y = np.zeros((numBandsUsed, 1))
-                    Yvar = np.zeros((numBandsUsed, 1))
-                    X = np.ones((numBandsUsed, 3))
-                    for off, iband in enumerate(bandIndices[mask]):
-                        X[off, 0] = iband
-                        X[off, 1] = z
-                        X[off, 2] = ell
-                        Y[off, 0] = fluxes[off]
-                        Yvar[off, 0] = fluxesVar[off]
+                        numBandsUsed = fluxes.size
+                        X = np.ones((numBandsUsed, 3))
+                        X[:, 0] = bandIndices[mask]
+                        X[:, 1] = z
+                        X[:, 2] = ell
+                        Y = fluxes.reshape((numBandsUsed, 1))
+                        Yvar = fluxesVar.reshape((numBandsUsed, 1))
 
-                    if CV:
                         yield z, normedRefFlux,\
                             bandIndices[mask], fluxes, fluxesVar,\
-                            bandIndicesCV[maskCV], fluxesCV, fluxesCVVar,\
-                            X, Y, Yvar
-                    else:
-                        yield z, normedRefFlux,\
-                            bandIndices[mask], fluxes, fluxesVar,\
-                            None, None, None,\
+                            bandsCV, fluxesCV, fluxesCVVar,\
                             X, Y, Yvar
+
+                if zs.size < last - first:
+                    break
+        finally:
+            if prefetch:
+                blocks.close()
@@ -4,10 +4,11 @@ import numpy as np
 from copy import copy
 import scipy.linalg
 from scipy.optimize import minimize
-from scipy.interpolate import interp1d
 
-from delight.utils import approx_DL, scalefree_flux_likelihood, symmetrize
+from delight.utils import approx_DL, scalefree_flux_likelihood, symmetrize,\
+    LinearInterpolationOperator
 from delight.photoz_kernels import *
+from delight.photoz_kernels_cy import predict_batch_grid
 
 import logging
 import coloredlogs
@@ -54,6 +55,10 @@ class PhotozGP_SN:
             (``float``, default: ``4.5e3``)
         g_AB (Optional): AB photometric normalization constant
             (``float``, default: ``1.0``)
+        gridCache (Optional): ``KernelGridCache`` for the kernel grids
+            (default: ``None``, no cache)
+        comm (Optional): MPI communicator for sharing the kernel grids
+            between the ranks of a node (default: ``None``)
     """
     def __init__(self,
                  bandCoefAmplitudes, bandCoefPositions, bandCoefWidths,
@@ -62,7 +67,9 @@ class PhotozGP_SN:
                  redshiftGridGP,
                  use_interpolators=True,
                  lambdaRef=4.5e3,
-                 g_AB=1.0):
+                 g_AB=1.0,
+                 gridCache=None,
+                 comm=None):
 
         DL = approx_DL()
         self.bands = np.arange(bandCoefAmplitudes.shape[0])
@@ -70,31 +77,148 @@ class PhotozGP_SN:
             bandCoefAmplitudes, bandCoefPositions, bandCoefWidths,
             lines_pos, lines_width, var_C, var_L, alpha_T, alpha_C, alpha_L,
             g_AB=g_AB, DL_z=DL, redshiftGrid=redshiftGridGP,
-            use_interpolators=use_interpolators)
+            use_interpolators=use_interpolators, gridCache=gridCache,
+            comm=comm)
         self.redshiftGridGP = redshiftGridGP
 
-    def setData(self, X, Y, Yvar):
+    def setData(self, X, Y, Yvar, structured=True):
         """
         Set data content for the Gaussian process.
 
+        If the observations form a full grid of photometric inputs
+        (band, redshift, luminosity) and epochs, e.g. a light curve
+        observed in all bands at shared epochs, and if the flux variances
+        factorize into a band term times an epoch term (e.g. constant
+        per band), the kernel matrix is a Kronecker product of a
+        photometric and a time matrix and is never formed (see
+        kroneckerSolve). Otherwise a dense Cholesky factorization is used.
+        The dense factorization only reads the lower triangle of the
+        kernel matrix, which is not exactly symmetric with SED lines;
+        the Kronecker path does the same with rows sorted by band.
+        The Kronecker log determinant is then that of the symmetrized
+        matrix, while the dense one is taken over the full matrix,
+        so the marginal likelihoods differ slightly with lines.
+
         Args:
             X: array of size (nobj, 4) containing the GP inputs.
-                The column order is band, redshift, and luminosity.
+                The column order is band, redshift, luminosity and time.
             Y: array of size (nobj, 1) containing the GP outputs.
                 Contains the photometric fluxes corresponding to the inputs.
             Yvar: array of size (nobj, 1) containing the GP outputs.
                 Contains the flux variances corresponding to the inputs.
+            structured (Optional): use the Kronecker path when possible
+                (default: ``True``)
         """
         self.X = X
         self.Y = Y.reshape((-1, 1))
         self.Yvar = Yvar.reshape((-1, 1))
-        self.KXX = self.kernel.K(self.X)
-        self.A = self.KXX + np.diag(self.Yvar.flatten())
-        sign, self.logdet = np.linalg.slogdet(self.A)
-        self.logdet *= sign
-        self.L = scipy.linalg.cholesky(self.A, lower=True)
+        self.kron = None
+        if structured:
+            self.kron = self.kroneckerFactors(X, self.Yvar)
+        if self.kron is None:
+            self.KXX = self.kernel.K(self.X)
+            self.A = self.KXX + np.diag(self.Yvar.flatten())
+            sign, self.logdet = np.linalg.slogdet(self.A)
+            self.logdet *= sign
+            self.L = scipy.linalg.cholesky(self.A, lower=True)
+        else:
+            self.L = None
+            lambdas, noise = self.kron['lambdas'], self.kron['noise']
+            self.logdet = np.sum(np.log(lambdas)) + np.sum(np.log(noise))
         self.D = 1*self.Y
-        self.beta = scipy.linalg.cho_solve((self.L, True), self.D)
+        self.beta = self.solve(self.D)
+
+    def kroneckerFactors(self, X, Yvar):
+        """
+        Factorization of the kernel matrix plus noise as
+        ``S (KP x KT + I) S``, with S the noise standard deviations
+        and KP, KT the photometric and time kernels scaled by them.
+        Returns ``None`` if the data are not on a full grid of
+        photometric inputs and epochs, or if the noise does not factorize.
+
+        Args:
+            X: array of size (nobj, 4) containing the GP inputs.
+            Yvar: array of size (nobj, 1) containing the flux variances.
+        """
+        grid = self.kroneckerGrid(X, Yvar)
+        if grid is None:
+            return None
+        KP = self.kernel.K_photometric(X)[0]
+        KP = np.tril(KP) + np.tril(KP, -1).T
+        KT = self.kernel.K_time(grid['times'])
+        sP, sT = np.sqrt(grid['dP']), np.sqrt(grid['dT'])
+        lambdaP, QP = np.linalg.eigh(KP / sP[:, None] / sP[None, :])
+        lambdaT, QT = np.linalg.eigh(KT / sT[:, None] / sT[None, :])
+        return {'order': grid['order'], 'noise': grid['noise'],
+                'scale': sP[:, None] * sT[None, :],
+                'QP': QP, 'QT': QT,
+                'lambdas': lambdaP[:, None] * lambdaT[None, :] + 1}
+
+    def kroneckerGrid(self, X, Yvar):
+        """
+        Grid structure of the data used by kroneckerFactors,
+        or ``None`` if the data are not on a full grid of
+        photometric inputs and epochs, or if the noise does not factorize.
+
+        Args:
+            X: array of size (nobj, 4) containing the GP inputs.
+            Yvar: array of size (nobj, 1) containing the flux variances.
+
+        Returns:
+            dictionary with the distinct photometric inputs P (sorted as
+            by ``numpy.unique``) and epochs times, the rows of the data
+            on the (nP, nT) grid order, their variances noise, and the
+            band and epoch terms dP and dT of the variances.
+        """
+        P, iP = np.unique(X[:, 0:3], axis=0, return_inverse=True)
+        times, iT = np.unique(X[:, 3], return_inverse=True)
+        nP, nT = P.shape[0], times.size
+        iP, iT = iP.ravel(), iT.ravel()
+        if nP * nT != X.shape[0] or nP == 1 or nT == 1:
+            return None
+        order = np.full((nP, nT), -1)
+        order[iP, iT] = np.arange(X.shape[0])
+        if np.any(order < 0):  # repeated (input, epoch) pairs
+            return None
+        noise = Yvar.ravel()[order]
+        dP = noise[:, 0]
+        dT = noise[0, :] / noise[0, 0]
+        if not np.allclose(noise, dP[:, None] * dT[None, :],
+                           rtol=1e-10, atol=0):
+            return None
+        return {'P': P, 'times': times, 'order': order, 'noise': noise,
+                'dP': dP, 'dT': dT}
+
+    def kroneckerSolve(self, B):
+        """
+        Solve (K + noise) x = B with the Kronecker factorization,
+        in O(nP nT (nP + nT)) per column instead of O((nP nT)^3).
+
+        Args:
+            B: array of size (nobj, ncol), rows in the order of the data.
+        """
+        kron = self.kron
+        order, scale = kron['order'], kron['scale'][:, :, None]
+        QP, QT = kron['QP'], kron['QT']
+        B_grid = B[order, :] / scale
+        Z = np.einsum('pi,ptk,tj->ijk', QP, B_grid, QT)
+        Z /= kron['lambdas'][:, :, None]
+        X_grid = np.einsum('pi,ijk,tj->ptk', QP, Z, QT) / scale
+        res = np.zeros_like(B, dtype=float)
+        res[order.ravel(), :] = X_grid.reshape((-1, B.shape[1]))
+        return res
+
+    def solve(self, B):
+        """
+        Solve (K + noise) x = B, with the Kronecker factorization
+        if the data have one, the Cholesky factor otherwise.
+
+        Args:
+            B: array of size (nobj, ncol), rows in the order of the data.
+        """
+        if self.kron is not None:
+            return self.kroneckerSolve(B)
+        return scipy.linalg.cho_solve((self.L, True), B)
 
     def margLike(self):
         """
@@ -103,24 +227,81 @@ class PhotozGP_SN:
         return 0.5 * np.sum(self.beta * self.D) +\
             0.5 * self.logdet + 0.5 * self.D.size * log_2_pi
 
+    def margLikeBatch(self, Xs, Ys, Yvars, structured=True):
+        """
+        Marginalized likelihoods of many data sets (e.g. light curves)
+        with the current kernel hyperparameters.
+        The data sets with a Kronecker structure (see kroneckerFactors)
+        are grouped by epochs and epoch noise terms: each group uses one
+        eigendecomposition of the time kernel, and the photometric
+        kernels of its data sets are computed and diagonalized at once.
+        The others use a dense Cholesky factorization.
+        The data of the GP are left unchanged.
+
+        Args:
+            Xs, Ys, Yvars: sequences of inputs, outputs and variances,
+                as in setData.
+            structured (Optional): use the Kronecker path when possible
+                (default: ``True``)
+        """
+        margLikes = np.zeros((len(Xs), ))
+        groups = {}
+        for i, (X, Y, Yvar) in enumerate(zip(Xs, Ys, Yvars)):
+            grid = None
+            if structured:
+                grid = self.kroneckerGrid(X, Yvar)
+            if grid is not None:
+                key = (grid['P'].shape[0], grid['times'].tobytes(),
+                       grid['dT'].tobytes())
+                groups.setdefault(key, []).append(
+                    (i, grid, Y.ravel()[grid['order']]))
+                continue
+            A = self.kernel.K(X) + np.diag(Yvar.ravel())
+            sign, logdet = np.linalg.slogdet(A)
+            L = scipy.linalg.cholesky(A, lower=True)
+            beta = scipy.linalg.cho_solve((L, True), Y.reshape((-1, 1)))
+            margLikes[i] = 0.5 * np.sum(beta * Y.reshape((-1, 1))) +\
+                0.5 * sign * logdet + 0.5 * Y.size * log_2_pi
+        for members in groups.values():
+            ind = [i for i, grid, Y_grid in members]
+            grids = [grid for i, grid, Y_grid in members]
+            KT = self.kernel.K_time(grids[0]['times'])
+            sT = np.sqrt(grids[0]['dT'])
+            lambdaT, QT = np.linalg.eigh(KT / sT[:, None] / sT[None, :])
+            KP = self.kernel.K_photometric_batch(
+                np.array([grid['P'] for grid in grids]))
+            KP = np.tril(KP) + np.transpose(np.tril(KP, -1), (0, 2, 1))
+            sP = np.sqrt(np.array([grid['dP'] for grid in grids]))
+            lambdaP, QP = np.linalg.eigh(
+                KP / sP[:, :, None] / sP[:, None, :])
+            lambdas = lambdaP[:, :, None] * lambdaT[None, None, :] + 1
+            noise = np.array([grid['noise'] for grid in grids])
+            Y_grid = np.array([Y_grid for i, grid, Y_grid in members]) /\
+                (sP[:, :, None] * sT[None, None, :])
+            Z = np.einsum('npi,npt,tj->nij', QP, Y_grid, QT)
+            margLikes[ind] = 0.5 * np.sum(Z**2 / lambdas, axis=(1, 2)) +\
+                0.5 * np.sum(np.log(lambdas), axis=(1, 2)) +\
+                0.5 * np.sum(np.log(noise), axis=(1, 2)) +\
+                0.5 * noise[0].size * log_2_pi
+        return margLikes
+
     def predict(self, x_pred, diag=True):
         """
         Raw way to predict outputs with the GP.
         Args:
             x_pred: input array of size (nobj, 4).
-                The column order is band, redshift, and luminosity.
+                The column order is band, redshift, luminosity and time.
             diag (Optional): return the predicted variance on the diagonal only
         """
         assert x_pred.shape[1] == 4
         KXXp = self.kernel.K(x_pred, self.X)
-        v = scipy.linalg.cho_solve((self.L, True), KXXp.T)
+        v = self.solve(KXXp.T)
         if diag:
             y_pred_cov = self.kernel.Kdiag(x_pred)
             for i in range(x_pred.shape[0]):
                 y_pred_cov[i] -= KXXp[i, :].dot(v[:, i])
         else:
             KXpXp = self.kernel.K(x_pred)
-            v = scipy.linalg.cho_solve((self.L, True), KXXp.T)
             y_pred_cov = KXpXp - KXXp.dot(v)
         y_pred = np.dot(KXXp, self.beta)
         return y_pred, y_pred_cov
@@ -160,6 +341,17 @@ class PhotozGP:
             (``float``, default: ``4.5e3``)
         g_AB (Optional): AB photometric normalization constant
             (``float``, default: ``1.0``)
+        gridCache (Optional): ``KernelGridCache`` for the kernel grids
+            (default: ``None``, no cache)
+        comm (Optional): MPI communicator for sharing the kernel grids
+            between the ranks of a node (default: ``None``)
+        bands (Optional): indices of the bands the GP is built for,
+            e.g. from readBandSubset. Predictions are made for these bands
+            only; ``compactIndex`` maps band indices to their columns
+            (default: ``None``, all bands)
+        gridDtype (Optional): storage type of the kernel grids,
+            ``numpy.float64`` or ``numpy.float32``
+            (default: ``numpy.float64``)
     """
     def __init__(self,
                  f_mod_interp,
@@ -169,10 +361,13 @@ class PhotozGP:
                  redshiftGridGP,
                  use_interpolators=True,
                  lambdaRef=4.5e3,
-                 g_AB=1.0):
+                 g_AB=1.0,
+                 gridCache=None,
+                 comm=None,
+                 bands=None,
+                 gridDtype=np.float64):
 
         DL = approx_DL()
-        self.bands = np.arange(bandCoefAmplitudes.shape[0])
         if isinstance(f_mod_interp, int):
             self.mean_fct = None
             self.nt = f_mod_interp
@@ -186,8 +381,12 @@ class PhotozGP:
             bandCoefAmplitudes, bandCoefPositions, bandCoefWidths,
             lines_pos, lines_width, var_C, var_L, alpha_C, alpha_L,
             g_AB=g_AB, DL_z=DL, redshiftGrid=redshiftGridGP,
-            use_interpolators=use_interpolators)
+            use_interpolators=use_interpolators, gridCache=gridCache,
+            comm=comm, bands=bands, gridDtype=gridDtype)
+        self.bands = self.kernel.bandIndices
+        self.compactIndex = self.kernel.compactIndex
         self.redshiftGridGP = redshiftGridGP
+        self.interpolator = None
 
     def setData(self, X, Y, Yvar, bestType=None):
         """
@@ -224,6 +423,64 @@ class PhotozGP:
             self.D -= np.dot(hx.T, self.betas)[:, None]
         self.beta = scipy.linalg.cho_solve((self.L, True), self.D)
 
+    def setDataBatch(self, X, Y, Yvar, bestTypes, cores):
+        """
+        Batched version of setData and getCore for many objects,
+        e.g. a block of the training set.
+        The objects are grouped by number of bands. The kernels of each
+        group are computed in one call and factorized with stacked
+        Cholesky decompositions, which also give the log determinants.
+        The GP cores are written in cores; the data of the GP
+        itself are left unchanged.
+
+        Args:
+            X: list of arrays of size (nobj_i, 3) containing the GP inputs
+                of each object.
+            Y: list of arrays of size (nobj_i, 1) containing the fluxes.
+            Yvar: list of arrays of size (nobj_i, 1) containing the
+                flux variances.
+            bestTypes: array of best fit templates, for the mean function.
+            cores: array of GP core records (see
+                ``delight.io.gpCoreDtype``), filled in place.
+
+        Returns:
+            logdets: log determinants of the kernel+noise matrices.
+        """
+        numObjects = len(X)
+        B = np.array([x.shape[0] for x in X])
+        bestTypes = np.asarray(bestTypes, dtype=int)
+        logdets = np.zeros((numObjects, ))
+        for lB in np.unique(B):
+            ind = np.where(B == lB)[0]
+            nG = ind.size
+            Xg = np.array([X[i] for i in ind]).reshape((nG, lB, 3))
+            Yg = np.array([Y[i] for i in ind]).reshape((nG, lB, 1))
+            Yvarg = np.array([Yvar[i] for i in ind]).reshape((nG, lB))
+            A = self.kernel.K_batch(Xg)
+            A[:, np.arange(lB), np.arange(lB)] += Yvarg
+            L = np.linalg.cholesky(A)
+            logdets[ind] = 2 * np.sum(
+                np.log(np.diagonal(L, axis1=1, axis2=2)), axis=1)
+            D = 1*Yg
+            betas = np.zeros((nG, self.nt))
+            if self.mean_fct is not None:
+                betas[np.arange(nG), bestTypes[ind]] = 1.0
+                hx = self.mean_fct.f(Xg.reshape((-1, 3)))\
+                    .reshape((nG, lB, -1))[np.arange(nG), :, bestTypes[ind]]
+                hx[~np.isfinite(hx)] = 0
+                D -= hx[:, :, None]
+            beta = np.linalg.solve(np.transpose(L, (0, 2, 1)),
+                                   np.linalg.solve(L, D))
+            cores['B'][ind] = lB
+            cores['z'][ind] = Xg[:, 0, 1]
+            cores['ell'][ind] = Xg[:, 0, 2]
+            cores['bands'][ind, :lB] = Xg[:, :, 0]
+            cores['betas'][ind] = betas
+            cores['L'][ind, :lB, :lB] = L
+            cores['D'][ind, :lB] = D[:, :, 0]
+            cores['beta'][ind, :lB] = beta[:, :, 0]
+        return logdets
+
     def getCore(self):
         """
         Returns core matrices, useful to re-use the GP elsewhere.
@@ -245,13 +502,24 @@ class PhotozGP:
         The core matrices contain stuff that doesn't need to be recomputed.
 
         Args:
-            flatarray: size numTemplates+numBands+numBands*(numBands+1)//2.
+            flatarray: size numTemplates+numBands+numBands*(numBands+1)//2,
+                or record of a binary GP core store
+                (see ``delight.io.createGPCoreStore``). In the latter case
+                the core matrices are views of the record
+                and beta is not solved for again.
             X: the GP inputs, of size (nobj, 3).
             B: ``float`` the number of bands.
             nt: ``float`` the number of templates.
 
         """
         self.X = X
+        if flatarray.dtype.names is not None:
+            self.betas = flatarray['betas']
+            self.bestType = int(np.argmax(self.betas))
+            self.L = flatarray['L'][:B, :B]
+            self.D = flatarray['D'][:B, None]
+            self.beta = flatarray['beta'][:B, None]
+            return
         self.betas = flatarray[0:nt]
         self.bestType = int(np.argmax(self.betas))
         self.D = flatarray[nt+B*(B+1)//2:].reshape((-1, 1))
@@ -266,21 +534,49 @@ class PhotozGP:
         return 0.5 * np.sum(self.beta * self.D) +\
             0.5 * self.logdet + 0.5 * self.D.size * log_2_pi
 
-    def predict(self, x_pred, diag=True):
+    def margLikeGradients(self):
+        """
+        Returns the gradient of the marginalized likelihood
+        with respect to var_C, var_L, alpha_C and alpha_L,
+        as an array of size 4.
+        Uses the kernel parts of the last call to kernel.K(self.X)
+        (e.g. in setData), which must have been made
+        with kernel.grad_needed set to True.
+        """
+        # The line parts make A slightly asymmetric: the log determinant
+        # sees all of A, the Cholesky factor only its lower triangle.
+        # d margLike = 0.5 * tr(A^-1 dA) - 0.5 * beta^T tril_sym(dA) beta
+        AinvT = np.linalg.inv(self.A).T
+        bbT = np.outer(self.beta, self.beta)
+        ell = self.X[:, 2]
+        prefac = self.kernel.Zprefac**2 * ell[:, None] * ell[None, :]
+        dKs = [self.kernel.KC, self.kernel.KL,
+               self.kernel.var_C * self.kernel.D_alpha_C,
+               self.kernel.var_L * self.kernel.D_alpha_L]
+        grads = np.zeros((len(dKs), ))
+        for i, dK in enumerate(dKs):
+            dA = prefac * dK
+            dAsym = np.tril(dA) + np.tril(dA, -1).T
+            grads[i] = 0.5 * np.sum(AinvT * dA) - 0.5 * np.sum(bbT * dAsym)
+        return grads
+
+    def predict(self, x_pred, diag=True, KXXp=None):
         """
         Raw way to predict outputs with the GP.
         Args:
             x_pred: input array of size (nobj, 3).
                 The column order is band, redshift, and luminosity.
             diag (Optional): return the predicted variance on the diagonal only
+            KXXp (Optional): cross kernel between x_pred and the data,
+                if already computed.
         """
         assert x_pred.shape[1] == 3
-        KXXp = self.kernel.K(x_pred, self.X)
+        if KXXp is None:
+            KXXp = self.kernel.K(x_pred, self.X)
         v = scipy.linalg.cho_solve((self.L, True), KXXp.T)
         if diag:
             y_pred_cov = self.kernel.Kdiag(x_pred)
-            for i in range(x_pred.shape[0]):
-                y_pred_cov[i] -= KXXp[i, :].dot(v[:, i])
+            y_pred_cov -= np.sum(KXXp * v.T, axis=1)
         else:
             KXpXp = self.kernel.K(x_pred)
             v = scipy.linalg.cho_solve((self.L, True), KXXp.T)
@@ -312,34 +608,34 @@ class PhotozGP:
         numBands = self.bands.size
         numZGP = self.redshiftGridGP.size
         redshiftGridGP_loc = 1 * self.redshiftGridGP
+        interpolator = self.interpolationOperator(redshiftGrid)
+        interp = interpolator.matrix
         if z is not None:
             zloc = np.abs(z - redshiftGridGP_loc).argmin()
             redshiftGridGP_loc[zloc] = z
+            interp = interpolator.withNode(zloc, z)
         xv, yv = np.meshgrid(redshiftGridGP_loc, self.bands,
                              sparse=False, indexing='xy')
         X_pred = np.ones((numBands*numZGP, 3))
         X_pred[:, 0] = yv.flatten()
         X_pred[:, 1] = xv.flatten()
         X_pred[:, 2] = ell
-        y_pred, y_pred_cov = self.predict(X_pred, diag=True)
-        model_mean = np.zeros((redshiftGrid.size, numBands))
-        model_var = np.zeros((redshiftGrid.size, numBands))
-        for i in range(numBands):
-            y_pred_bin = y_pred[i*numZGP:(i+1)*numZGP].ravel()
-            y_var_bin = y_pred_cov[i*numZGP:(i+1)*numZGP].ravel()
-            model_mean[:, i] = interp1d(redshiftGridGP_loc,
-                                        y_pred_bin,
-                                        assume_sorted=True,
-                                        copy=False)(redshiftGrid)
-            # np.interp(redshiftGrid, redshiftGridGP_loc, y_pred_bin)
-            if np.any(y_var_bin <= 0):
-                print(z, "band", i, "y_pred_bin",
-                      y_pred_bin, "y_var_bin", y_var_bin)
-            model_var[:, i] = interp1d(redshiftGridGP_loc,
-                                       y_var_bin,
-                                       assume_sorted=True,
-                                       copy=False)(redshiftGrid)
-            #  np.interp(redshiftGrid, redshiftGridGP_loc, y_var_bin)
+        KXXp = None
+        if self.kernel.use_interpolators and\
+                np.all(self.X[:, 1] == self.X[0, 1]):
+            # the inputs are on the grid nodes, except at z
+            KXXp = self.kernel.K_grid(self.X, ell=ell)
+            if z is not None:
+                rows = zloc + numZGP * np.arange(numBands)
+                KXXp[rows, :] = self.kernel.K(X_pred[rows, :], self.X)
+        y_pred, y_pred_cov = self.predict(X_pred, diag=True, KXXp=KXXp)
+        y_pred = y_pred.reshape((numBands, numZGP)).T
+        y_var = y_pred_cov.reshape((numBands, numZGP)).T
+        if np.any(y_var <= 0):
+            logger.warning('%i non-positive predicted variances'
+                           % np.sum(y_var <= 0))
+        model_mean = interp.dot(y_pred)
+        model_var = interp.dot(y_var)
         # model_covar = np.zeros((redshiftGrid.size, numBands, numBands))
         # for i in range(numBands):
         #    for j in range(numBands):
@@ -352,6 +648,75 @@ class PhotozGP:
         # interp_spline(redshiftGrid, redshiftGrid, grid=False)
         return model_mean, model_var
 
+    def predictAndInterpolateBatch(self, redshiftGrid, cores):
+        """
+        Batched version of setCore and predictAndInterpolate for many
+        training objects: flux predictions on a redshift/band grid,
+        computed on the GP grid in one compiled, threaded pass
+        and interpolated linearly on the finer grid.
+        Requires the kernel interpolators (use_interpolators=True).
+
+        Args:
+            redshiftGrid: array to get predictions for.
+            cores: array of GP core records (see
+                ``delight.io.gpCoreDtype``), e.g. a slice of a binary
+                GP core store. The predictions are made at the
+                luminosity ell of each core.
+
+        Returns:
+            model_mean, model_var: arrays of size
+            (redshiftGrid.size, cores.size, numBands)
+        """
+        assert self.kernel.use_interpolators
+        kernel = self.kernel
+        NT = cores.shape[0]
+        numBands = self.bands.size
+        numZGP = self.redshiftGridGP.size
+        B = cores['B'].astype(int)
+        bands = np.zeros(cores['bands'].shape, dtype=int)
+        for j in range(bands.shape[1]):
+            sel = B > j
+            bands[sel, j] = kernel.roundband(cores['bands'][sel, j])
+        z, ell = cores['z'].astype(float), cores['ell'].astype(float)
+        fz = 1 + z
+        fzGP = 1 + self.redshiftGridGP
+        sk = fzGP / kernel.DL_z(self.redshiftGridGP) /\
+            (kernel.fourpi * kernel.g_AB)
+        skd = fzGP * sk / kernel.DL_z(self.redshiftGridGP)
+        sn = ell * fz / kernel.DL_z(z)
+        model_mean = np.zeros((numZGP, NT, numBands))
+        model_var = np.zeros((numZGP, NT, numBands))
+        predict_batch_grid(NT, numBands, numZGP, B, bands,
+                           fz, kernel.binLocator(fz), sn, ell, sk, skd,
+                           cores['L'], cores['beta'], fzGP,
+                           kernel.var_C, kernel.var_L,
+                           kernel.KC_grid, kernel.KL_grid,
+                           kernel.KC_diag_grid, kernel.KL_diag_grid,
+                           model_mean, model_var)
+        if isinstance(self.mean_fct, Photoz_linear_sed_basis):
+            X_pred = np.ones((numBands*numZGP, 3))
+            X_pred[:, 0] = np.repeat(self.bands, numZGP)
+            X_pred[:, 1] = np.tile(self.redshiftGridGP, numBands)
+            hx = self.mean_fct.f(X_pred).reshape((numBands, numZGP, -1))
+            model_mean += ell[None, :, None] *\
+                np.einsum('nt,bkt->knb', cores['betas'], hx)
+        if np.any(model_var <= 0):
+            logger.warning('%i non-positive predicted variances'
+                           % np.sum(model_var <= 0))
+        interpolator = self.interpolationOperator(redshiftGrid)
+        return interpolator(model_mean), interpolator(model_var)
+
+    def interpolationOperator(self, redshiftGrid):
+        """
+        Linear interpolation operator from redshiftGridGP to redshiftGrid,
+        cached for the last redshiftGrid.
+        """
+        if self.interpolator is None or\
+                not np.array_equal(self.interpolator.points, redshiftGrid):
+            self.interpolator = LinearInterpolationOperator(
+                redshiftGrid, self.redshiftGridGP)
+        return self.interpolator
+
     def estimateAlphaEll(self):
         """
         (Deprecated)
@@ -405,18 +770,31 @@ class PhotozGP:
         assert self.kernel.use_interpolators is False
         if x0 is None:
             x0 = [1.0, 1e3]  # V_C, V_L, alpha_C
-        res = minimize(self.updateHyperparamatersAndReturnMarglike, x0,
-                       method='L-BFGS-B',
-                       bounds=[(1e-12, 1e12), (1e2, 1e4)])
+        grad_needed = self.kernel.grad_needed
+        self.kernel.grad_needed = True
+        try:
+            res = minimize(self.updateHyperparamatersAndReturnMarglike, x0,
+                           args=(True, ), jac=True,
+                           method='L-BFGS-B',
+                           bounds=[(1e-12, 1e12), (1e2, 1e4)])
+        finally:
+            self.kernel.grad_needed = grad_needed
         V_C, alpha_C = res.x
         if verbose:
             print("Optimized parameters: ", res.x)
         self.kernel.var_C, self.kernel.var_L = 1*V_C, 1*V_C
         self.kernel.alpha_C, self.kernel.alpha_L = 1*alpha_C, 1*alpha_C
 
-    def updateHyperparamatersAndReturnMarglike(self, pars):
+    def updateHyperparamatersAndReturnMarglike(self, pars, gradients=False):
         """
         For optimizing Hyperparamaters with marglike as objective using scipy.
+        V_C is shared by the continuum and lines (var_C = var_L),
+        as is alpha_C (alpha_C = alpha_L).
+
+        Args:
+            pars: V_C, alpha_C
+            gradients (Optional): also return the gradient of the marglike
+                with respect to pars (needs kernel.grad_needed set to True)
         """
         V_C, alpha_C = pars
         self.kernel.var_C, self.kernel.var_L = 1*V_C, 1*V_C
@@ -435,6 +813,11 @@ class PhotozGP:
             hx = self.mean_fct.f(self.X, which=which).T
             self.D -= np.dot(hx.T, self.betas)[:, None]
         self.beta = scipy.linalg.cho_solve((self.L, True), self.D)
+        if gradients:
+            # Tied parameters: sum the continuum and line gradients.
+            dV_C, dV_L, dalpha_C, dalpha_L = self.margLikeGradients()
+            return self.margLike(), np.array([dV_C + dV_L,
+                                              dalpha_C + dalpha_L])
         return self.margLike()
 
     def optimizeAlpha_GP(self):
@@ -1,20 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import os
+import collections
+import hashlib
+import zipfile
 from copy import copy
 from scipy.special import erf
 import scipy.linalg
 from scipy.interpolate import interp1d, interp2d, RectBivariateSpline
 
 from delight.photoz_kernels_cy import kernelparts, kernelparts_diag,\
-    kernel_parts_interp
-from delight.utils_cy import find_positions
-from delight.utils import approx_DL
+    kernel_parts_interp, kernel_parts_interp_diag,\
+    kernel_parts_interp_batch, kernel_parts_interp_equalz,\
+    kernel_parts_interp_grid, kernelparts_grid
+from delight.utils import approx_DL, TemplateFluxTable, RedshiftBinLocator
 
 import logging
 import coloredlogs
 
-kind = "linear"
+KERNEL_GRID_CACHE_VERSION = 2
 
 logger = logging.getLogger(__name__)
 coloredlogs.install(level='DEBUG', logger=logger,fmt='%(asctime)s,%(msecs)03d %(programname)s, %(name)s[%(process)d] %(levelname)s %(message)s')
@@ -25,8 +30,9 @@ class Photoz_linear_sed_basis():
     Mean function of photoz GP, based on a library of templates.
 
     Args:
-        f_mod_interp: grid of interpolators of size (num templates, num bands)
-            called as ``f_mod_interp[it, ib](z)``
+        f_mod_interp: TemplateFluxTable, or grid of interpolators
+            of size (num templates, num bands) called as
+            ``f_mod_interp[it, ib](z)``
     """
     def __init__(self, f_mod_interp):
         """ Constructor."""
@@ -53,6 +59,10 @@ class Photoz_linear_sed_basis():
         if which is None:
             which = range(self.nt)
         hx = np.zeros((X.shape[0], self.nt))
+        if isinstance(self.f_mod_interp, TemplateFluxTable):
+            which = np.asarray(which, dtype=int)
+            hx[:, which] = self.f_mod_interp.evaluate(z, b, types=which)
+            return l[:, None] * hx
         for it in which:
             for k in range(self.nb):
                 sel = b == k
@@ -124,6 +134,98 @@ class Photoz_mean_function():
         return (fac * self.sum_mf).reshape((-1, 1))
 
 
+class KernelGridCache():
+    """
+    Content-addressed directory of precomputed kernel grids,
+    with one .npz file per set of filter coefficients, lines,
+    hyperparameters and redshift grid.
+    Entries are evicted in least-recently-used order
+    (their modification time is refreshed on every hit)
+    when the total size of the directory exceeds maxSize.
+
+    Args:
+        cacheDir: directory of the cache, created if needed
+        maxSize (Optional): maximum size of the cache in bytes
+            (``float``, default: ``2e9``)
+    """
+    def __init__(self, cacheDir, maxSize=2e9):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def key(self, kernel):
+        """
+        Hash of everything the kernel grids depend on.
+        """
+        h = hashlib.sha256()
+        h.update(str(KERNEL_GRID_CACHE_VERSION).encode())
+        for arr in [kernel.fcoefs_amp, kernel.fcoefs_mu, kernel.fcoefs_sig,
+                    kernel.lines_mu[:kernel.numLines],
+                    kernel.lines_sig[:kernel.numLines],
+                    kernel.redshiftGrid,
+                    [kernel.alpha_C, kernel.alpha_L, kernel.grad_needed]]:
+            arr = np.ascontiguousarray(arr, dtype=float)
+            h.update(str(arr.shape).encode())
+            h.update(arr.tobytes())
+        h.update(kernel.gridDtype.str.encode())
+        return h.hexdigest()
+
+    def fileName(self, key):
+        return os.path.join(self.cacheDir, key + '.npz')
+
+    def load(self, key):
+        """
+        Dictionary of arrays stored under key, or None if absent.
+        """
+        fileName = self.fileName(key)
+        try:
+            with np.load(fileName) as data:
+                arrays = {k: data[k] for k in data.files}
+            os.utime(fileName)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        return arrays
+
+    def save(self, key, arrays):
+        """
+        Store a dictionary of arrays under key, then evict old entries.
+        The file is written under a temporary name and renamed,
+        so that concurrent processes never read partial entries.
+        """
+        fileName = self.fileName(key)
+        tmpName = fileName + '.tmp' + str(os.getpid())
+        with open(tmpName, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmpName, fileName)
+        self.evict(keep=fileName)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in maxSize.
+        """
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith('.npz'):
+                continue
+            fileName = os.path.join(self.cacheDir, name)
+            try:
+                st = os.stat(fileName)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fileName))
+        totalSize = sum([size for mtime, size, fileName in entries])
+        for mtime, size, fileName in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+            if fileName == keep:
+                continue
+            try:
+                os.remove(fileName)
+            except FileNotFoundError:
+                pass
+            totalSize -= size
+
+
 class Photoz_kernel:
     """
     Photoz kernel based on RBF kernel in SED space.
@@ -159,6 +261,24 @@ class Photoz_kernel:
         use_interpolators (Optional): ``boolean`` indicating if the GP
             should be used for all predictions,
             or if an interpolation scheme should be used (default: ``True``)
+        grad_needed (Optional): ``boolean`` indicating if the derivatives
+            of the kernel with respect to alpha_C and alpha_L
+            (the D_alpha_* attributes) should be computed,
+            e.g. for hyperparameter optimization (default: ``False``)
+        gridCache (Optional): ``KernelGridCache`` from which the kernel
+            grids are loaded if present, and to which they are saved
+            otherwise (default: ``None``, no cache)
+        comm (Optional): MPI communicator. If set, the kernel grids are
+            built once per node and shared by the ranks of the node
+            (default: ``None``, private grids)
+        bands (Optional): indices of the bands (rows of fcoefs_*)
+            the kernel is built for. Inputs still use these indices,
+            which are mapped to compact ones with ``compactIndex``
+            (default: ``None``, all bands)
+        gridDtype (Optional): storage type of the kernel grids,
+            ``numpy.float64`` or ``numpy.float32``. Grids are computed
+            and interpolated in double precision either way
+            (default: ``numpy.float64``)
     """
     def __init__(self,
                  fcoefs_amp, fcoefs_mu, fcoefs_sig,
@@ -170,9 +290,21 @@ class Photoz_kernel:
                  g_AB=1.0,
                  DL_z=None,
                  redshiftGrid=None,
-                 use_interpolators=True):
+                 use_interpolators=True,
+                 grad_needed=False,
+                 gridCache=None,
+                 comm=None,
+                 bands=None,
+                 gridDtype=np.float64):
         """ Constructor."""
         self.use_interpolators = use_interpolators
+        self.gridDtype = np.dtype(gridDtype)
+        if self.gridDtype not in [np.float32, np.float64]:
+            raise Exception(str(gridDtype) + ' : invalid kernel grid type')
+        self.grad_needed = grad_needed
+        self.gridCache = gridCache
+        self.comm = comm
+        self.nodeComm, self.sharedWindow = None, None
         if DL_z is None:
             self.DL_z = approx_DL()
         else:
@@ -184,11 +316,19 @@ class Photoz_kernel:
         self.numLines = self.lines_mu.size
         assert fcoefs_amp.shape[0] == fcoefs_mu.shape[0] and\
             fcoefs_amp.shape[0] == fcoefs_sig.shape[0]
-        self.fcoefs_amp = fcoefs_amp
-        self.fcoefs_mu = fcoefs_mu
-        self.fcoefs_sig = fcoefs_sig
+        self.numBandsTotal = fcoefs_amp.shape[0]
+        if bands is None:
+            self.bandIndices = np.arange(self.numBandsTotal)
+        else:
+            self.bandIndices = np.unique(np.asarray(bands, dtype=int))
+        # Compact index of each band, -1 for bands outside the subset.
+        self.compactIndex = np.repeat(-1, self.numBandsTotal)
+        self.compactIndex[self.bandIndices] = np.arange(self.bandIndices.size)
+        self.fcoefs_amp = np.ascontiguousarray(fcoefs_amp[self.bandIndices])
+        self.fcoefs_mu = np.ascontiguousarray(fcoefs_mu[self.bandIndices])
+        self.fcoefs_sig = np.ascontiguousarray(fcoefs_sig[self.bandIndices])
         self.numCoefs = fcoefs_amp.shape[1]
-        self.numBands = fcoefs_amp.shape[0]
+        self.numBands = self.bandIndices.size
         self.norms = np.sqrt(2*np.pi)\
             * np.sum(self.fcoefs_amp * self.fcoefs_sig, axis=1)
         # Initialize parameters and link them.
@@ -212,7 +352,11 @@ class Photoz_kernel:
         # Check bounds. This is ok because band indices should never change
         # unless there are tiny numerical errors withint GPy.
         b[b < 0] = 0
-        b[b >= self.numBands] = self.numBands - 1
+        b[b >= self.numBandsTotal] = self.numBandsTotal - 1
+        b = self.compactIndex[b]
+        if np.any(b < 0):
+            raise Exception('Some bands are not in the band subset'
+                            + ' of the kernel')
         return b
 
     def Kdiag(self, X):
@@ -236,6 +380,86 @@ class Photoz_kernel:
         return self.Zprefac**2 * l1[:, None] * l2[None, :] *\
             (self.var_C * self.KC + self.var_L * self.KL)
 
+    def K_batch(self, X):
+        """
+        Compute the GP auto kernels of many objects at once.
+
+        Args:
+            X: array of size (nobj, B, 3) containing the GP inputs
+                of nobj objects with B inputs each.
+                The column order is band, redshift, and luminosity.
+
+        Returns:
+            array of size (nobj, B, B)
+        """
+        if not self.use_interpolators:
+            return np.array([self.K(x) for x in X]).reshape(
+                (X.shape[0], X.shape[1], X.shape[1]))
+        NG, NB = X.shape[0], X.shape[1]
+        b = self.roundband(X[:, :, 0].ravel()).reshape((NG, NB))
+        fz = 1 + X[:, :, 1]
+        fzgrid = 1 + self.redshiftGrid
+        KC, KL = np.zeros((NG, NB, NB)), np.zeros((NG, NB, NB))
+        if np.all(fz == fz[:, :1]):
+            # one redshift per object: equal-redshift tables
+            fz0 = np.ascontiguousarray(fz[:, 0])
+            ps = self.binLocator(fz0)
+            kernel_parts_interp_equalz(NG, NB, KC, b, fz0, ps, fzgrid,
+                                       self.KC_equalz_grid)
+            if self.numLines > 0:
+                kernel_parts_interp_equalz(NG, NB, KL, b, fz0, ps, fzgrid,
+                                           self.KL_equalz_grid)
+        else:
+            ps = self.binLocator(fz.ravel()).reshape((NG, NB))
+            kernel_parts_interp_batch(NG, NB, KC, b, fz, ps,
+                                      fzgrid, self.KC_grid)
+            if self.numLines > 0:
+                kernel_parts_interp_batch(NG, NB, KL, b, fz, ps,
+                                          fzgrid, self.KL_grid)
+        a = fz / self.DL_z(X[:, :, 1])
+        Zprefac = a[:, :, None] * a[:, None, :] / (self.fourpi * self.g_AB)
+        l1 = X[:, :, 2]
+        return Zprefac**2 * l1[:, :, None] * l1[:, None, :] *\
+            (self.var_C * KC + self.var_L * KL)
+
+    def K_grid(self, X2, ell=1.0):
+        """
+        Compute the GP cross kernel between the redshift grid nodes in all
+        bands, at luminosity ell, and inputs sharing a single redshift,
+        e.g. the data of one object.
+        The grid nodes need no interpolation, so the precomputed grids
+        are only interpolated along the redshift of X2.
+        Requires the interpolators (use_interpolators=True).
+
+        Args:
+            X2: array of size (nobj, 3) containing the GP inputs,
+                with the same redshift.
+                The column order is band, redshift, and luminosity.
+            ell (Optional): luminosity of the grid inputs.
+
+        Returns:
+            array of size (numBands * nz, nobj), with rows ordered by band
+            then redshift node.
+        """
+        assert self.use_interpolators
+        NZ, NO2 = self.redshiftGrid.size, X2.shape[0]
+        b2 = self.roundband(X2[:, 0])
+        fz2 = 1 + X2[0, 1]
+        p2 = self.binLocator(np.array([fz2]))[0]
+        fzgrid = 1 + self.redshiftGrid
+        KC, KL = np.zeros((self.numBands*NZ, NO2)),\
+            np.zeros((self.numBands*NZ, NO2))
+        kernel_parts_interp_grid(self.numBands, NZ, NO2, KC, b2, fz2, p2,
+                                 fzgrid, self.KC_grid)
+        if self.numLines > 0:
+            kernel_parts_interp_grid(self.numBands, NZ, NO2, KL, b2, fz2, p2,
+                                     fzgrid, self.KL_grid)
+        z1 = np.tile(self.redshiftGrid, self.numBands)[:, None]
+        Zprefac = (1+z1) * fz2 /\
+            (self.fourpi * self.g_AB * self.DL_z(z1) * self.DL_z(X2[0, 1]))
+        return Zprefac**2 * ell * X2[None, :, 2] *\
+            (self.var_C * KC + self.var_L * KL)
+
     def update_kernelparts_diag(self, X):
         """
         Update the precomputed parts of the kernel, on the diagonal only.
@@ -254,19 +478,20 @@ class Photoz_kernel:
 
         if self.use_interpolators:
 
-            for i1 in range(self.numBands):
-                ind1 = np.where(b1 == i1)[0]
-                fz1 = 1 + X[ind1, 1]
-                is1 = np.argsort(fz1)
-                if ind1.size > 0:
-                    self.KLd[ind1[is1]] =\
-                        self.KL_diag_interp[i1](fz1[is1])
-                    self.KCd[ind1[is1]] =\
-                        self.KC_diag_interp[i1](fz1[is1])
-                    self.D_alpha_Cd[ind1[is1]] =\
-                        self.D_alpha_C_diag_interp[i1](fz1[is1])
-                    self.D_alpha_Ld[ind1[is1]] =\
-                        self.D_alpha_L_diag_interp[i1](fz1[is1])
+            p1s = self.binLocator(fz1)
+            fzgrid = 1 + self.redshiftGrid
+            kernel_parts_interp_diag(NO1, self.KCd, b1, fz1, p1s,
+                                     fzgrid, self.KC_diag_grid)
+            if self.grad_needed:
+                kernel_parts_interp_diag(NO1, self.D_alpha_Cd, b1, fz1, p1s,
+                                         fzgrid, self.D_alpha_C_diag_grid)
+            if self.numLines > 0:
+                kernel_parts_interp_diag(NO1, self.KLd, b1, fz1, p1s,
+                                         fzgrid, self.KL_diag_grid)
+                if self.grad_needed:
+                    kernel_parts_interp_diag(NO1, self.D_alpha_Ld,
+                                             b1, fz1, p1s, fzgrid,
+                                             self.D_alpha_L_diag_grid)
 
         else:  # not use interpolators
             fz1 = 1 + X[:, 1]
@@ -277,7 +502,7 @@ class Photoz_kernel:
                              self.lines_mu[:self.numLines],
                              self.lines_sig[:self.numLines],
                              self.norms, b1, fz1,
-                             True, self.KLd, self.KCd,
+                             self.grad_needed, self.KLd, self.KCd,
                              self.D_alpha_Cd, self.D_alpha_Ld)
 
     def update_kernelparts(self, X, X2=None):
@@ -285,9 +510,15 @@ class Photoz_kernel:
         Update the precomputed parts of the kernel.
         X is an array of size (nobj, 3) containing the GP inputs.
         The column order is band, redshift, and luminosity.
+        Auto kernels of inputs sharing one redshift (e.g. the data of
+        one object) are interpolated in the equal-redshift tables.
+        The kernel is an auto kernel if X2 is None or equal to X
+        (by value, not only by identity).
         """
         if X2 is None:
             X2 = X
+        equalz = X2 is X or (X2.shape == X.shape and np.array_equal(X2, X))
+        equalz = equalz and np.all(X[:, 1] == X[0, 1])
         NO1, NO2 = X.shape[0], X2.shape[0]
         b1 = self.roundband(X[:, 0])
         b2 = self.roundband(X2[:, 0])
@@ -300,23 +531,37 @@ class Photoz_kernel:
             np.zeros((NO1, NO2)), np.zeros((NO1, NO2)),\
             np.zeros((NO1, NO2))
 
-        if self.use_interpolators:
+        if self.use_interpolators and equalz:
+
+            ps = self.binLocator(fz1[:1])
+            parts = [(self.KC, self.KC_equalz_grid)]
+            if self.grad_needed:
+                parts += [(self.D_alpha_C, self.D_alpha_C_equalz_grid)]
+            if self.numLines > 0:
+                parts += [(self.KL, self.KL_equalz_grid)]
+                if self.grad_needed:
+                    parts += [(self.D_alpha_L, self.D_alpha_L_equalz_grid)]
+            for out, table in parts:
+                kernel_parts_interp_equalz(1, NO1, out[None, :, :],
+                                           b1[None, :], fz1[:1], ps,
+                                           fzgrid, table)
+
+        elif self.use_interpolators:
 
-            p1s = np.zeros(NO1, dtype=int)
-            p2s = np.zeros(NO2, dtype=int)
-            find_positions(NO1, self.nz, fz1, p1s, fzgrid)
-            find_positions(NO2, self.nz, fz2, p2s, fzgrid)
+            p1s = self.binLocator(fz1)
+            p2s = self.binLocator(fz2)
 
             kernel_parts_interp(NO1, NO2,
                                 self.KC,
                                 b1, fz1, p1s,
                                 b2, fz2, p2s,
                                 fzgrid, self.KC_grid)
-            kernel_parts_interp(NO1, NO2,
-                                self.D_alpha_C,
-                                b1, fz1, p1s,
-                                b2, fz2, p2s,
-                                fzgrid, self.D_alpha_C_grid)
+            if self.grad_needed:
+                kernel_parts_interp(NO1, NO2,
+                                    self.D_alpha_C,
+                                    b1, fz1, p1s,
+                                    b2, fz2, p2s,
+                                    fzgrid, self.D_alpha_C_grid)
 
             if self.numLines > 0:
                 kernel_parts_interp(NO1, NO2,
@@ -324,11 +569,12 @@ class Photoz_kernel:
                                     b1, fz1, p1s,
                                     b2, fz2, p2s,
                                     fzgrid, self.KL_grid)
-                kernel_parts_interp(NO1, NO2,
-                                    self.D_alpha_L,
-                                    b1, fz1, p1s,
-                                    b2, fz2, p2s,
-                                    fzgrid, self.D_alpha_L_grid)
+                if self.grad_needed:
+                    kernel_parts_interp(NO1, NO2,
+                                        self.D_alpha_L,
+                                        b1, fz1, p1s,
+                                        b2, fz2, p2s,
+                                        fzgrid, self.D_alpha_L_grid)
 
         else:  # not use interpolators
 
@@ -338,7 +584,7 @@ class Photoz_kernel:
                         self.lines_mu[:self.numLines],
                         self.lines_sig[:self.numLines],
                         self.norms, b1, fz1, b2, fz2,
-                        True, self.KL, self.KC,
+                        self.grad_needed, self.KL, self.KC,
                         self.D_alpha_C, self.D_alpha_L, self.D_alpha_z)
 
         self.Zprefac = (1+X[:, 1:2]) * (1+X2[None, :, 1]) /\
@@ -350,76 +596,176 @@ class Photoz_kernel:
         Construct interpolation scheme for the kernel.
         This significantly speeds up calculations by computing and storing
         the kernel evaluated on a grid, for later interpolation.
+        The grids are taken from the grid cache if there is one.
+        If the kernel has a communicator, this is a collective call:
+        the grids are built once per node in shared memory (see
+        shared_grids).
         """
-        bands = np.arange(self.numBands).astype(int)
         fzgrid = 1 + self.redshiftGrid
-        ts = (self.numBands, self.numBands, self.nz, self.nz)
-        self.KC_grid, self.KL_grid = np.zeros(ts), np.zeros(ts)
-        self.D_alpha_C_grid, self.D_alpha_L_grid, self.D_alpha_z_grid\
-            = np.zeros(ts), np.zeros(ts), np.zeros(ts)
-        for b1 in range(self.numBands):
-            for b2 in range(self.numBands):
-                b1_grid = np.repeat(b1, self.nz).astype(int)
-                b2_grid = np.repeat(b2, self.nz).astype(int)
-                kernelparts(self.nz, self.nz, self.numCoefs, self.numLines,
-                            self.alpha_C, self.alpha_L,
-                            self.fcoefs_amp, self.fcoefs_mu, self.fcoefs_sig,
-                            self.lines_mu[:self.numLines],
-                            self.lines_sig[:self.numLines],
-                            self.norms,
-                            b1_grid, fzgrid, b2_grid, fzgrid,
-                            True,
-                            self.KL_grid[b1, b2, :, :],
-                            self.KC_grid[b1, b2, :, :],
-                            self.D_alpha_C_grid[b1, b2, :, :],
-                            self.D_alpha_L_grid[b1, b2, :, :],
-                            self.D_alpha_z_grid[b1, b2, :, :])
-
-        bands = np.arange(self.numBands).astype(int)
+        self.binLocator = RedshiftBinLocator(fzgrid, offset=1.0)
+        if self.comm is not None:
+            grids = self.shared_grids()
+        else:
+            grids = self.load_or_compute_grids()
+
+        self.KC_grid, self.KL_grid = grids['KC_grid'], grids['KL_grid']
+        self.D_alpha_C_grid = grids.get('D_alpha_C_grid')
+        self.D_alpha_L_grid = grids.get('D_alpha_L_grid')
+        self.KC_diag_grid = grids['KC_diag_grid']
+        self.KL_diag_grid = grids['KL_diag_grid']
+        self.D_alpha_C_diag_grid = grids.get('D_alpha_C_diag_grid')
+        self.D_alpha_L_diag_grid = grids.get('D_alpha_L_diag_grid')
+        self.KC_equalz_grid = grids['KC_equalz_grid']
+        self.KL_equalz_grid = grids['KL_equalz_grid']
+        self.D_alpha_C_equalz_grid = grids.get('D_alpha_C_equalz_grid')
+        self.D_alpha_L_equalz_grid = grids.get('D_alpha_L_equalz_grid')
+
+    def grid_shapes(self):
+        """
+        Names, shapes and types of the kernel grids,
+        as an ordered dictionary of (shape, dtype) pairs.
+        """
+        names = ['KC', 'KL']
+        if self.grad_needed:
+            names += ['D_alpha_C', 'D_alpha_L']
+        shapes = collections.OrderedDict()
+        for name in names:
+            shapes[name + '_grid'] =\
+                ((self.numBands, self.numBands, self.nz, self.nz),
+                 self.gridDtype)
+        for name in names:
+            shapes[name + '_diag_grid'] =\
+                ((self.numBands, self.nz), np.dtype(float))
+        for name in names:
+            shapes[name + '_equalz_grid'] =\
+                ((self.numBands, self.numBands, self.nz), np.dtype(float))
+        return shapes
+
+    def load_or_compute_grids(self, grids=None):
+        """
+        Kernel grids from the grid cache if present,
+        computed (and saved to the cache) otherwise.
+
+        Args:
+            grids (Optional): dictionary of zeroed arrays
+                (see grid_shapes) to write the grids into.
+        """
+        key = None
+        if self.gridCache is not None:
+            key = self.gridCache.key(self)
+            cached = self.gridCache.load(key)
+            if cached is not None:
+                if grids is None:
+                    return cached
+                for name in grids:
+                    grids[name][...] = cached[name]
+                return grids
+        grids = self.compute_grids(grids)
+        if key is not None:
+            self.gridCache.save(key, grids)
+        return grids
+
+    def shared_grids(self):
+        """
+        Kernel grids shared by the ranks of self.comm on the same node.
+        They are allocated in an MPI shared-memory window by the first rank
+        of the node, which loads or computes them, and the other ranks
+        attach read-only views.
+        """
+        from mpi4py import MPI
+        if self.nodeComm is None:
+            self.nodeComm = self.comm.Split_type(MPI.COMM_TYPE_SHARED)
+        if self.sharedWindow is not None:
+            self.sharedWindow.Free()
+            self.sharedWindow = None
+        shapes = self.grid_shapes()
+        # Byte offsets of the grids, aligned on 8 bytes.
+        offsets, nbytes = [], 0
+        for shape, dtype in shapes.values():
+            offsets.append(nbytes)
+            nbytes += int(np.prod(shape)) * dtype.itemsize
+            nbytes += -nbytes % 8
+        isRoot = self.nodeComm.Get_rank() == 0
+        win = MPI.Win.Allocate_shared(nbytes if isRoot else 0, 1,
+                                      comm=self.nodeComm)
+        buf, itemsize = win.Shared_query(0)
+        grids = {}
+        for (name, (shape, dtype)), offset in zip(shapes.items(), offsets):
+            grids[name] = np.ndarray(buffer=buf, dtype=dtype, shape=shape,
+                                     offset=offset)
+        if isRoot:
+            for grid in grids.values():
+                grid[...] = 0
+            self.load_or_compute_grids(grids)
+        self.nodeComm.Barrier()
+        if not isRoot:
+            for grid in grids.values():
+                grid.flags.writeable = False
+        self.sharedWindow = win
+        return grids
+
+    def compute_grids(self, grids=None):
+        """
+        Compute the kernel parts on the redshift grid, for all band pairs,
+        and on the diagonal for each band.
+        Returns a dictionary of arrays of size
+        (numBands, numBands, nz, nz) and (numBands, nz) respectively,
+        and of the parts at equal redshifts, of size (numBands, numBands, nz).
+
+        Args:
+            grids (Optional): dictionary of zeroed arrays
+                (see grid_shapes) to write the grids into.
+        """
+        shapes = self.grid_shapes()
+        if grids is None:
+            grids = {name: np.zeros(shape, dtype=dtype)
+                     for name, (shape, dtype) in shapes.items()}
         fzgrid = 1 + self.redshiftGrid
-        self.KL_diag_interp = np.empty(self.numBands, dtype=interp1d)
-        self.KC_diag_interp = np.empty(self.numBands, dtype=interp1d)
-        self.D_alpha_C_diag_interp = np.empty(self.numBands, dtype=interp1d)
-        self.D_alpha_L_diag_interp = np.empty(self.numBands, dtype=interp1d)
-        for b1 in range(self.numBands):
-            ts = (self.nz, )
-            KC_grid, KL_grid = np.zeros(ts), np.zeros(ts)
-            D_alpha_C_grid, D_alpha_L_grid, D_alpha_z_grid\
-                = np.zeros(ts), np.zeros(ts), np.zeros(ts)
-            b1_grid = np.repeat(b1, self.nz).astype(int)
-            kernelparts_diag(self.nz, self.numCoefs, self.numLines,
-                             self.alpha_C, self.alpha_L,
-                             self.fcoefs_amp, self.fcoefs_mu,
-                             self.fcoefs_sig,
-                             self.lines_mu[:self.numLines],
-                             self.lines_sig[:self.numLines],
-                             self.norms,
-                             b1_grid, fzgrid,
-                             True,
-                             KL_grid,
-                             KC_grid,
-                             D_alpha_C_grid,
-                             D_alpha_L_grid)
-            self.KL_diag_interp[b1] = interp1d(fzgrid, KL_grid,
-                                               kind=kind,
-                                               assume_sorted=True,
-                                               bounds_error=False,
-                                               fill_value="extrapolate")
-            self.KC_diag_interp[b1] = interp1d(fzgrid, KC_grid,
-                                               kind=kind,
-                                               assume_sorted=True,
-                                               bounds_error=False,
-                                               fill_value="extrapolate")
-            self.D_alpha_C_diag_interp[b1] = interp1d(fzgrid, D_alpha_C_grid,
-                                                      kind=kind,
-                                                      assume_sorted=True,
-                                                      bounds_error=False,
-                                                      fill_value="extrapolate")
-            self.D_alpha_L_diag_interp[b1] = interp1d(fzgrid, D_alpha_L_grid,
-                                                      kind=kind,
-                                                      assume_sorted=True,
-                                                      bounds_error=False,
-                                                      fill_value="extrapolate")
+        # The grids are written in their own precision,
+        # and the tables at equal redshifts in double precision.
+        names = ['KL_grid', 'KC_grid', 'D_alpha_C_grid', 'D_alpha_L_grid']
+        outputs, equalz_outputs = [], []
+        for name in names:
+            equalz_name = name.replace('_grid', '_equalz_grid')
+            if name in grids:
+                outputs.append(grids[name])
+                equalz_outputs.append(grids[equalz_name])
+            else:
+                # Placeholders, not touched by kernelparts_grid.
+                outputs.append(np.zeros((0, 0, 0, 0), dtype=self.gridDtype))
+                equalz_outputs.append(np.zeros((0, 0, 0)))
+        kernelparts_grid(self.numBands, self.nz,
+                         self.numCoefs, self.numLines,
+                         self.alpha_C, self.alpha_L,
+                         self.fcoefs_amp, self.fcoefs_mu, self.fcoefs_sig,
+                         self.lines_mu[:self.numLines],
+                         self.lines_sig[:self.numLines],
+                         self.norms, fzgrid,
+                         self.grad_needed,
+                         *outputs, *equalz_outputs)
+
+        # All bands at once: entries are computed independently.
+        b1_grid = np.repeat(np.arange(self.numBands), self.nz).astype(int)
+        fz1_grid = np.tile(fzgrid, self.numBands)
+        ts = (self.numBands * self.nz, )
+        diags = [np.zeros(ts) for i in range(4)]
+        kernelparts_diag(b1_grid.size, self.numCoefs, self.numLines,
+                         self.alpha_C, self.alpha_L,
+                         self.fcoefs_amp, self.fcoefs_mu,
+                         self.fcoefs_sig,
+                         self.lines_mu[:self.numLines],
+                         self.lines_sig[:self.numLines],
+                         self.norms,
+                         b1_grid, fz1_grid,
+                         self.grad_needed,
+                         *diags)
+        names = ['KL', 'KC']
+        if self.grad_needed:
+            names += ['D_alpha_C', 'D_alpha_L']
+        for name, diag in zip(names, diags):
+            grids[name + '_diag_grid'][...] =\
+                diag.reshape((self.numBands, self.nz))
+        return grids
 
 
 class Photoz_SN_kernel(Photoz_kernel):
@@ -459,6 +805,17 @@ class Photoz_SN_kernel(Photoz_kernel):
         use_interpolators (Optional): ``boolean`` indicating if the GP
             should be used for all predictions,
             or if an interpolation scheme should be used (default: ``True``)
+        grad_needed (Optional): ``boolean`` indicating if the derivatives
+            of the kernel with respect to alpha_C and alpha_L
+            should be computed (default: ``False``)
+        gridCache (Optional): ``KernelGridCache`` for the kernel grids
+            (default: ``None``, no cache)
+        comm (Optional): MPI communicator for sharing the kernel grids
+            between the ranks of a node (default: ``None``)
+        bands (Optional): indices of the bands the kernel is built for
+            (default: ``None``, all bands)
+        gridDtype (Optional): storage type of the kernel grids
+            (default: ``numpy.float64``)
     """
     def __init__(self,
                  fcoefs_amp, fcoefs_mu, fcoefs_sig,
@@ -471,14 +828,20 @@ class Photoz_SN_kernel(Photoz_kernel):
                  g_AB=1.0,
                  DL_z=None,
                  redshiftGrid=None,
-                 use_interpolators=True):
+                 use_interpolators=True,
+                 grad_needed=False,
+                 gridCache=None,
+                 comm=None,
+                 bands=None,
+                 gridDtype=np.float64):
         """ Constructor."""
         self.alpha_T = alpha_T
         super().__init__(
             fcoefs_amp, fcoefs_mu, fcoefs_sig,
             lines_mu, lines_sig, var_C, var_L,
             alpha_C, alpha_L, g_AB, DL_z,
-            redshiftGrid, use_interpolators)
+            redshiftGrid, use_interpolators, grad_needed, gridCache, comm,
+            bands, gridDtype)
 
     def Kdiag(self, X):
         """
@@ -492,7 +855,57 @@ class Photoz_SN_kernel(Photoz_kernel):
         """
         if X2 is None:
             X2 = X
-        t1 = X[:, 3]
-        t2 = X2[:, 3]
-        kt = np.exp(-(X[:, None, 3] - X2[None, :, 3])**2/self.alpha_T)
-        return kt * super().K(X[:, 0:3], X2[:, 0:3])
+        KP, iP1, iP2 = self.K_photometric(X, X2)
+        kt = self.K_time(X[:, 3], X2[:, 3])
+        return kt * KP[iP1, :][:, iP2]
+
+    def K_photometric(self, X, X2=None):
+        """
+        Photometric (band, redshift, luminosity) factor of the kernel,
+        computed once per distinct photometric input:
+        the kernel is ``K_time * KP[iP1, :][:, iP2]``.
+        Light curves have many epochs for few distinct photometric inputs.
+
+        Args:
+            X, X2: arrays of size (nobj, 4) containing the GP inputs.
+                The column order is band, redshift, luminosity and time.
+
+        Returns:
+            KP: photometric kernel between the distinct inputs
+                of X and X2 (sorted as by ``numpy.unique``)
+            iP1, iP2: index of the distinct input of each row of X and X2
+        """
+        P1, iP1 = np.unique(X[:, 0:3], axis=0, return_inverse=True)
+        if X2 is None:
+            P2, iP2 = P1, iP1
+        else:
+            P2, iP2 = np.unique(X2[:, 0:3], axis=0, return_inverse=True)
+        KP = super().K(P1, P2)
+        return KP, iP1.ravel(), iP2.ravel()
+
+    def K_photometric_batch(self, P):
+        """
+        Photometric factors of the kernel for many sets of distinct
+        photometric inputs (e.g. of light curves), computed at once
+        with the interpolators (see K_batch).
+
+        Args:
+            P: array of size (nobj, nP, 3) containing nobj sets of nP
+                photometric inputs.
+                The column order is band, redshift, and luminosity.
+
+        Returns:
+            array of size (nobj, nP, nP)
+        """
+        if self.use_interpolators:
+            return self.K_batch(P)
+        return np.array([Photoz_kernel.K(self, p) for p in P]).reshape(
+            (P.shape[0], P.shape[1], P.shape[1]))
+
+    def K_time(self, t1, t2=None):
+        """
+        Time factor of the kernel, ``exp(-(t1-t2)**2/alpha_T)``.
+        """
+        if t2 is None:
+            t2 = t1
+        return np.exp(-(t1[:, None] - t2[None, :])**2/self.alpha_T)
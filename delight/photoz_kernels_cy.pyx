@@ -1,9 +1,16 @@
 #cython: boundscheck=False, wraparound=False, nonecheck=False, cdivision=True
+import numpy as np
 cimport numpy as np
-from cython.parallel import prange
+from cython.parallel import prange, parallel
 from cpython cimport bool
 cimport cython
 from libc.math cimport sqrt, M_PI, exp, pow
+from libc.stdlib cimport malloc, free
+
+# Storage types of the kernel grids, interpolated in double precision.
+ctypedef fused grid_t:
+    float
+    double
 
 
 def kernel_parts_interp(
@@ -16,7 +23,7 @@ def kernel_parts_interp(
             double[:] fz2,
             long[:] p2s,
             double[:] fzGrid,
-            double[:,:,:,:] Kgrid):
+            const grid_t[:,:,:,:] Kgrid):
 
     cdef int p1, p2, o1, o2
     cdef double dzm2, opz1, opz2
@@ -35,6 +42,183 @@ def kernel_parts_interp(
                 )
 
 
+def kernel_parts_interp_batch(
+            int NG, int NB,
+            double[:,:,:] Kinterp,
+            long[:,:] b,
+            double[:,:] fz,
+            long[:,:] ps,
+            double[:] fzGrid,
+            const grid_t[:,:,:,:] Kgrid):
+    # Auto kernel parts of NG objects of NB inputs each,
+    # interpolated as in kernel_parts_interp.
+
+    cdef int g, p1, p2, o1, o2
+    cdef double dzm2, opz1, opz2
+    for g in prange(NG, nogil=True):
+        for o1 in range(NB):
+            opz1 = fz[g, o1]
+            p1 = ps[g, o1]
+            for o2 in range(NB):
+                opz2 = fz[g, o2]
+                p2 = ps[g, o2]
+                dzm2 = 1. / (fzGrid[p1+1] - fzGrid[p1]) / (fzGrid[p2+1] - fzGrid[p2])
+                Kinterp[g, o1, o2] = dzm2 * (
+                    (fzGrid[p1+1] - opz1) * (fzGrid[p2+1] - opz2) * Kgrid[b[g, o1], b[g, o2], p1, p2]
+                    + (opz1 - fzGrid[p1]) * (fzGrid[p2+1] - opz2) * Kgrid[b[g, o1], b[g, o2], p1+1, p2]
+                    + (fzGrid[p1+1] - opz1) * (opz2 - fzGrid[p2]) * Kgrid[b[g, o1], b[g, o2], p1, p2+1]
+                    + (opz1 - fzGrid[p1]) * (opz2 - fzGrid[p2]) * Kgrid[b[g, o1], b[g, o2], p1+1, p2+1]
+                    )
+
+
+def kernel_parts_interp_equalz(
+            int NG, int NB,
+            double[:,:,:] Kinterp,
+            long[:,:] b,
+            double[:] fz,
+            long[:] ps,
+            double[:] fzGrid,
+            const double[:,:,:] Kgrid):
+    # Auto kernel parts of NG objects of NB inputs sharing the redshift
+    # fz[g] - 1, in bin ps[g], interpolated linearly in the tables
+    # of the kernel parts at equal redshifts (b1, b2, z).
+
+    cdef int g, p, o1, o2
+    cdef double w
+    for g in prange(NG, nogil=True):
+        p = ps[g]
+        w = (fz[g] - fzGrid[p]) / (fzGrid[p+1] - fzGrid[p])
+        for o1 in range(NB):
+            for o2 in range(NB):
+                Kinterp[g, o1, o2] = (1 - w) * Kgrid[b[g, o1], b[g, o2], p]\
+                    + w * Kgrid[b[g, o1], b[g, o2], p+1]
+
+
+def kernel_parts_interp_grid(
+            int NB1, int NZ, int NO2,
+            double[:,:] Kinterp,
+            long[:] b2,
+            double fz2,
+            int p2,
+            double[:] fzGrid,
+            const grid_t[:,:,:,:] Kgrid):
+    # Cross kernel parts between the grid nodes of the bands 0..NB1-1
+    # (row b1*NZ+k for node k of band b1) and NO2 inputs sharing
+    # the redshift fz2 - 1, in bin p2: the first inputs are on the nodes,
+    # so the grid is only interpolated along the second axis.
+
+    cdef int r, b1, k, o2
+    cdef double w1, w2
+    w1 = (fzGrid[p2+1] - fz2) / (fzGrid[p2+1] - fzGrid[p2])
+    w2 = (fz2 - fzGrid[p2]) / (fzGrid[p2+1] - fzGrid[p2])
+    for r in prange(NB1 * NZ, nogil=True):
+        b1 = r // NZ
+        k = r % NZ
+        for o2 in range(NO2):
+            Kinterp[r, o2] = w1 * Kgrid[b1, b2[o2], k, p2]\
+                + w2 * Kgrid[b1, b2[o2], k, p2+1]
+
+
+def kernel_parts_interp_diag(
+            int NO1,
+            double[:] Kinterp,
+            long[:] b1,
+            double[:] fz1,
+            long[:] p1s,
+            double[:] fzGrid,
+            const double[:,:] Kgrid):
+    # Linear interpolation of the (band, redshift) table of a diagonal
+    # kernel part, with the bins of kernel_parts_interp
+    # (extrapolating linearly outside of the grid).
+
+    cdef int p1, o1
+    cdef double opz1
+    for o1 in prange(NO1, nogil=True):
+        opz1 = fz1[o1]
+        p1 = p1s[o1]
+        Kinterp[o1] = (
+            (fzGrid[p1+1] - opz1) * Kgrid[b1[o1], p1]
+            + (opz1 - fzGrid[p1]) * Kgrid[b1[o1], p1+1]
+            ) / (fzGrid[p1+1] - fzGrid[p1])
+
+
+def line_kernel_matrices(
+        int NL, double alpha_L,
+        double[:] lines_mu,
+        bool grad_needed,
+        double[:,:] M,
+        double[:,:] D_alpha_M
+    ):
+    # Line-line part of the line kernel, which only depends on alpha_L.
+    # Pairs of lines are weighted 2 for l2 < l1, 1 for l2 = l1
+    # and 0 for l2 > l1, as in the original double sum.
+    cdef int l1, l2
+    cdef double dmul2
+    for l1 in range(NL):
+        for l2 in range(NL):
+            M[l1, l2] = 0
+            if grad_needed is True:
+                D_alpha_M[l1, l2] = 0
+        for l2 in range(l1 + 1):
+            dmul2 = pow(lines_mu[l1] - lines_mu[l2], 2)
+            M[l1, l2] = exp(-0.5*dmul2/pow(alpha_L,2))
+            if l2 < l1:
+                M[l1, l2] *= 2
+            if grad_needed is True:
+                D_alpha_M[l1, l2] = M[l1, l2] * dmul2 / pow(alpha_L,3)
+
+
+def line_factors(
+        int NO, int NC, int NL,
+        double[:,:] fcoefs_amp,
+        double[:,:] fcoefs_mu,
+        double[:,:] fcoefs_sig,
+        double[:] lines_mu,
+        long[:] b,
+        double[:] fz,
+        double[:,:] F
+    ):
+    # Band-line part of the line kernel, for each input:
+    # F[o, l] = sum_i amp_i exp(-0.5 ((mu_i - (1+z) mu_l) / sig_i)^2).
+    # The line kernel of a pair of inputs is then F[o1] . M . F[o2].
+    cdef int o, l, i
+    cdef double opz, mul
+    for o in prange(NO, nogil=True):
+        opz = fz[o]
+        for l in range(NL):
+            mul = lines_mu[l]
+            F[o, l] = 0
+            for i in range(NC):
+                F[o, l] += fcoefs_amp[b[o],i] * exp(-0.5*pow((fcoefs_mu[b[o],i] - opz*mul)/fcoefs_sig[b[o],i],2))
+
+
+cdef void line_contract(
+        int NL,
+        double[:,:] F1, long o1,
+        double[:,:] F2, long o2,
+        double[:,:] M,
+        double[:,:] D_alpha_M,
+        bint grad_needed,
+        double* out
+    ) noexcept nogil:
+    # Unnormalized KL and D_alpha_L of one pair of inputs from their line
+    # factors, in O(NL^2) (M is lower triangular).
+    cdef int l1, l2
+    cdef double t, dt
+    out[0] = 0
+    out[3] = 0
+    for l1 in range(NL):
+        t = 0
+        dt = 0
+        for l2 in range(l1 + 1):
+            t = t + M[l1, l2] * F2[o2, l2]
+            if grad_needed:
+                dt = dt + D_alpha_M[l1, l2] * F2[o2, l2]
+        out[0] += F1[o1, l1] * t
+        if grad_needed:
+            out[3] += F1[o1, l1] * dt
+
+
 def kernelparts_diag(
         int NO1, int NC, int NL,
         double alpha_C, double alpha_L,
@@ -54,50 +238,51 @@ def kernelparts_diag(
     ):
 
     cdef double sqrt2pi = sqrt(2 * M_PI)
-    cdef int l1, l2, o1, i, j
-    cdef double theexp, opz1, opz2, mu1, mu2, sig1, sig2, amp1, amp2, sigma, mul1, mul2
+    cdef int o1, i, j
+    cdef double theexp, opz1, opz2, mu1, mu2, sig1, sig2, amp1, amp2, sigma
+    cdef bint grad = grad_needed is True
+    cdef double[:,:] F1 = np.zeros((NO1, NL))
+    cdef double[:,:] M = np.zeros((NL, NL))
+    cdef double[:,:] D_alpha_M = np.zeros((NL, NL))
+    cdef double* out
 
-    for o1 in prange(NO1, nogil=True):
-        KC[o1] = 0
-        KL[o1] = 0
-        opz1 = fz1[o1]
-        opz2 = fz1[o1]
-        for i in range(NC):
-            mu1 = fcoefs_mu[b1[o1],i]
-            amp1 = fcoefs_amp[b1[o1],i]
-            sig1 = fcoefs_sig[b1[o1],i]
-            for j in range(NC):
-                mu2 = fcoefs_mu[b1[o1],j]
-                amp2 = fcoefs_amp[b1[o1],j]
-                sig2 = fcoefs_sig[b1[o1],j]
-                sigma = sqrt( pow(opz1*sig2,2) + pow(opz2*sig1,2) + pow(opz1*opz2*alpha_C,2) )
-                theexp = amp1 * amp2 * 2 * M_PI * sig1 * sig2 * exp(-0.5*pow((opz1*mu2 - opz2*mu1)/sigma,2)) / sigma
-                KC[o1] += alpha_C * theexp
-                if grad_needed is True:
-                    D_alpha_C[o1] += theexp * (1 - pow(alpha_C*opz1*opz2/sigma,2) + pow(alpha_C*(opz1*mu2 - opz2*mu1)*opz1*opz2,2) /pow(sigma,4)  )
-
-                if NL > 0:
-                    for l1 in range(NL):
-                        mul1 = lines_mu[l1]
-                        for l2 in range(l1):
-                            mul2 = lines_mu[l2]
-                            KL[o1] += 2 * amp1 * amp2 * exp(-0.5*(pow((mu1 - opz1*mul1)/sig1,2) + pow((mu2 - opz2*mul2)/sig2,2) + pow((mul1-mul2)/alpha_L,2)))
-                            if grad_needed is True:
-                                D_alpha_L[o1] += 2 * amp1 * amp2 * exp(-0.5*(pow((mu1 - opz1*mul1)/sig1,2) + pow((mu2 - opz2*mul2)/sig2,2) + pow((mul1-mul2)/alpha_L,2))) * pow(mul1-mul2,2) / pow(alpha_L,3)
-
-                        # Last term needed once
-                        l2 = l1
-                        mul2 = lines_mu[l2]
-                        KL[o1] += amp1 * amp2 * exp(-0.5*(pow((mu1 - opz1*mul1)/sig1,2) + pow((mu2 - opz2*mul2)/sig2,2) + pow((mul1-mul2)/alpha_L,2)))
-                        if grad_needed is True:
-                            D_alpha_L[o1] += amp1 * amp2 * exp(-0.5*(pow((mu1 - opz1*mul1)/sig1,2) + pow((mu2 - opz2*mul2)/sig2,2) + pow((mul1-mul2)/alpha_L,2))) * pow(mul1-mul2,2) / pow(alpha_L,3)
-
-        KC[o1] /= norms[b1[o1]] * norms[b1[o1]]
-        KL[o1] /= norms[b1[o1]] * norms[b1[o1]]
-
-        if grad_needed is True:
-            D_alpha_C[o1] /= norms[b1[o1]] * norms[b1[o1]]
-            D_alpha_L[o1] /= norms[b1[o1]] * norms[b1[o1]]
+    line_kernel_matrices(NL, alpha_L, lines_mu, grad_needed, M, D_alpha_M)
+    line_factors(NO1, NC, NL, fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                 lines_mu, b1, fz1, F1)
+
+    with nogil, parallel():
+        out = <double*> malloc(4 * sizeof(double))
+        for o1 in prange(NO1):
+            KC[o1] = 0
+            KL[o1] = 0
+            opz1 = fz1[o1]
+            opz2 = fz1[o1]
+            for i in range(NC):
+                mu1 = fcoefs_mu[b1[o1],i]
+                amp1 = fcoefs_amp[b1[o1],i]
+                sig1 = fcoefs_sig[b1[o1],i]
+                for j in range(NC):
+                    mu2 = fcoefs_mu[b1[o1],j]
+                    amp2 = fcoefs_amp[b1[o1],j]
+                    sig2 = fcoefs_sig[b1[o1],j]
+                    sigma = sqrt( pow(opz1*sig2,2) + pow(opz2*sig1,2) + pow(opz1*opz2*alpha_C,2) )
+                    theexp = amp1 * amp2 * 2 * M_PI * sig1 * sig2 * exp(-0.5*pow((opz1*mu2 - opz2*mu1)/sigma,2)) / sigma
+                    KC[o1] += alpha_C * theexp
+                    if grad:
+                        D_alpha_C[o1] += theexp * (1 - pow(alpha_C*opz1*opz2/sigma,2) + pow(alpha_C*(opz1*mu2 - opz2*mu1)*opz1*opz2,2) /pow(sigma,4)  )
+
+            line_contract(NL, F1, o1, F1, o1, M, D_alpha_M, grad, out)
+            KL[o1] += out[0]
+            if grad:
+                D_alpha_L[o1] += out[3]
+
+            KC[o1] /= norms[b1[o1]] * norms[b1[o1]]
+            KL[o1] /= norms[b1[o1]] * norms[b1[o1]]
+
+            if grad:
+                D_alpha_C[o1] /= norms[b1[o1]] * norms[b1[o1]]
+                D_alpha_L[o1] /= norms[b1[o1]] * norms[b1[o1]]
+        free(out)
 
 
 def kernelparts(
@@ -122,56 +307,239 @@ def kernelparts(
     ):
 
     cdef double sqrt2pi = sqrt(2 * M_PI)
-    cdef int l1, l2, o1, o2, i, j
-    cdef double theexp, opz1, opz2, mu1, mu2, amp1, amp2, sig1, sig2, sigma, mul1, mul2
-    #, sigl1, sigl2
+    cdef int o1, o2, i, j
+    cdef double theexp, opz1, opz2, mu1, mu2, amp1, amp2, sig1, sig2, sigma
+    cdef bint grad = grad_needed is True
+    cdef double[:,:] F1 = np.zeros((NO1, NL))
+    cdef double[:,:] F2 = np.zeros((NO2, NL))
+    cdef double[:,:] M = np.zeros((NL, NL))
+    cdef double[:,:] D_alpha_M = np.zeros((NL, NL))
+    cdef double* out
 
-    for o1 in prange(NO1, nogil=True):
-        for o2 in range(NO2):
-            opz1 = fz1[o1]
-            opz2 = fz2[o2]
-            #KC[o1,o2] = 0
-            #KL[o1,o2] = 0
-            #if grad_needed is True:
-            #    D_alpha_L[o1,o2] = 0
-            #    D_alpha_C[o1,o2] = 0
-            #    D_alpha_z[o1,o2] = 0
-            for i in range(NC):
-                mu1 = fcoefs_mu[b1[o1],i]
-                amp1 = fcoefs_amp[b1[o1],i]
-                sig1 = fcoefs_sig[b1[o1],i]
-                for j in range(NC):
-                    mu2 = fcoefs_mu[b2[o2],j]
-                    amp2 = fcoefs_amp[b2[o2],j]
-                    sig2 = fcoefs_sig[b2[o2],j]
-                    sigma = sqrt( pow(opz1*sig2,2) + pow(opz2*sig1,2) + pow(opz1*opz2*alpha_C,2) )
-                    theexp = amp1 * amp2 * 2 * M_PI * sig1 * sig2 * exp(-0.5*pow((opz1*mu2 - opz2*mu1)/sigma,2)) / sigma
-                    KC[o1,o2] += alpha_C * theexp
-                    if grad_needed is True:
-                        D_alpha_C[o1,o2] += theexp * (1 - pow(alpha_C*opz1*opz2/sigma,2)  + pow(alpha_C*(opz1*mu2 - opz2*mu1)*opz1*opz2,2) /pow(sigma,4)  )
-                        D_alpha_z[o1,o2] += alpha_C * theexp * ( (sig2**2 * opz1 + opz1 * opz2**2 * alpha_C**2) * ((mu2*opz1 - mu1*opz2)**2 / pow(sigma,4)  -  1 / sigma**2) \
-                              - mu2 * (mu2*opz1 - mu1*opz2) / sigma**2 )
-
-                    if NL > 0:
-                        for l1 in range(NL):
-                            mul1 = lines_mu[l1]
-                            for l2 in range(l1):
-                                mul2 = lines_mu[l2]
-                                KL[o1,o2] += 2 * amp1 * amp2 * exp(-0.5*(pow((mu1 - opz1*mul1)/sig1,2) + pow((mu2 - opz2*mul2)/sig2,2) + pow((mul1-mul2)/alpha_L,2)))
-                                if grad_needed is True:
-                                    D_alpha_L[o1,o2] += 2 * amp1 * amp2 * exp(-0.5*(pow((mu1 - opz1*mul1)/sig1,2) + pow((mu2 - opz2*mul2)/sig2,2) + pow((mul1-mul2)/alpha_L,2))) * pow(mul1-mul2,2) / pow(alpha_L,3)
-
-                            # Last term needed once
-                            l2 = l1
-                            mul2 = lines_mu[l2]
-                            KL[o1,o2] += amp1 * amp2 * exp(-0.5*(pow((mu1 - opz1*mul1)/sig1,2) + pow((mu2 - opz2*mul2)/sig2,2) + pow((mul1-mul2)/alpha_L,2)))
-                            if grad_needed is True:
-                                D_alpha_L[o1,o2] += amp1 * amp2 * exp(-0.5*(pow((mu1 - opz1*mul1)/sig1,2) + pow((mu2 - opz2*mul2)/sig2,2) + pow((mul1-mul2)/alpha_L,2))) * pow(mul1-mul2,2) / pow(alpha_L,3)
-
-            KC[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
-            KL[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
+    # The line kernel factorizes into F1 . M . F2 (see line_factors),
+    # so the line factors of each input are computed once.
+    line_kernel_matrices(NL, alpha_L, lines_mu, grad_needed, M, D_alpha_M)
+    line_factors(NO1, NC, NL, fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                 lines_mu, b1, fz1, F1)
+    line_factors(NO2, NC, NL, fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                 lines_mu, b2, fz2, F2)
 
-            if grad_needed is True:
-                D_alpha_C[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
-                D_alpha_L[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
-                D_alpha_z[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
+    with nogil, parallel():
+        out = <double*> malloc(4 * sizeof(double))
+        for o1 in prange(NO1):
+            for o2 in range(NO2):
+                opz1 = fz1[o1]
+                opz2 = fz2[o2]
+                for i in range(NC):
+                    mu1 = fcoefs_mu[b1[o1],i]
+                    amp1 = fcoefs_amp[b1[o1],i]
+                    sig1 = fcoefs_sig[b1[o1],i]
+                    for j in range(NC):
+                        mu2 = fcoefs_mu[b2[o2],j]
+                        amp2 = fcoefs_amp[b2[o2],j]
+                        sig2 = fcoefs_sig[b2[o2],j]
+                        sigma = sqrt( pow(opz1*sig2,2) + pow(opz2*sig1,2) + pow(opz1*opz2*alpha_C,2) )
+                        theexp = amp1 * amp2 * 2 * M_PI * sig1 * sig2 * exp(-0.5*pow((opz1*mu2 - opz2*mu1)/sigma,2)) / sigma
+                        KC[o1,o2] += alpha_C * theexp
+                        if grad:
+                            D_alpha_C[o1,o2] += theexp * (1 - pow(alpha_C*opz1*opz2/sigma,2)  + pow(alpha_C*(opz1*mu2 - opz2*mu1)*opz1*opz2,2) /pow(sigma,4)  )
+                            D_alpha_z[o1,o2] += alpha_C * theexp * ( (sig2**2 * opz1 + opz1 * opz2**2 * alpha_C**2) * ((mu2*opz1 - mu1*opz2)**2 / pow(sigma,4)  -  1 / sigma**2) \
+                                  - mu2 * (mu2*opz1 - mu1*opz2) / sigma**2 )
+
+                line_contract(NL, F1, o1, F2, o2, M, D_alpha_M, grad, out)
+                KL[o1,o2] += out[0]
+                if grad:
+                    D_alpha_L[o1,o2] += out[3]
+
+                KC[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
+                KL[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
+
+                if grad:
+                    D_alpha_C[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
+                    D_alpha_L[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
+                    D_alpha_z[o1,o2] /= norms[b1[o1]] * norms[b2[o2]]
+        free(out)
+
+
+cdef void kernelparts_entry(
+        int NC,
+        double alpha_C,
+        double[:,:] fcoefs_amp,
+        double[:,:] fcoefs_mu,
+        double[:,:] fcoefs_sig,
+        long b1, double opz1,
+        long b2, double opz2,
+        bint grad_needed,
+        double* out
+    ) noexcept nogil:
+    # Unnormalized KC and D_alpha_C of one pair of inputs,
+    # with the same terms (and order of summation) as kernelparts.
+    cdef int i, j
+    cdef double theexp, mu1, mu2, amp1, amp2, sig1, sig2, sigma
+    out[1] = 0
+    out[2] = 0
+    for i in range(NC):
+        mu1 = fcoefs_mu[b1,i]
+        amp1 = fcoefs_amp[b1,i]
+        sig1 = fcoefs_sig[b1,i]
+        for j in range(NC):
+            mu2 = fcoefs_mu[b2,j]
+            amp2 = fcoefs_amp[b2,j]
+            sig2 = fcoefs_sig[b2,j]
+            sigma = sqrt( pow(opz1*sig2,2) + pow(opz2*sig1,2) + pow(opz1*opz2*alpha_C,2) )
+            theexp = amp1 * amp2 * 2 * M_PI * sig1 * sig2 * exp(-0.5*pow((opz1*mu2 - opz2*mu1)/sigma,2)) / sigma
+            out[1] += alpha_C * theexp
+            if grad_needed:
+                out[2] += theexp * (1 - pow(alpha_C*opz1*opz2/sigma,2)  + pow(alpha_C*(opz1*mu2 - opz2*mu1)*opz1*opz2,2) /pow(sigma,4)  )
+
+
+def kernelparts_grid(
+        int NB, int NZ, int NC, int NL,
+        double alpha_C, double alpha_L,
+        double[:,:] fcoefs_amp,
+        double[:,:] fcoefs_mu,
+        double[:,:] fcoefs_sig,
+        double[:] lines_mu,
+        double[:] lines_sig,
+        double [:] norms,
+        double[:] fzGrid,
+        bool grad_needed,
+        grid_t[:,:,:,:] KL_grid,
+        grid_t[:,:,:,:] KC_grid,
+        grid_t[:,:,:,:] D_alpha_C_grid,
+        grid_t[:,:,:,:] D_alpha_L_grid,
+        double[:,:,:] KL_equalz_grid,
+        double[:,:,:] KC_equalz_grid,
+        double[:,:,:] D_alpha_C_equalz_grid,
+        double[:,:,:] D_alpha_L_equalz_grid
+    ):
+    # Kernel parts for all pairs of bands and redshifts of the grid,
+    # in one parallel loop over (band, redshift) rows.
+    # The continuum parts are symmetric under (b1, z1) <-> (b2, z2),
+    # so only one triangle is computed and mirrored.
+    # The line parts are not (lines are weighted by l2 <= l1),
+    # so both orders are contracted from the line factors of the rows.
+    # The grids are written directly in their own precision (float or double),
+    # and the equal-redshift tables [b1, b2, p] in double precision,
+    # so no double copy of a float grid is ever needed.
+    # The gradient grids are only touched if grad_needed is True,
+    # and the equal-redshift tables only if they are not empty.
+
+    cdef long I, J, b1, b2, p1, p2
+    cdef long NI = NB * NZ
+    cdef double fac
+    cdef bint grad = grad_needed is True
+    cdef bint equalz = KL_equalz_grid.shape[0] > 0
+    cdef double[:,:] F = np.zeros((NI, NL))
+    cdef double[:,:] M = np.zeros((NL, NL))
+    cdef double[:,:] D_alpha_M = np.zeros((NL, NL))
+    cdef double* out
+    cdef double* out2
+
+    line_kernel_matrices(NL, alpha_L, lines_mu, grad_needed, M, D_alpha_M)
+    line_factors(NI, NC, NL, fcoefs_amp, fcoefs_mu, fcoefs_sig, lines_mu,
+                 np.repeat(np.arange(NB), NZ), np.tile(fzGrid, NB), F)
+
+    # The scratch buffers are allocated per thread.
+    with nogil, parallel():
+        out = <double*> malloc(4 * sizeof(double))
+        out2 = <double*> malloc(4 * sizeof(double))
+        for I in prange(NI, schedule='dynamic'):
+            b1 = I // NZ
+            p1 = I % NZ
+            for J in range(I, NI):
+                b2 = J // NZ
+                p2 = J % NZ
+                fac = 1. / (norms[b1] * norms[b2])
+                kernelparts_entry(NC, alpha_C,
+                                  fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                                  b1, fzGrid[p1], b2, fzGrid[p2],
+                                  grad, out)
+                line_contract(NL, F, I, F, J, M, D_alpha_M, grad, out)
+                KC_grid[b1, b2, p1, p2] = out[1] * fac
+                KC_grid[b2, b1, p2, p1] = out[1] * fac
+                KL_grid[b1, b2, p1, p2] = out[0] * fac
+                if grad:
+                    D_alpha_C_grid[b1, b2, p1, p2] = out[2] * fac
+                    D_alpha_C_grid[b2, b1, p2, p1] = out[2] * fac
+                    D_alpha_L_grid[b1, b2, p1, p2] = out[3] * fac
+                if equalz and p1 == p2:
+                    KC_equalz_grid[b1, b2, p1] = out[1] * fac
+                    KC_equalz_grid[b2, b1, p1] = out[1] * fac
+                    KL_equalz_grid[b1, b2, p1] = out[0] * fac
+                    if grad:
+                        D_alpha_C_equalz_grid[b1, b2, p1] = out[2] * fac
+                        D_alpha_C_equalz_grid[b2, b1, p1] = out[2] * fac
+                        D_alpha_L_equalz_grid[b1, b2, p1] = out[3] * fac
+                if J > I:
+                    line_contract(NL, F, J, F, I, M, D_alpha_M, grad, out2)
+                    KL_grid[b2, b1, p2, p1] = out2[0] * fac
+                    if grad:
+                        D_alpha_L_grid[b2, b1, p2, p1] = out2[3] * fac
+                    if equalz and p1 == p2:
+                        KL_equalz_grid[b2, b1, p1] = out2[0] * fac
+                        if grad:
+                            D_alpha_L_equalz_grid[b2, b1, p1] = out2[3] * fac
+        free(out)
+        free(out2)
+
+
+def predict_batch_grid(
+        int NT, int NBP, int NZG,
+        long[:] B,
+        long[:,:] bands,
+        double[:] fz2,
+        long[:] p2s,
+        double[:] sn,
+        double[:] elln,
+        double[:] sk,
+        double[:] skd,
+        const double[:,:,:] L,
+        const double[:,:] beta,
+        double[:] fzGrid,
+        double var_C, double var_L,
+        const grid_t[:,:,:,:] KC_grid,
+        const grid_t[:,:,:,:] KL_grid,
+        const double[:,:] KC_diag_grid,
+        const double[:,:] KL_diag_grid,
+        double[:,:,:] mean,
+        double[:,:,:] var
+    ):
+    # GP predictions of NT training objects (cores L, beta) for all the
+    # NBP bands and NZG redshifts of the kernel grid, at the luminosity
+    # of each object. The predicted inputs are grid nodes, so the kernel
+    # is only interpolated in the redshift of the training object (fz2,
+    # in bin p2s). The kernel prefactors are (sk[k] sn[n])^2 off the
+    # diagonal and (skd[k] elln[n])^2 on it.
+    # mean[k, n, b] = K . beta and var[k, n, b] = Kdiag - |L^-1 K|^2,
+    # without the mean function.
+
+    cdef long n, b, k, j, i, p2, bj
+    cdef double g0, g1, fac, Kj, m, vv
+    cdef double* v
+
+    with nogil, parallel():
+        v = <double*> malloc(L.shape[1] * sizeof(double))
+        for n in prange(NT, schedule='dynamic'):
+            p2 = p2s[n]
+            g0 = (fzGrid[p2+1] - fz2[n]) / (fzGrid[p2+1] - fzGrid[p2])
+            g1 = (fz2[n] - fzGrid[p2]) / (fzGrid[p2+1] - fzGrid[p2])
+            for b in range(NBP):
+                for k in range(NZG):
+                    fac = pow(sk[k] * sn[n], 2)
+                    m = 0
+                    vv = 0
+                    for j in range(B[n]):
+                        bj = bands[n, j]
+                        Kj = fac * (
+                            var_C * (g0 * KC_grid[b, bj, k, p2] + g1 * KC_grid[b, bj, k, p2+1])
+                            + var_L * (g0 * KL_grid[b, bj, k, p2] + g1 * KL_grid[b, bj, k, p2+1]))
+                        m = m + Kj * beta[n, j]
+                        for i in range(j):
+                            Kj = Kj - L[n, j, i] * v[i]
+                        v[j] = Kj / L[n, j, j]
+                        vv = vv + v[j] * v[j]
+                    mean[k, n, b] = m
+                    var[k, n, b] = pow(skd[k] * elln[n], 2) * (
+                        var_C * KC_diag_grid[b, k] + var_L * KL_diag_grid[b, k]) - vv
+        free(v)
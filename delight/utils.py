@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import scipy.sparse
 from scipy.misc import derivative
 
+from delight.utils_cy import find_positions, find_positions_loggrid
+
 import logging
 import coloredlogs
 
@@ -26,6 +29,185 @@ class approx_DL():
         return self.__dict__ == other.__dict__
 
 
+class TemplateFluxTable():
+    """
+    Template fluxes tabulated on a redshift grid, linearly interpolated
+    (and extrapolated) in redshift like scipy's interp1d,
+    but evaluated for all templates and bands in one vectorized call.
+    Indexing as ``table[it, ib](z)`` is supported, as with the array of
+    interpolators previously returned by readSEDs.
+
+    Args:
+        redshiftGrid: increasing array of size nz
+        fluxes: array of size (nz, num templates, num bands)
+    """
+    def __init__(self, redshiftGrid, fluxes):
+        self.redshiftGrid = np.asarray(redshiftGrid, dtype=float)
+        self.fluxes = np.asarray(fluxes, dtype=float)
+        self.nz, self.nt, self.nb = self.fluxes.shape
+        assert self.redshiftGrid.size == self.nz and self.nz > 1
+        self.shape = (self.nt, self.nb)
+        self.slopes = np.diff(self.fluxes, axis=0)\
+            / np.diff(self.redshiftGrid)[:, None, None]
+
+    def positions(self, z):
+        """
+        Bin indices and offsets of redshifts z, to be reused with
+        interpolate if the same redshifts are evaluated repeatedly.
+        """
+        z = np.asarray(z, dtype=float)
+        pos = np.searchsorted(self.redshiftGrid, z)
+        pos = np.clip(pos, 1, self.nz - 1) - 1
+        return pos, z - self.redshiftGrid[pos]
+
+    def interpolate(self, pos, dz, types=slice(None), bands=slice(None)):
+        """
+        Fluxes at precomputed positions (see positions),
+        array of size z.shape + (num types, num bands).
+        types and bands are indices, arrays of indices or slices.
+        """
+        pos = np.asarray(pos)
+        dz = np.asarray(dz)[..., None, None]
+        values = self.slopes[pos] * dz + self.fluxes[pos]
+        return values[..., types, :][..., bands]
+
+    def __call__(self, z, types=slice(None), bands=slice(None)):
+        """
+        Fluxes at redshifts z, array of size z.shape + (num types, num bands).
+        """
+        pos, dz = self.positions(z)
+        return self.interpolate(pos, dz, types=types, bands=bands)
+
+    def evaluate(self, z, bands, types=slice(None)):
+        """
+        Fluxes of objects with one band each,
+        array of size (z.size, num types).
+
+        Args:
+            z: redshifts of the objects
+            bands: band indices of the objects
+            types (Optional): subset of the types
+        """
+        pos, dz = self.positions(np.ravel(z))
+        bands = np.ravel(bands).astype(int)
+        slopes = self.slopes[pos, :, bands][:, types]
+        fluxes = self.fluxes[pos, :, bands][:, types]
+        return slopes * dz[:, None] + fluxes
+
+    def __getitem__(self, key):
+        it, ib = key
+        return lambda z: self(z, types=it, bands=ib)
+
+
+class RedshiftBinLocator():
+    """
+    Interpolation bins of values in an increasing grid,
+    i.e. the largest p in [0, nz-2] with grid[p] < value.
+    Values outside the grid are clamped to the first or last bin,
+    which kernel_parts_interp and bilininterp_precomputedbins then
+    extrapolate linearly.
+    Grids of the form offset + logspace (like 1 + redshiftGridGP)
+    are detected and located in closed form, other grids by binary search.
+
+    Args:
+        grid: increasing array of size nz
+        offset (Optional): offset of the log-spaced part of the grid
+            (``float``, default: ``0.0``)
+    """
+    def __init__(self, grid, offset=0.0):
+        self.grid = np.ascontiguousarray(grid, dtype=float)
+        self.nz = self.grid.size
+        assert self.nz > 1
+        self.offset = offset
+        self.logSpaced = False
+        if self.nz > 2 and np.all(self.grid > offset):
+            logSteps = np.diff(np.log(self.grid - offset))
+            self.logSpaced = bool(np.allclose(logSteps, logSteps[0],
+                                              rtol=1e-8, atol=0))
+
+    def __call__(self, values, positions=None):
+        """
+        Bin indices of values, written to positions if provided.
+        """
+        values = np.ascontiguousarray(values, dtype=float)
+        if positions is None:
+            positions = np.zeros(values.size, dtype=int)
+        if self.logSpaced:
+            find_positions_loggrid(values.size, self.nz, values, positions,
+                                   self.grid, self.offset)
+        else:
+            find_positions(values.size, self.nz, values, positions,
+                           self.grid)
+        return positions
+
+
+class LinearInterpolationOperator():
+    """
+    Sparse linear interpolation from the nodes of an increasing grid
+    to a set of points, as a matrix W of size (numPoints, numNodes)
+    with two weights per row, i.e. W.dot(y) = np.interp(points, nodes, y)
+    for all the columns of y at once.
+    Points outside the nodes are clamped to the first or last node,
+    as in np.interp.
+    The weights are computed once. withNode gives the operator of the
+    grid with one node moved, recomputing the rows between its neighbours
+    only.
+
+    Args:
+        points: array of size numPoints
+        nodes: increasing array of size numNodes
+    """
+    def __init__(self, points, nodes):
+        self.points = np.ascontiguousarray(points, dtype=float)
+        self.nodes = np.ascontiguousarray(nodes, dtype=float)
+        assert self.nodes.size > 1
+        self.positions, self.weights = self.interpolationWeights(self.nodes)
+        self.matrix = self.sparseMatrix(self.positions, self.weights)
+
+    def interpolationWeights(self, nodes, rows=slice(None)):
+        """
+        Left nodes and weights of the right nodes for points[rows].
+        """
+        points = self.points[rows]
+        p = np.searchsorted(nodes, points, side='right') - 1
+        p = np.clip(p, 0, nodes.size - 2)
+        w = np.clip((points - nodes[p]) / (nodes[p+1] - nodes[p]), 0, 1)
+        return p, w
+
+    def sparseMatrix(self, positions, weights):
+        """
+        CSR matrix with weights 1-w and w on the nodes p and p+1.
+        """
+        n = self.points.size
+        data = np.column_stack((1 - weights, weights)).ravel()
+        indices = np.column_stack((positions, positions + 1)).ravel()
+        indptr = np.arange(0, 2*n + 1, 2)
+        return scipy.sparse.csr_matrix((data, indices, indptr),
+                                       shape=(n, self.nodes.size))
+
+    def withNode(self, k, value):
+        """
+        Operator for the nodes with nodes[k] replaced by value,
+        which must keep the nodes increasing.
+        """
+        nodes = 1 * self.nodes
+        nodes[k] = value
+        low = nodes[k-1] if k > 0 else -np.inf
+        high = nodes[k+1] if k < nodes.size - 1 else np.inf
+        rows = np.where((self.points >= low) & (self.points <= high))[0]
+        positions, weights = 1 * self.positions, 1 * self.weights
+        positions[rows], weights[rows] =\
+            self.interpolationWeights(nodes, rows)
+        return self.sparseMatrix(positions, weights)
+
+    def __call__(self, y):
+        """
+        Interpolate the columns of y, of size (numNodes, ...).
+        """
+        return self.matrix.dot(y.reshape((self.nodes.size, -1)))\
+            .reshape((self.points.size, ) + y.shape[1:])
+
+
 def symmetrize(a):
     """
     Symmmetrize matrix
@@ -3,10 +3,49 @@ cimport numpy as np
 from cython.parallel import prange
 from cpython cimport bool
 cimport cython
-from libc.math cimport sqrt, M_PI, exp, pow, log
+from libc.math cimport sqrt, M_PI, exp, pow, log, floor
 from libc.stdlib cimport malloc, free
 
 
+cdef inline long locate_bin(double v, double[:] grid, long nz) nogil:
+    """
+    Binary search for the largest p in [0, nz-2] with grid[p] < v.
+    Values below the grid map to the first bin, values above it to the
+    last one, so that the interpolation extrapolates linearly.
+    """
+    cdef long lo = 0, hi = nz - 1, mid
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if grid[mid] < v:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+cdef inline long locate_bin_loggrid(
+        double v, double[:] grid, long nz,
+        double offset, double logStart, double invLogStep) nogil:
+    """
+    Same as locate_bin, for grid[p] = offset + exp(logStart + p*logStep).
+    The closed-form guess is corrected by at most a few steps to absorb
+    rounding, so both functions return identical bins.
+    """
+    cdef long p
+    if v - offset <= 0:
+        return 0
+    p = <long>floor((log(v - offset) - logStart) * invLogStep)
+    if p < 0:
+        p = 0
+    if p > nz - 2:
+        p = nz - 2
+    while p > 0 and grid[p] >= v:
+        p -= 1
+    while p < nz - 2 and grid[p+1] < v:
+        p += 1
+    return p
+
+
 def find_positions(
         int NO1, int nz,
         double[:] fz1,
@@ -14,12 +53,26 @@ def find_positions(
         double[:] fzGrid
         ):
 
-    cdef long p1, o1
+    cdef long o1
+    for o1 in prange(NO1, nogil=True):
+        p1s[o1] = locate_bin(fz1[o1], fzGrid, nz)
+
+
+def find_positions_loggrid(
+        int NO1, int nz,
+        double[:] fz1,
+        long[:] p1s,
+        double[:] fzGrid,
+        double offset
+        ):
+
+    cdef long o1
+    cdef double logStart = log(fzGrid[0] - offset)
+    cdef double invLogStep = (nz - 1) /\
+        (log(fzGrid[nz-1] - offset) - logStart)
     for o1 in prange(NO1, nogil=True):
-        for p1 in range(nz-1):
-            if fz1[o1] >= fzGrid[p1] and fz1[o1] <= fzGrid[p1+1]:
-                p1s[o1] = p1
-                break;
+        p1s[o1] = locate_bin_loggrid(fz1[o1], fzGrid, nz,
+                                     offset, logStart, invLogStep)
 
 
 def bilininterp_precomputedbins(
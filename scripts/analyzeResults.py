@@ -35,9 +35,7 @@ numZ = redshiftGrid.size
 fig, axs = plt.subplots(numZbins, 2, figsize=(10, 10))
 
 for iax, extra in enumerate(['', 'Temp']):
-    numObjectsTarget = np.sum(1 for line in open(params['metricsFile'+extra]))
-    fpdf = open(params['redshiftpdfFile'+extra])
-    fmet = open(params['metricsFile'+extra])
+    numObjectsTarget = getNumberOfLines(params['metricsFile'+extra])
 
     # Create local files to store results
     numConfLevels = len(params['confidenceLevels'])
@@ -56,11 +54,15 @@ for iax, extra in enumerate(['', 'Temp']):
 
     # Now loop over target set to compute likelihood function
     loc = - 1
-    iterpdf = itertools.islice(fpdf, 0, numObjectsTarget)
-    itermet = itertools.islice(fmet, 0, numObjectsTarget)
+    chunkSize = 10000
     for loc in range(numObjectsTarget):
-        pdf = np.array(next(iterpdf).split(' '), dtype=float)
-        metrics = np.array(next(itermet).split(' '), dtype=float)
+        if loc % chunkSize == 0:
+            pdfs = readPDFRows(params['redshiftpdfFile'+extra],
+                               loc, loc + chunkSize)
+            metricsChunk = readRowRange(params['metricsFile'+extra],
+                                        loc, loc + chunkSize)
+        pdf = pdfs[loc % chunkSize, :]
+        metrics = metricsChunk[loc % chunkSize, :]
         ztrue, zmean, zstdzmean, zmap, zstdzmap, pdfAtZ, cumPdfAtZ\
             = metrics[0:7]
         confidencelevels = metrics[7:]
@@ -0,0 +1,71 @@
+##################################################################################################
+#
+# script : benchmarkPDFCodecs.py
+#
+# size and error benchmark of the PDF codecs (see writePDFSlabs) on the redshift PDFs
+# produced by delight-apply.py for a given parameter file (by default the G10 configuration).
+#
+# input : parameter file, optionally the PDF file to use instead of redshiftpdfFile
+# output : table printed on screen (size, compression, timings, errors on the PDFs and
+# on the redshift point estimates)
+##################################################################################################
+
+from delight.io import *
+import sys
+import os
+import tempfile
+from time import time
+
+logger = logging.getLogger(__name__)
+coloredlogs.install(level='DEBUG', logger=logger,fmt='%(asctime)s,%(msecs)03d %(programname)s, %(name)s[%(process)d] %(levelname)s %(message)s')
+
+paramFile = sys.argv[1] if len(sys.argv) > 1\
+    else 'parameter_files/parameters_G10.cfg'
+params = parseParamFile(paramFile, verbose=False, catFilesNeeded=False)
+pdfFile = sys.argv[2] if len(sys.argv) > 2 else params['redshiftpdfFile']
+if not os.path.exists(pdfFile):
+    raise Exception(pdfFile+' : file does not exist, run delight-apply.py first')
+
+redshiftDistGrid, redshiftGrid, redshiftGridGP = createGrids(params)
+numObjects = getNumberOfLines(pdfFile)
+pdfs = readPDFRows(pdfFile, 0, numObjects)
+logger.info("--- Benchmark of the PDF codecs on " + pdfFile + " ---")
+
+
+def directorySize(fileName):
+    if os.path.isfile(fileName):
+        return os.path.getsize(fileName)
+    return sum([os.path.getsize(os.path.join(fileName, name))
+                for name in os.listdir(fileName)])
+
+
+def pointEstimates(pdfs):
+    norm = np.where(pdfs.sum(axis=1) > 0, pdfs.sum(axis=1), 1)
+    zmean = np.sum(pdfs * redshiftGrid[None, :], axis=1) / norm
+    zmap = redshiftGrid[np.argmax(pdfs, axis=1)]
+    return zmean, zmap
+
+
+zmean, zmap = pointEstimates(pdfs)
+peaks = np.where(pdfs.max(axis=1) > 0, pdfs.max(axis=1), 1)
+print('%-10s %12s %8s %9s %9s %12s %12s %12s' %
+      ('codec', 'bytes', 'ratio', 'write(s)', 'read(s)',
+       'maxRelErr', 'max|dzmean|', 'max|dzmap|'))
+outDir = tempfile.mkdtemp()
+for codec in PDF_CODECS:
+    fileName = os.path.join(outDir, 'pdfs-' + codec +
+                            ('.txt' if codec == 'text' else ''))
+    t1 = time()
+    writePDFSlabs(fileName, pdfs, 0, numObjects, codec=codec,
+                  threshold=params['pdfSparseThreshold'])
+    t2 = time()
+    pdfs2 = readPDFRows(fileName, 0, numObjects)
+    t3 = time()
+    if codec == 'text':
+        size0 = directorySize(fileName)
+    zmean2, zmap2 = pointEstimates(pdfs2)
+    print('%-10s %12d %8.1f %9.3f %9.3f %12.2e %12.2e %12.2e' %
+          (codec, directorySize(fileName),
+           size0 / float(directorySize(fileName)), t2 - t1, t3 - t2,
+           np.max(np.abs(pdfs2 - pdfs) / peaks[:, None]),
+           np.max(np.abs(zmean2 - zmean)), np.max(np.abs(zmap2 - zmap))))
@@ -0,0 +1,32 @@
+##################################################################################################
+#
+# script : buildModelBundle.py
+#
+# build a model bundle from a parameter file: a directory with the parsed parameters,
+# the band Gaussian coefficients and norms, the redshift grids and the template flux
+# grids, stored as memory-mappable .npy files with a versioned manifest and content hash.
+#
+# output directory : second argument, or the parameter file (without extension) + '_bundle'
+# the bundle can then be passed to any script instead of the parameter file.
+##################################################################################################
+
+import sys
+import os
+from delight.io import *
+
+logger = logging.getLogger(__name__)
+coloredlogs.install(level='DEBUG', logger=logger,fmt='%(asctime)s,%(msecs)03d %(programname)s, %(name)s[%(process)d] %(levelname)s %(message)s')
+
+if len(sys.argv) < 2:
+    raise Exception('Please provide a parameter file')
+
+logger.info("--- Build model bundle ---")
+
+params = parseParamFile(sys.argv[1], verbose=False)
+if len(sys.argv) > 2:
+    outDir = sys.argv[2]
+else:
+    outDir = os.path.splitext(sys.argv[1])[0] + '_bundle'
+
+bundleHash = buildModelBundle(params, outDir)
+logger.info('model bundle written to ' + outDir + ' (hash ' + bundleHash + ')')
@@ -0,0 +1,41 @@
+##################################################################################################
+#
+# script : convertCatalogs.py
+#
+# convert the training and target text catalogs into the binary columnar format
+# (one .npy file per column), which is memory-mapped instead of parsed.
+#
+# output directories : catFile (without extension) + '_columns'
+# the catFile entries of the parameter file should then point to them.
+##################################################################################################
+
+import sys
+import os
+from delight.io import *
+
+logger = logging.getLogger(__name__)
+coloredlogs.install(level='DEBUG', logger=logger,fmt='%(asctime)s,%(msecs)03d %(programname)s, %(name)s[%(process)d] %(levelname)s %(message)s')
+
+if len(sys.argv) < 2:
+    raise Exception('Please provide a parameter file')
+
+logger.info("--- Convert catalogs ---")
+
+params = parseParamFile(sys.argv[1], verbose=False)
+
+catalogs = collections.OrderedDict()
+for prefix in ['training_', 'target_']:
+    catFile = params[prefix+'catFile']
+    if isColumnarCatalog(catFile):
+        logger.info(catFile + ' is already columnar')
+        continue
+    bandOrders = catalogs.get(catFile, [])
+    bandOrders.append(params[prefix+'bandOrder'])
+    if prefix == 'training_':
+        bandOrders.append(params['training_CV_bandOrder'])
+    catalogs[catFile] = bandOrders
+
+for catFile, bandOrders in catalogs.items():
+    outDir = os.path.splitext(catFile)[0] + '_columns'
+    convertCatalogToColumns(catFile, bandOrders, outDir)
+    logger.info(catFile + ' converted to ' + outDir)
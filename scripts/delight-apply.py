@@ -8,6 +8,9 @@ from delight.photoz_gp import PhotozGP
 from delight.photoz_kernels import Photoz_mean_function, Photoz_kernel
 from delight.utils_cy import approx_flux_likelihood_cy
 from time import time
+import os
+import shutil
+import tempfile
 
 logger = logging.getLogger(__name__)
 coloredlogs.install(level='DEBUG', logger=logger,fmt='%(asctime)s,%(msecs)03d %(programname)s, %(name)s[%(process)d] %(levelname)s %(message)s')
@@ -39,17 +42,13 @@ dir_seds = params['templates_directory']
 dir_filters = params['bands_directory']
 lambdaRef = params['lambdaRef']
 sed_names = params['templates_names']
-f_mod_grid = np.zeros((redshiftGrid.size, len(sed_names),
-                       len(params['bandNames'])))
-for t, sed_name in enumerate(sed_names):
-    f_mod_grid[:, t, :] = np.loadtxt(dir_seds + '/' + sed_name +
-                                     '_fluxredshiftmod.txt')
+f_mod_grid = f_mod_interp.fluxes
 
 numZbins = redshiftDistGrid.size - 1
 numZ = redshiftGrid.size
 
-numObjectsTraining = np.sum(1 for line in open(params['training_catFile']))
-numObjectsTarget = np.sum(1 for line in open(params['target_catFile']))
+numObjectsTraining = getNumberOfLines(params['training_catFile'])
+numObjectsTarget = getNumberOfLines(params['target_catFile'])
 redshiftsInTarget = ('redshift' in params['target_bandOrder'])
 Ncompress = params['Ncompress']
 
@@ -69,42 +68,70 @@ gp = PhotozGP(f_mod_interp,
               params['lines_pos'], params['lines_width'],
               params['V_C'], params['V_L'],
               params['alpha_C'], params['alpha_L'],
-              redshiftGridGP, use_interpolators=True)
+              redshiftGridGP, use_interpolators=True,
+              gridCache=getKernelGridCache(params),
+              comm=comm if params.get('shareKernelGrids') else None,
+              bands=readBandSubset(params),
+              gridDtype=params.get('kernelGridDtype', 'float64'))
 
-# Create local files to store results
-numMetrics = 7 + len(params['confidenceLevels'])
-localPDFs = np.zeros((numLines, numZ))
-localMetrics = np.zeros((numLines, numMetrics))
-localCompressIndices = np.zeros((numLines,  Ncompress), dtype=int)
-localCompEvidences = np.zeros((numLines,  Ncompress))
+binaryCores = isBinaryFile(params['training_paramFile'])
+if binaryCores:
+    coreStore = openGPCoreStore(params['training_paramFile'])
 
-# Looping over chunks of the training set to prepare model predictions over z
+numMetrics = 7 + len(params['confidenceLevels'])
 numChunks = params['training_numChunks']
-for chunk in range(numChunks):
+
+# Targets are processed in blocks of blockSize objects (all by default),
+# so that memory use depends on the block size only.
+# Training chunk predictions are cached on disk if they are reused
+# by several blocks.
+blockSize = params['target_blockSize']
+if blockSize <= 0:
+    blockSize = max(1, numLines)
+numBlocks = max(1, int(np.ceil(numLines / float(blockSize))))
+cacheDir = None
+if numChunks > 1 and numBlocks > 1:
+    cacheDir = tempfile.mkdtemp(prefix='delight-apply-')
+
+
+def trainingChunkPredictions(chunk):
+    """
+    Model predictions over z for a chunk of the training set,
+    and the corresponding redshift prior.
+    """
     TR_firstLine = int(chunk * numObjectsTraining / float(numChunks))
     TR_lastLine = int(min(numObjectsTraining,
                       (chunk + 1) * numObjectsTarget / float(numChunks)))
     targetIndices = np.arange(TR_firstLine, TR_lastLine)
     numTObjCk = TR_lastLine - TR_firstLine
-    redshifts = np.zeros((numTObjCk, ))
-    model_mean = np.zeros((numZ, numTObjCk, numBands))
-    model_covar = np.zeros((numZ, numTObjCk, numBands))
-    bestTypes = np.zeros((numTObjCk, ), dtype=int)
-    ells = np.zeros((numTObjCk, ), dtype=int)
-    loc = TR_firstLine - 1
-    trainingDataIter = getDataFromFile(params, TR_firstLine, TR_lastLine,
-                                       prefix="training_", ftype="gpparams")
-    for loc, (z, ell, bands, X, B, flatarray) in enumerate(trainingDataIter):
-        t1 = time()
-        redshifts[loc] = z
-        gp.setCore(X, B, nt,
-                   flatarray[0:nt+B+B*(B+1)//2])
-        bestTypes[loc] = gp.bestType
-        ells[loc] = ell
-        model_mean[:, loc, :], model_covar[:, loc, :] =\
-            gp.predictAndInterpolate(redshiftGrid, ell=ell)
-        t2 = time()
-        # print(loc, t2-t1)
+    if binaryCores:
+        # the records of the binary store are the GP cores of the chunk
+        cores = coreStore[TR_firstLine:TR_lastLine]
+        redshifts = cores['z'].astype(float)
+    else:
+        redshifts = np.zeros((numTObjCk, ))
+        bestTypes = np.zeros((numTObjCk, ), dtype=int)
+        ells = np.zeros((numTObjCk, ), dtype=int)
+        # the GP cores of the chunk are gathered, then predicted at once
+        cores = np.zeros((numTObjCk, ), dtype=gpCoreDtype(numBands, nt))
+        loc = TR_firstLine - 1
+        trainingDataIter = getDataFromFile(params, TR_firstLine, TR_lastLine,
+                                           prefix="training_",
+                                           ftype="gpparams", prefetch=True,
+                                           prefetchTimes=prefetchTimes)
+        for loc, (z, ell, bands, X, B, flatarray)\
+                in enumerate(trainingDataIter):
+            redshifts[loc] = z
+            gp.setCore(X, B, nt, flatarray)
+            bestTypes[loc] = gp.bestType
+            ells[loc] = ell
+            writeGPCore(cores, loc, z, ell, bands,
+                        gp.betas, gp.L, gp.D, gp.beta)
+    t1 = time()
+    model_mean, model_covar =\
+        gp.predictAndInterpolateBatch(redshiftGrid, cores)
+    t2 = time()
+    # print(numTObjCk, t2-t1)
 
     # p_t = params['p_t'][bestTypes][None, :]
     # p_z_t = params['p_z_t'][bestTypes][None, :]
@@ -113,124 +140,156 @@ for chunk in range(numChunks):
     # prior[prior < 1e-6] = 0
     # prior *= p_t * redshiftGrid[:, None] *
     # np.exp(-0.5 * redshiftGrid[:, None]**2 / p_z_t) / p_z_t
+    return targetIndices, model_mean, model_covar, prior
+
+
+chunkPredictions = {}
+# time spent reading the training cores and targets in the background,
+# and time spent waiting for them
+prefetchTimes = {'io': 0., 'wait': 0.}
+
+
+def getTrainingChunkPredictions(chunk):
+    """
+    Predictions of a training chunk, computed once: kept in memory
+    if there is a single chunk, memory-mapped from the cache otherwise.
+    """
+    if chunk in chunkPredictions:
+        return chunkPredictions[chunk]
+    predictions = trainingChunkPredictions(chunk)
+    if numChunks == 1:
+        chunkPredictions[chunk] = predictions
+    elif cacheDir is not None:
+        names = ['targetIndices', 'model_mean', 'model_covar', 'prior']
+        for name, arr in zip(names, predictions):
+            np.save(os.path.join(cacheDir, name + str(chunk) + '.npy'), arr)
+        chunkPredictions[chunk] = tuple(
+            np.load(os.path.join(cacheDir, name + str(chunk) + '.npy'),
+                    mmap_mode='r') for name in names)
+    return predictions
 
-    if params['useCompression'] and params['compressionFilesFound']:
-        fC = open(params['compressMargLikFile'])
-        fCI = open(params['compressIndicesFile'])
-        itCompM = itertools.islice(fC, firstLine, lastLine)
-        iterCompI = itertools.islice(fCI, firstLine, lastLine)
-    targetDataIter = getDataFromFile(params, firstLine, lastLine,
-                                     prefix="target_", getXY=False, CV=False)
-    for loc, (z, normedRefFlux, bands, fluxes, fluxesVar, bCV, dCV, dVCV)\
-            in enumerate(targetDataIter):
-        t1 = time()
-        ell_hat_z = normedRefFlux * 4 * np.pi\
-            * params['fluxLuminosityNorm'] \
-            * (DL(redshiftGrid)**2. * (1+redshiftGrid))
-        ell_hat_z[:] = 1
-        if params['useCompression'] and params['compressionFilesFound']:
-            indices = np.array(next(iterCompI).split(' '), dtype=int)
-            sel = np.in1d(targetIndices, indices, assume_unique=True)
-            like_grid2 = approx_flux_likelihood(
-                fluxes,
-                fluxesVar,
-                model_mean[:, sel, :][:, :, bands],
-                f_mod_covar=model_covar[:, sel, :][:, :, bands],
-                marginalizeEll=True, normalized=False,
-                ell_hat=ell_hat_z,
-                ell_var=(ell_hat_z*params['ellPriorSigma'])**2
-            )
-            like_grid *= prior[:, sel]
-        else:
-            like_grid = np.zeros((nz, model_mean.shape[1]))
-            approx_flux_likelihood_cy(
-                like_grid, nz, model_mean.shape[1], bands.size,
-                fluxes, fluxesVar,
-                model_mean[:, :, bands],
-                model_covar[:, :, bands],
-                ell_hat=ell_hat_z,
-                ell_var=(ell_hat_z*params['ellPriorSigma'])**2)
-            like_grid *= prior[:, :]
-        t2 = time()
-        localPDFs[loc, :] += like_grid.sum(axis=1)
-        evidences = np.trapz(like_grid, x=redshiftGrid, axis=0)
-        t3 = time()
-        if params['useCompression'] and not params['compressionFilesFound']:
-            if localCompressIndices[loc, :].sum() == 0:
-                sortind = np.argsort(evidences)[::-1][0:Ncompress]
-                localCompressIndices[loc, :] = targetIndices[sortind]
-                localCompEvidences[loc, :] = evidences[sortind]
-            else:
-                dind = np.concatenate((targetIndices,
-                                       localCompressIndices[loc, :]))
-                devi = np.concatenate((evidences,
-                                       localCompEvidences[loc, :]))
-                sortind = np.argsort(devi)[::-1][0:Ncompress]
-                localCompressIndices[loc, :] = dind[sortind]
-                localCompEvidences[loc, :] = devi[sortind]
-
-        if chunk == numChunks - 1\
-                and redshiftsInTarget\
-                and localPDFs[loc, :].sum() > 0:
-            localMetrics[loc, :] = computeMetrics(
-                                    z, redshiftGrid,
-                                    localPDFs[loc, :],
-                                    params['confidenceLevels'])
-        t4 = time()
-        if loc % 100 == 0:
-            print(loc, t2-t1, t3-t2, t4-t3)
+
+# Outputs are written block by block by each process
+fmt = '%.2e'
+fname = params['redshiftpdfFileComp'] if params['compressionFilesFound']\
+    else params['redshiftpdfFile']
+writers = {}
+writers['pdfs'] = RowSlabWriter(fname, (numObjectsTarget, numZ),
+                                firstLine, lastLine, comm,
+                                codec=params['pdfCodec'],
+                                threshold=params['pdfSparseThreshold'],
+                                fmt=fmt)
+if redshiftsInTarget:
+    writers['metrics'] = RowSlabWriter(params['metricsFile'],
+                                       (numObjectsTarget, numMetrics),
+                                       firstLine, lastLine, comm, fmt=fmt)
+if params['useCompression'] and not params['compressionFilesFound']:
+    writers['compEvidences'] = RowSlabWriter(params['compressMargLikFile'],
+                                             (numObjectsTarget, Ncompress),
+                                             firstLine, lastLine, comm,
+                                             fmt=fmt)
+    writers['compIndices'] = RowSlabWriter(params['compressIndicesFile'],
+                                           (numObjectsTarget, Ncompress),
+                                           firstLine, lastLine, comm,
+                                           dtype=int, fmt="%i")
+
+for block in range(numBlocks):
+    BL_firstLine = firstLine + block * blockSize
+    BL_lastLine = min(lastLine, BL_firstLine + blockSize)
+    numBlockLines = BL_lastLine - BL_firstLine
+
+    # Create local arrays to store results of the block
+    localPDFs = np.zeros((numBlockLines, numZ))
+    localMetrics = np.zeros((numBlockLines, numMetrics))
+    localCompressIndices = np.zeros((numBlockLines,  Ncompress), dtype=int)
+    localCompEvidences = np.zeros((numBlockLines,  Ncompress))
 
     if params['useCompression'] and params['compressionFilesFound']:
-        fC.close()
-        fCI.close()
+        compIndices = readRowRange(params['compressIndicesFile'],
+                                   BL_firstLine, BL_lastLine, dtype=int)
 
-comm.Barrier()
-if threadNum == 0:
-    globalPDFs = np.zeros((numObjectsTarget, numZ))
-    globalCompressIndices = np.zeros((numObjectsTarget, Ncompress), dtype=int)
-    globalCompEvidences = np.zeros((numObjectsTarget, Ncompress))
-    globalMetrics = np.zeros((numObjectsTarget, numMetrics))
-else:
-    globalPDFs = None
-    globalCompressIndices = None
-    globalCompEvidences = None
-    globalMetrics = None
-
-firstLines = [int(k*numObjectsTarget/numThreads)
-              for k in range(numThreads)]
-lastLines = [int(min(numObjectsTarget, (k+1)*numObjectsTarget/numThreads))
-             for k in range(numThreads)]
-numLines = [lastLines[k] - firstLines[k] for k in range(numThreads)]
-
-sendcounts = tuple([numLines[k] * numZ for k in range(numThreads)])
-displacements = tuple([firstLines[k] * numZ for k in range(numThreads)])
-comm.Gatherv(localPDFs,
-             [globalPDFs, sendcounts, displacements, MPI.DOUBLE])
-
-sendcounts = tuple([numLines[k] * Ncompress for k in range(numThreads)])
-displacements = tuple([firstLines[k] * Ncompress for k in range(numThreads)])
-comm.Gatherv(localCompressIndices,
-             [globalCompressIndices, sendcounts, displacements, MPI.LONG])
-comm.Gatherv(localCompEvidences,
-             [globalCompEvidences, sendcounts, displacements, MPI.DOUBLE])
-comm.Barrier()
+    # Looping over chunks of the training set with model predictions over z
+    for chunk in range(numChunks):
+        targetIndices, model_mean, model_covar, prior =\
+            getTrainingChunkPredictions(chunk)
 
-sendcounts = tuple([numLines[k] * numMetrics for k in range(numThreads)])
-displacements = tuple([firstLines[k] * numMetrics for k in range(numThreads)])
-comm.Gatherv(localMetrics,
-             [globalMetrics, sendcounts, displacements, MPI.DOUBLE])
+        targetDataIter = getDataFromFile(params, BL_firstLine, BL_lastLine,
+                                         prefix="target_", getXY=False,
+                                         CV=False, prefetch=True,
+                                         prefetchTimes=prefetchTimes)
+        for loc, (z, normedRefFlux, bands, fluxes, fluxesVar,
+                  bCV, dCV, dVCV) in enumerate(targetDataIter):
+            t1 = time()
+            bandsGP = gp.compactIndex[bands]
+            ell_hat_z = normedRefFlux * 4 * np.pi\
+                * params['fluxLuminosityNorm'] \
+                * (DL(redshiftGrid)**2. * (1+redshiftGrid))
+            ell_hat_z[:] = 1
+            if params['useCompression'] and params['compressionFilesFound']:
+                indices = compIndices[loc, :]
+                sel = np.in1d(targetIndices, indices, assume_unique=True)
+                like_grid2 = approx_flux_likelihood(
+                    fluxes,
+                    fluxesVar,
+                    model_mean[:, sel, :][:, :, bandsGP],
+                    f_mod_covar=model_covar[:, sel, :][:, :, bandsGP],
+                    marginalizeEll=True, normalized=False,
+                    ell_hat=ell_hat_z,
+                    ell_var=(ell_hat_z*params['ellPriorSigma'])**2
+                )
+                like_grid *= prior[:, sel]
+            else:
+                like_grid = np.zeros((nz, model_mean.shape[1]))
+                approx_flux_likelihood_cy(
+                    like_grid, nz, model_mean.shape[1], bands.size,
+                    fluxes, fluxesVar,
+                    model_mean[:, :, bandsGP],
+                    model_covar[:, :, bandsGP],
+                    ell_hat=ell_hat_z,
+                    ell_var=(ell_hat_z*params['ellPriorSigma'])**2)
+                like_grid *= prior[:, :]
+            t2 = time()
+            localPDFs[loc, :] += like_grid.sum(axis=1)
+            evidences = np.trapz(like_grid, x=redshiftGrid, axis=0)
+            t3 = time()
+            if params['useCompression']\
+                    and not params['compressionFilesFound']:
+                if localCompressIndices[loc, :].sum() == 0:
+                    sortind = np.argsort(evidences)[::-1][0:Ncompress]
+                    localCompressIndices[loc, :] = targetIndices[sortind]
+                    localCompEvidences[loc, :] = evidences[sortind]
+                else:
+                    dind = np.concatenate((targetIndices,
+                                           localCompressIndices[loc, :]))
+                    devi = np.concatenate((evidences,
+                                           localCompEvidences[loc, :]))
+                    sortind = np.argsort(devi)[::-1][0:Ncompress]
+                    localCompressIndices[loc, :] = dind[sortind]
+                    localCompEvidences[loc, :] = devi[sortind]
 
-comm.Barrier()
+            if chunk == numChunks - 1\
+                    and redshiftsInTarget\
+                    and localPDFs[loc, :].sum() > 0:
+                localMetrics[loc, :] = computeMetrics(
+                                        z, redshiftGrid,
+                                        localPDFs[loc, :],
+                                        params['confidenceLevels'])
+            t4 = time()
+            if loc % 100 == 0:
+                print(loc, t2-t1, t3-t2, t4-t3)
 
-if threadNum == 0:
-    fmt = '%.2e'
-    fname = params['redshiftpdfFileComp'] if params['compressionFilesFound']\
-        else params['redshiftpdfFile']
-    np.savetxt(fname, globalPDFs, fmt=fmt)
+    writers['pdfs'].write(localPDFs)
     if redshiftsInTarget:
-        np.savetxt(params['metricsFile'], globalMetrics, fmt=fmt)
+        writers['metrics'].write(localMetrics)
     if params['useCompression'] and not params['compressionFilesFound']:
-        np.savetxt(params['compressMargLikFile'],
-                   globalCompEvidences, fmt=fmt)
-        np.savetxt(params['compressIndicesFile'],
-                   globalCompressIndices, fmt="%i")
+        writers['compEvidences'].write(localCompEvidences)
+        writers['compIndices'].write(localCompressIndices)
+
+logger.info('Thread %d: I/O %.2fs, waiting for I/O %.2fs, hidden %.2fs'
+            % (threadNum, prefetchTimes['io'], prefetchTimes['wait'],
+               max(0., prefetchTimes['io'] - prefetchTimes['wait'])))
+comm.Barrier()
+for writer in writers.values():
+    writer.close()
+if cacheDir is not None:
+    shutil.rmtree(cacheDir)
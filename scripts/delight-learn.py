@@ -35,7 +35,7 @@ numBands = bandCoefAmplitudes.shape[0]
 redshiftDistGrid, redshiftGrid, redshiftGridGP = createGrids(params)
 f_mod = readSEDs(params)
 
-numObjectsTraining = np.sum(1 for line in open(params['training_catFile']))
+numObjectsTraining = getNumberOfLines(params['training_catFile'])
 print('Number of Training Objects', numObjectsTraining)
 firstLine = int(threadNum * numObjectsTraining / numThreads)
 lastLine = int(min(numObjectsTraining,
@@ -49,34 +49,90 @@ gp = PhotozGP(f_mod, bandCoefAmplitudes, bandCoefPositions, bandCoefWidths,
               params['lines_pos'], params['lines_width'],
               params['V_C'], params['V_L'],
               params['alpha_C'], params['alpha_L'],
-              redshiftGridGP, use_interpolators=True)
+              redshiftGridGP, use_interpolators=True,
+              gridCache=getKernelGridCache(params),
+              comm=comm if params.get('shareKernelGrids') else None,
+              bands=readBandSubset(params),
+              gridDtype=params.get('kernelGridDtype', 'float64'))
 
 B = numBands
 numCol = 3 + B + B*(B+1)//2 + B + f_mod.shape[0]
-localData = np.zeros((numLines, numCol))
+binaryCores = isBinaryFile(params['training_paramFile'])
+if binaryCores:
+    # each thread writes its cores directly in the binary store
+    numBandsTraining = readColumnPositions(params, prefix="training_")[0].size
+    if threadNum == 0:
+        createGPCoreStore(params['training_paramFile'], numObjectsTraining,
+                          numBandsTraining, f_mod.shape[0])
+    comm.Barrier()
+    coreStore = openGPCoreStore(params['training_paramFile'], mode='r+')
+    localData = np.zeros((0, numCol))
+else:
+    localData = np.zeros((numLines, numCol))
 fmt = '%i ' + '%.12e ' * (localData.shape[1] - 1)
 
-loc = - 1
 crossValidate = params['training_crossValidate']
 trainingDataIter1 = getDataFromFile(params, firstLine, lastLine,
                                     prefix="training_", getXY=True,
                                     CV=crossValidate)
 if crossValidate:
-    chi2sLocal = None
     bandIndicesCV, bandNamesCV, bandColumnsCV,\
         bandVarColumnsCV, redshiftColumnCV =\
         readColumnPositions(params, prefix="training_CV_", refFlux=False)
+    chi2sLocal = np.zeros((numObjectsTraining, bandIndicesCV.size))
+
+# The GPs are trained by batches of objects (see PhotozGP.setDataBatch)
+batchSize = 10000
+numBandsCores = numBandsTraining if binaryCores else numBands
+
+
+def trainBatch(firstLoc, batch):
+    """
+    Train the GPs of a batch of objects starting at line firstLoc
+    of the thread, and store their cores and cross-validation chi2s.
+    """
+    Xs, Ys, Yvars, bestTypes, CVs = zip(*batch)
+    cores = np.zeros((len(batch), ),
+                     dtype=gpCoreDtype(numBandsCores, f_mod.shape[0]))
+    gp.setDataBatch(Xs, Ys, Yvars, bestTypes, cores)
+    first = firstLine + firstLoc
+    if binaryCores:
+        coreStore[first:first + len(batch)] = cores
+    else:
+        localData[firstLoc:firstLoc + len(batch), :] =\
+            flattenGPCores(cores, numCol)
+
+    if crossValidate:
+        # predictions on the GP redshift grid, interpolated at z
+        model_mean, model_covar =\
+            gp.predictAndInterpolateBatch(redshiftGridGP, cores)
+        zs = cores['z']
+        p = np.clip(np.searchsorted(redshiftGridGP, zs) - 1,
+                    0, redshiftGridGP.size - 2)
+        w = np.clip((zs - redshiftGridGP[p]) /
+                    (redshiftGridGP[p+1] - redshiftGridGP[p]), 0, 1)[:, None]
+        obj = np.arange(len(batch))
+        model_mean = (1 - w) * model_mean[p, obj, :] +\
+            w * model_mean[p+1, obj, :]
+        model_covar = (1 - w) * model_covar[p, obj, :] +\
+            w * model_covar[p+1, obj, :]
+        for i, (bandsCV, fluxesCV, fluxesVarCV) in enumerate(CVs):
+            ind = np.array([list(bandIndicesCV).index(b) for b in bandsCV])
+            bCV = gp.compactIndex[bandsCV]
+            chi2sLocal[first + i, ind] =\
+                - 0.5 * (model_mean[i, bCV] - fluxesCV)**2 /\
+                (model_covar[i, bCV] + fluxesVarCV)
 
+
+loc = - 1
+batch = []
 for z, normedRefFlux,\
     bands, fluxes, fluxesVar,\
     bandsCV, fluxesCV, fluxesVarCV,\
         X, Y, Yvar in trainingDataIter1:
     loc += 1
 
-    themod = np.zeros((1, f_mod.shape[0], bands.size))
-    for it in range(f_mod.shape[0]):
-        for ib, band in enumerate(bands):
-            themod[0, it, ib] = f_mod[it, band](z)
+    themod = f_mod(z, bands=bands)[None, :, :]
     chi2_grid, ellMLs = scalefree_flux_likelihood(
         fluxes,
         fluxesVar,
@@ -87,28 +143,19 @@ for z, normedRefFlux,\
     ell = ellMLs[0, bestType]
     X[:, 2] = ell
 
-    gp.setData(X, Y, Yvar, bestType)
-    lB = bands.size
-    localData[loc, 0] = lB
-    localData[loc, 1] = z
-    localData[loc, 2] = ell
-    localData[loc, 3:3+lB] = bands
-    localData[loc, 3+lB:3+f_mod.shape[0]+lB+lB*(lB+1)//2+lB] = gp.getCore()
-
-    if crossValidate:
-        model_mean, model_covar\
-            = gp.predictAndInterpolate(np.array([z]), ell=ell)
-        if chi2sLocal is None:
-            chi2sLocal = np.zeros((numObjectsTraining, bandIndicesCV.size))
-        ind = np.array([list(bandIndicesCV).index(b) for b in bandsCV])
-        chi2sLocal[firstLine + loc, ind] =\
-            - 0.5 * (model_mean[0, bandsCV] - fluxesCV)**2 /\
-            (model_covar[0, bandsCV] + fluxesVarCV)
+    batch.append((X, Y, Yvar, bestType, (bandsCV, fluxesCV, fluxesVarCV)))
+    if len(batch) == batchSize:
+        trainBatch(loc + 1 - len(batch), batch)
+        batch = []
+if len(batch) > 0:
+    trainBatch(loc + 1 - len(batch), batch)
 
 
 # use MPI to get the totals
+if binaryCores:
+    coreStore.flush()
 comm.Barrier()
-if threadNum == 0:
+if threadNum == 0 and not binaryCores:
     reducedData = np.zeros((numObjectsTraining, numCol))
 else:
     reducedData = None
@@ -127,10 +174,13 @@ sendcounts = tuple([(lastLines[k] - firstLines[k]) * numCol
 displacements = tuple([firstLines[k] * numCol
                        for k in range(numThreads)])
 
-comm.Gatherv(localData, [reducedData, sendcounts, displacements, MPI.DOUBLE])
+if not binaryCores:
+    comm.Gatherv(localData,
+                 [reducedData, sendcounts, displacements, MPI.DOUBLE])
 comm.Barrier()
 
 if threadNum == 0:
-    np.savetxt(params['training_paramFile'], reducedData, fmt=fmt)
+    if not binaryCores:
+        np.savetxt(params['training_paramFile'], reducedData, fmt=fmt)
     if crossValidate:
         np.savetxt(params['training_CVfile'], chi2sGlobal)
@@ -26,20 +26,17 @@ dir_seds = params['templates_directory']
 dir_filters = params['bands_directory']
 lambdaRef = params['lambdaRef']
 sed_names = params['templates_names']
-f_mod_grid = np.zeros((redshiftGrid.size, len(sed_names),
-                       len(params['bandNames'])))
-for t, sed_name in enumerate(sed_names):
-    f_mod_grid[:, t, :] = np.loadtxt(dir_seds + '/' + sed_name +
-                                     '_fluxredshiftmod.txt')
+f_mod_grid = readTemplateFluxGrid(params)
 
 numZbins = redshiftDistGrid.size - 1
 numZ = redshiftGrid.size
 numConfLevels = len(params['confidenceLevels'])
-numObjectsTraining = np.sum(1 for line in open(params['training_catFile']))
-numObjectsTarget = np.sum(1 for line in open(params['target_catFile']))
+numObjectsTraining = getNumberOfLines(params['training_catFile'])
+numObjectsTarget = getNumberOfLines(params['target_catFile'])
 print('Number of Training Objects', numObjectsTraining)
 print('Number of Target Objects', numObjectsTarget)
 
+gridCache = getKernelGridCache(params)
 for ellPriorSigma in [1.0, 10.0]:
     alpha_C = 1e3
     alpha_L = 1e2
@@ -49,14 +46,16 @@ for ellPriorSigma in [1.0, 10.0]:
         bandCoefAmplitudes, bandCoefPositions, bandCoefWidths,
         params['lines_pos'], params['lines_width'],
         V_C, V_L, alpha_C, alpha_L,
-        redshiftGridGP, use_interpolators=True)
+        redshiftGridGP, use_interpolators=True,
+        gridCache=gridCache, bands=readBandSubset(params),
+        gridDtype=params.get('kernelGridDtype', 'float64'))
 
     for extraFracFluxError in [1e-2]:
         redshifts = np.zeros((numObjectsTraining, ))
         bestTypes = np.zeros((numObjectsTraining, ), dtype=int)
         ellMLs = np.zeros((numObjectsTraining, ))
-        model_mean = np.zeros((numZ, numObjectsTraining, numBands))
-        model_covar = np.zeros((numZ, numObjectsTraining, numBands))
+        model_mean = np.zeros((numZ, numObjectsTraining, gp.bands.size))
+        model_covar = np.zeros((numZ, numObjectsTraining, gp.bands.size))
         # params['training_extraFracFluxError'] = extraFracFluxError
         params['target_extraFracFluxError'] = extraFracFluxError
 
@@ -120,8 +119,8 @@ for ellPriorSigma in [1.0, 10.0]:
                         like_grid,
                         model_mean.shape[0], model_mean.shape[1], bands.size,
                         fluxes, fluxesVar,
-                        model_mean[:, :, bands],
-                        V_C*model_covar[:, :, bands],
+                        model_mean[:, :, gp.compactIndex[bands]],
+                        V_C*model_covar[:, :, gp.compactIndex[bands]],
                         ell_hat_z, (ell_hat_z*ellPriorSigma)**2)
                     like_grid *= np.exp(-0.5*((redshiftGrid[:, None] -
                                                redshifts[None, :]) /
@@ -22,7 +22,7 @@ numBands = bandCoefAmplitudes.shape[0]
 redshiftDistGrid, redshiftGrid, redshiftGridGP = createGrids(params)
 f_mod = readSEDs(params)
 
-numObjectsTraining = np.sum(1 for line in open(params['training_catFile']))
+numObjectsTraining = getNumberOfLines(params['training_catFile'])
 print('Number of Training Objects', numObjectsTraining)
 
 gp = PhotozGP(f_mod, bandCoefAmplitudes, bandCoefPositions, bandCoefWidths,
@@ -52,11 +52,7 @@ dir_seds = params['templates_directory']
 dir_filters = params['bands_directory']
 lambdaRef = params['lambdaRef']
 sed_names = params['templates_names']
-f_mod = np.zeros((redshiftGrid.size, len(sed_names),
-                  len(params['bandNames'])))
-for t, sed_name in enumerate(sed_names):
-    f_mod[:, t, :] = np.loadtxt(dir_seds + '/' + sed_name +
-                                '_fluxredshiftmod.txt')
+f_mod = readTemplateFluxGrid(params)
 
 
 loc = - 1
@@ -38,12 +38,9 @@ lambdaRef = params['lambdaRef']
 sed_names = params['templates_names']
 numBands = bandIndices.size
 nt = len(sed_names)
-f_mod = np.zeros((numZ, nt, len(params['bandNames'])))
-for t, sed_name in enumerate(sed_names):
-    f_mod[:, t, :] = np.loadtxt(dir_seds + '/' + sed_name +
-                                '_fluxredshiftmod.txt')
+f_mod = readTemplateFluxGrid(params)
 
-numObjectsTraining = np.sum(1 for line in open(params['training_catFile']))
+numObjectsTraining = getNumberOfLines(params['training_catFile'])
 print('Number of Training Objects', numObjectsTraining)
 numMetrics = 7 + len(params['confidenceLevels'])
 allFluxes = np.zeros((numObjectsTraining, numBands))
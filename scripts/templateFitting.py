@@ -56,15 +56,13 @@ sed_names = params['templates_names']
 # axis 1 : sed names
 # axis 2 : band names
 
-f_mod = np.zeros((redshiftGrid.size, len(sed_names),
-                  len(params['bandNames'])))
-# loop on SED to load the flux-redshift file from the training
-# ture data or simulated by simulateWithSEDs.py
-for t, sed_name in enumerate(sed_names):
-    f_mod[:, t, :] = np.loadtxt(dir_seds + '/' + sed_name +
-                                '_fluxredshiftmod.txt')
+# template flux table from the flux-redshift files (or the model bundle)
+# of the training ture data or simulated by simulateWithSEDs.py,
+# tabulated on redshiftGrid
+f_mod_table = readSEDs(params)
+f_mod = f_mod_table.fluxes
 
-numObjectsTarget = np.sum(1 for line in open(params['target_catFile']))
+numObjectsTarget = getNumberOfLines(params['target_catFile'])
 
 firstLine = int(threadNum * numObjectsTarget / float(numThreads))
 lastLine = int(min(numObjectsTarget,
@@ -85,8 +83,11 @@ localMetrics = np.zeros((numLines, numMetrics))
 # Now loop over each target galaxy (indexed bu loc index) to compute likelihood function
 # with its flux in each bands
 loc = - 1
+# target blocks are read in the background while the previous one is fitted
+prefetchTimes = {'io': 0., 'wait': 0.}
 trainingDataIter = getDataFromFile(params, firstLine, lastLine,
-                                   prefix="target_", getXY=False)
+                                   prefix="target_", getXY=False,
+                                   prefetch=True, prefetchTimes=prefetchTimes)
 for z, normedRefFlux, bands, fluxes, fluxesVar,\
         bCV, fCV, fvCV in trainingDataIter:
     loc += 1
@@ -125,34 +126,16 @@ for z, normedRefFlux, bands, fluxes, fluxesVar,\
                                     localPDFs[loc, :],
                                     params['confidenceLevels'])
 
-comm.Barrier()
-if threadNum == 0:
-    globalPDFs = np.zeros((numObjectsTarget, numZ))
-    globalMetrics = np.zeros((numObjectsTarget, numMetrics))
-else:
-    globalPDFs = None
-    globalMetrics = None
-
-firstLines = [int(k*numObjectsTarget/numThreads)
-              for k in range(numThreads)]
-lastLines = [int(min(numObjectsTarget, (k+1)*numObjectsTarget/numThreads))
-             for k in range(numThreads)]
-numLines = [lastLines[k] - firstLines[k] for k in range(numThreads)]
-
-sendcounts = tuple([numLines[k] * numZ for k in range(numThreads)])
-displacements = tuple([firstLines[k] * numZ for k in range(numThreads)])
-comm.Gatherv(localPDFs,
-             [globalPDFs, sendcounts, displacements, MPI.DOUBLE])
-
-sendcounts = tuple([numLines[k] * numMetrics for k in range(numThreads)])
-displacements = tuple([firstLines[k] * numMetrics for k in range(numThreads)])
-comm.Gatherv(localMetrics,
-             [globalMetrics, sendcounts, displacements, MPI.DOUBLE])
-
+logger.info('Thread %d: I/O %.2fs, waiting for I/O %.2fs, hidden %.2fs'
+            % (threadNum, prefetchTimes['io'], prefetchTimes['wait'],
+               max(0., prefetchTimes['io'] - prefetchTimes['wait'])))
 comm.Barrier()
 
-if threadNum == 0:
-    fmt = '%.2e'
-    np.savetxt(params['redshiftpdfFileTemp'], globalPDFs, fmt=fmt)
-    if redshiftColumn >= 0:
-        np.savetxt(params['metricsFileTemp'], globalMetrics, fmt=fmt)
+# each process writes its own slab of rows (gathered for text files)
+fmt = '%.2e'
+writePDFSlabs(params['redshiftpdfFileTemp'], localPDFs,
+              firstLine, numObjectsTarget, comm, codec=params['pdfCodec'],
+              threshold=params['pdfSparseThreshold'], fmt=fmt)
+if redshiftColumn >= 0:
+    writeRowSlabs(params['metricsFileTemp'], localMetrics,
+                  firstLine, numObjectsTarget, comm, fmt=fmt)
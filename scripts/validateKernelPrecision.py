@@ -0,0 +1,81 @@
+##################################################################################################
+#
+# script : validateKernelPrecision.py
+#
+# compare the GP flux predictions obtained with float32 kernel grids (kernelGridDtype: float32)
+# to the float64 ones, on the first training objects of a given parameter file.
+#
+# input : parameter file, optionally the number of training objects to use (default 100)
+# output : grid memory, timings, and maximum relative errors of the predicted
+# flux means and variances printed on screen
+##################################################################################################
+
+import sys
+from delight.io import *
+from delight.utils import *
+from delight.photoz_gp import PhotozGP
+from time import time
+
+logger = logging.getLogger(__name__)
+coloredlogs.install(level='DEBUG', logger=logger,fmt='%(asctime)s,%(msecs)03d %(programname)s, %(name)s[%(process)d] %(levelname)s %(message)s')
+
+if len(sys.argv) < 2:
+    raise Exception('Please provide a parameter file')
+params = parseParamFile(sys.argv[1], verbose=False)
+numObjects = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+numObjects = min(numObjects, getNumberOfLines(params['training_catFile']))
+
+logger.info("--- Validate float32 kernel grids on " + sys.argv[1] + " ---")
+
+bandCoefAmplitudes, bandCoefPositions, bandCoefWidths, norms\
+    = readBandCoefficients(params)
+redshiftDistGrid, redshiftGrid, redshiftGridGP = createGrids(params)
+f_mod = readSEDs(params)
+
+gps, buildTimes = {}, {}
+for dtype in ['float64', 'float32']:
+    t1 = time()
+    gps[dtype] = PhotozGP(f_mod, bandCoefAmplitudes, bandCoefPositions,
+                          bandCoefWidths,
+                          params['lines_pos'], params['lines_width'],
+                          params['V_C'], params['V_L'],
+                          params['alpha_C'], params['alpha_L'],
+                          redshiftGridGP, use_interpolators=True,
+                          bands=readBandSubset(params), gridDtype=dtype)
+    buildTimes[dtype] = time() - t1
+
+predictTimes = {'float64': 0., 'float32': 0.}
+maxErrMean, maxErrVar = 0., 0.
+trainingDataIter = getDataFromFile(params, 0, numObjects,
+                                   prefix="training_", getXY=True)
+for z, normedRefFlux, bands, fluxes, fluxesVar,\
+        bandsCV, fluxesCV, fluxesVarCV, X, Y, Yvar in trainingDataIter:
+    themod = f_mod(z, bands=bands)[None, :, :]
+    chi2_grid, ellMLs = scalefree_flux_likelihood(fluxes, fluxesVar, themod,
+                                                  returnChi2=True)
+    bestType = np.argmin(chi2_grid)
+    ell = ellMLs[0, bestType]
+    X[:, 2] = ell
+    predictions = {}
+    for dtype, gp in gps.items():
+        t1 = time()
+        gp.setData(X, Y, Yvar, bestType)
+        predictions[dtype] = gp.predictAndInterpolate(redshiftGrid, ell=ell)
+        predictTimes[dtype] += time() - t1
+    (mean64, var64), (mean32, var32) =\
+        predictions['float64'], predictions['float32']
+    maxErrMean = max(maxErrMean, np.max(np.abs(mean32 - mean64) /
+                                        np.abs(mean64).max(axis=0)))
+    maxErrVar = max(maxErrVar, np.max(np.abs(var32 - var64) /
+                                      np.abs(var64)))
+
+print('%-8s %14s %10s %12s' % ('dtype', 'grid bytes', 'build(s)',
+                               'predict(s)'))
+for dtype, gp in gps.items():
+    gridBytes = gp.kernel.KC_grid.nbytes + gp.kernel.KL_grid.nbytes
+    print('%-8s %14d %10.3f %12.3f' % (dtype, gridBytes, buildTimes[dtype],
+                                       predictTimes[dtype]))
+print('Objects:', numObjects)
+print('Max relative error of the flux means (w.r.t. the peak of each band):',
+      '%.2e' % maxErrMean)
+print('Max relative error of the flux variances:', '%.2e' % maxErrVar)
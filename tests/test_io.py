@@ -22,3 +22,204 @@ def test_readBandCoefficients():
 def test_readColumnPositions():
     params = parseParamFile(paramFile, verbose=False)
     out = readColumnPositions(params)
+
+
+def test_readBandSubset():
+    params = parseParamFile(paramFile, verbose=False)
+    bands = readBandSubset(params)
+    for prefix in ['training_', 'target_']:
+        bandIndices = readColumnPositions(params, prefix=prefix)[0]
+        assert np.all(np.in1d(bandIndices, bands))
+    assert np.all(np.diff(bands) > 0)
+
+
+def test_columnarCatalog(tmpdir):
+    params = parseParamFile(paramFile, verbose=False)
+    bandOrders = [params['training_bandOrder'],
+                  params['training_CV_bandOrder']]
+    outDir = convertCatalogToColumns(params['training_catFile'], bandOrders,
+                                     str(tmpdir.join('cat_columns')),
+                                     chunkSize=300)
+    assert isColumnarCatalog(outDir)
+    assert getNumberOfLines(outDir) ==\
+        getNumberOfLines(params['training_catFile'])
+    textIter = getDataFromFile(params, 10, 500, prefix="training_",
+                               getXY=True, CV=True)
+    params['training_catFile'] = outDir
+    binaryIter = getDataFromFile(params, 10, 500, prefix="training_",
+                                 getXY=True, CV=True)
+    for res1, res2 in zip(textIter, binaryIter):
+        for v1, v2 in zip(res1, res2):
+            np.testing.assert_allclose(v1, v2)
+
+
+def test_getDataBlockFromFile():
+    params = parseParamFile(paramFile, verbose=False)
+    z, normedRefFlux, ell, fluxes, fluxesVar, mask, valid,\
+        fluxesCV, fluxesCVVar, maskCV =\
+        getDataBlockFromFile(params, 0, 200, prefix="training_", CV=True)
+    numBands = mask.shape[1]
+    assert fluxes.shape == (z.size, numBands)
+    assert fluxesVar.shape == (z.size, numBands)
+    dataIter = getDataFromFile(params, 0, 200, prefix="training_",
+                               getXY=False, CV=True, chunkSize=64)
+    for o, res in zip(np.where(valid)[0], dataIter):
+        np.testing.assert_allclose(res[0], z[o])
+        np.testing.assert_allclose(res[1], normedRefFlux[o])
+        np.testing.assert_allclose(res[3], fluxes[o, mask[o]])
+        np.testing.assert_allclose(res[4], fluxesVar[o, mask[o]])
+        np.testing.assert_allclose(res[6], fluxesCV[o, maskCV[o]])
+        np.testing.assert_allclose(res[7], fluxesCVVar[o, maskCV[o]])
+
+
+def test_rowIndex(tmpdir):
+    fname = str(tmpdir.join('rows.txt'))
+    lines = [' '.join(['%d' % (i*j) for j in range(i % 5 + 1)])
+             for i in range(57)]
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines))
+    assert getNumberOfLines(fname) == len(lines)
+    assert os.path.isfile(rowIndexFileName(fname))
+    for firstLine, lastLine in [(0, 10), (13, 40), (50, 100), (60, 70)]:
+        res = [line.rstrip('\n')
+               for line in iterFileLines(fname, firstLine, lastLine)]
+        assert res == lines[firstLine:lastLine]
+    # the index must be rebuilt when the file changes
+    with open(fname, 'a') as f:
+        f.write('\n1 2 3\n')
+    assert getNumberOfLines(fname) == len(lines) + 1
+    res = list(iterFileLines(fname, len(lines), len(lines) + 1))
+    assert res == ['1 2 3\n']
+
+
+def test_rowSlabs(tmpdir):
+    pdfs = np.random.uniform(size=(23, 7))
+    indices = np.random.randint(0, 100, size=(23, 3))
+    for ext in ['.txt', '.npy']:
+        fname = str(tmpdir.join('pdfs' + ext))
+        fnameI = str(tmpdir.join('indices' + ext))
+        writeRowSlabs(fname, pdfs, 0, pdfs.shape[0])
+        writeRowSlabs(fnameI, indices, 0, indices.shape[0], fmt='%i')
+        assert getNumberOfLines(fname) == pdfs.shape[0]
+        for firstLine, lastLine in [(0, 23), (5, 12), (20, 30)]:
+            res = readRowRange(fname, firstLine, lastLine)
+            np.testing.assert_allclose(res, pdfs[firstLine:lastLine],
+                                       rtol=1e-2)
+            res = readRowRange(fnameI, firstLine, lastLine, dtype=int)
+            assert np.all(res == indices[firstLine:lastLine])
+
+
+def test_modelBundle(tmpdir):
+    params = parseParamFile(paramFile, verbose=False)
+    bundleDir = str(tmpdir.join('bundle'))
+    bundleHash = buildModelBundle(params, bundleDir)
+    assert isModelBundle(bundleDir)
+    params2 = parseParamFile(bundleDir, verbose=False)
+    assert params2['modelBundleHash'] == bundleHash
+    for k, v in params.items():
+        if isinstance(v, np.ndarray):
+            np.testing.assert_allclose(v, params2[k])
+        else:
+            assert v == params2[k]
+    for v1, v2 in zip(readBandCoefficients(params),
+                      readBandCoefficients(params2)):
+        np.testing.assert_allclose(v1, v2)
+    for v1, v2 in zip(createGrids(params), createGrids(params2)):
+        np.testing.assert_allclose(v1, v2)
+    np.testing.assert_allclose(readTemplateFluxGrid(params),
+                               readTemplateFluxGrid(params2))
+    loadModelBundle(bundleDir, checkHash=True)
+    # a bundle rebuilt from a bundle is the same model
+    assert buildModelBundle(params2, str(tmpdir.join('bundle2')))\
+        == bundleHash
+
+
+def test_pdfCodecs(tmpdir):
+    numZ = 50
+    redshiftGrid = np.linspace(0, 2, numZ)
+    zs = np.random.uniform(0.2, 1.8, 31)
+    pdfs = np.exp(-0.5*((redshiftGrid[None, :] - zs[:, None])/0.1)**2)\
+        * np.random.uniform(1e-5, 1e5, zs.size)[:, None]
+    pdfs[3, :] = 0
+    for codec, tol in [('float16', 1e-3), ('uint16', 1e-4),
+                       ('uint8', 3e-3), ('sparse', 2e-3)]:
+        fname = str(tmpdir.join('pdfs-' + codec))
+        writePDFSlabs(fname, pdfs, 0, pdfs.shape[0], codec=codec)
+        assert isPDFCodecFile(fname)
+        assert getNumberOfLines(fname) == pdfs.shape[0]
+        for firstLine, lastLine in [(0, 31), (5, 25), (28, 40)]:
+            res = readPDFRows(fname, firstLine, lastLine)
+            ref = pdfs[firstLine:lastLine]
+            assert res.shape == ref.shape
+            assert np.all(np.abs(res - ref) <=
+                          tol * ref.max(axis=1)[:, None])
+
+
+def test_benchmarkPDFCodecs(tmpdir):
+    """Smoke run of the PDF codec benchmark on a few PDFs"""
+    import subprocess
+    import sys
+    params = parseParamFile(paramFile, verbose=False)
+    redshiftDistGrid, redshiftGrid, redshiftGridGP = createGrids(params)
+    zs = np.random.uniform(0.2, 1.4, 10)
+    pdfs = np.exp(-0.5*((redshiftGrid[None, :] - zs[:, None])/0.1)**2)
+    pdfFile = str(tmpdir.join('pdfs.txt'))
+    np.savetxt(pdfFile, pdfs)
+    res = subprocess.run([sys.executable, 'scripts/benchmarkPDFCodecs.py',
+                          paramFile, pdfFile],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    assert res.returncode == 0, res.stderr
+    for codec in PDF_CODECS:
+        assert codec in res.stdout
+
+
+def test_rowSlabWriter(tmpdir):
+    pdfs = np.random.uniform(size=(23, 7))
+    for ext, codec in [('.txt', 'text'), ('.npy', 'text'),
+                       ('', 'uint16'), ('', 'sparse')]:
+        fname = str(tmpdir.join('pdfs-' + codec + ext))
+        writer = RowSlabWriter(fname, pdfs.shape, 0, pdfs.shape[0],
+                               codec=codec, threshold=0.5)
+        for first in range(0, pdfs.shape[0], 5):
+            writer.write(pdfs[first:first+5])
+        writer.close()
+        for root, dirs, files in os.walk(str(tmpdir)):
+            assert not [name for name in files if '.part' in name]
+        res = readPDFRows(fname, 0, pdfs.shape[0])
+        if codec == 'sparse':
+            ref = np.where(pdfs >= 0.5 * pdfs.max(axis=1)[:, None], pdfs, 0)
+        else:
+            ref = pdfs
+        np.testing.assert_allclose(res, ref, rtol=1e-2, atol=1e-4)
+
+
+def test_blockPrefetcher():
+    params = parseParamFile(paramFile, verbose=False)
+    times = {}
+    iter1 = getDataFromFile(params, 0, 100, prefix="training_", chunkSize=16)
+    iter2 = getDataFromFile(params, 0, 100, prefix="training_", chunkSize=16,
+                            prefetch=True, prefetchTimes=times)
+    numObjects = 0
+    for res1, res2 in zip(iter1, iter2):
+        numObjects += 1
+        for v1, v2 in zip(res1, res2):
+            if v1 is not None:
+                np.testing.assert_allclose(v1, v2)
+    assert numObjects > 0
+    iter2.close()
+    assert times['io'] >= 0 and times['wait'] >= 0
+    # exceptions are raised in the consuming thread
+    prefetcher = BlockPrefetcher((1/x for x in [1., 2., 0.]))
+    assert next(prefetcher) == 1
+    assert next(prefetcher) == 0.5
+    try:
+        next(prefetcher)
+        assert False
+    except ZeroDivisionError:
+        pass
+    # stopping early does not leave the thread running
+    prefetcher = BlockPrefetcher(iter(range(100)), numBuffered=1)
+    next(prefetcher)
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
@@ -4,7 +4,7 @@ import pytest
 import numpy as np
 from scipy.interpolate import interp1d
 
-from delight.photoz_gp import PhotozGP
+from delight.photoz_gp import PhotozGP, PhotozGP_SN
 from delight.photoz_kernels import Photoz_mean_function, Photoz_kernel
 from delight.utils import *
 
@@ -61,3 +61,236 @@ def test_create_gp(use_interpolators):
         gp.optimizeHyperparamaters()
 
     return gp
+
+
+def test_margLikeGradients():
+    """Analytic marglike gradients against numerical derivatives"""
+    redshiftGrid = np.logspace(-2, np.log10(4), num=numZ)
+    gp = PhotozGP(
+        numTemplates,
+        fcoefs_amp, fcoefs_mu, fcoefs_sig,
+        lines_mu, lines_sig,
+        var_C, var_L, alpha_C, alpha_L,
+        redshiftGrid, use_interpolators=False)
+    gp.kernel.grad_needed = True
+    # scale the luminosities so that the kernel and noise are comparable
+    Xs = 1*X
+    gp.setData(Xs, Y, Yvar)
+    Xs[:, 2] *= np.sqrt(np.mean(Yvar) / np.mean(np.diag(gp.KXX)))
+    gp.setData(Xs, Y, Yvar)
+
+    def fun(pars):
+        gp.kernel.var_C, gp.kernel.var_L,\
+            gp.kernel.alpha_C, gp.kernel.alpha_L = pars
+        gp.setData(Xs, Y, Yvar)
+        return gp.margLike()
+
+    def fun_grad(pars):
+        fun(pars)
+        return gp.margLikeGradients()
+
+    # components far below the largest one (typically the line ones)
+    # are dominated by the noise of the numerical derivatives
+    pars = np.array([var_C, var_L, alpha_C, alpha_L])
+    lim = 1e-8 * np.abs(fun_grad(pars)).max()
+    derivative_test(pars, fun, fun_grad, 1e-3, lim=lim)
+
+    def fun(pars):
+        return gp.updateHyperparamatersAndReturnMarglike(pars)
+
+    def fun_grad(pars):
+        return gp.updateHyperparamatersAndReturnMarglike(pars, True)[1]
+
+    pars = np.array([var_C, alpha_C])
+    lim = 1e-8 * np.abs(fun_grad(pars)).max()
+    derivative_test(pars, fun, fun_grad, 1e-3, lim=lim)
+
+
+def test_SN_kronecker():
+    """Kronecker solve of light curves against the dense one"""
+    numEpochs = 12
+    redshiftGrid = np.logspace(-2, np.log10(4), num=numZ)
+    gp = PhotozGP_SN(
+        fcoefs_amp, fcoefs_mu, fcoefs_sig,
+        lines_mu, lines_sig,
+        var_C, var_L, 0.1, alpha_C, alpha_L,
+        redshiftGrid, use_interpolators=False)
+    # band-major light curve, observed in all bands at shared epochs
+    times = np.sort(np.random.uniform(0, 1, numEpochs))
+    X = np.zeros((numBands * numEpochs, 4))
+    X[:, 0] = np.repeat(np.arange(numBands), numEpochs)
+    X[:, 1] = 0.5
+    X[:, 2] = 1.0
+    X[:, 3] = np.tile(times, numBands)
+    gp.setData(X, np.ones((X.shape[0], 1)), np.ones((X.shape[0], 1)),
+               structured=False)
+    X[:, 2] *= np.sqrt(0.1 / np.mean(np.diag(gp.KXX)))
+    Y = np.random.uniform(low=0.5, high=1., size=(X.shape[0], 1))
+    bandVar = np.random.uniform(low=0.05, high=0.1, size=numBands)
+    Yvar = bandVar[X[:, 0].astype(int)][:, None]
+    x_pred = np.zeros((7, 4))
+    x_pred[:, 0] = np.random.randint(numBands, size=7)
+    x_pred[:, 1:3] = X[0, 1:3]
+    x_pred[:, 3] = np.random.uniform(0, 1, 7)
+
+    perm = np.random.permutation(X.shape[0])
+    gp.setData(X[perm, :], Y[perm, :], Yvar[perm, :])
+    assert gp.kron is not None
+    margLike, beta = gp.margLike(), gp.beta[np.argsort(perm)]
+    y_pred, y_pred_cov = gp.predict(x_pred, diag=False)
+
+    gp.setData(X, Y, Yvar, structured=False)
+    assert gp.kron is None
+    # with lines, the Kronecker log determinant is that of the kernel
+    # symmetrized from its lower triangle, the dense one that of the
+    # slightly asymmetric kernel
+    assert np.allclose(margLike, gp.margLike(), rtol=1e-6, atol=0)
+    assert np.allclose(beta, gp.beta, rtol=1e-6, atol=1e-8)
+    y_pred2, y_pred_cov2 = gp.predict(x_pred, diag=False)
+    assert np.allclose(y_pred, y_pred2, rtol=1e-6, atol=1e-8)
+    assert np.allclose(y_pred_cov, y_pred_cov2, rtol=1e-6, atol=1e-8)
+
+    # without lines the kernel is symmetric and both agree to rounding
+    gp.kernel.var_L = 0
+    margLikes = [gp.margLikeBatch([X], [Y], [Yvar], structured=structured)[0]
+                 for structured in [True, False]]
+    assert np.allclose(margLikes[0], margLikes[1], rtol=1e-12, atol=0)
+    gp.kernel.var_L = var_L
+
+    # noise that does not factorize, and missing observations
+    gp.setData(X, Y, Yvar * np.random.uniform(1, 2, size=Yvar.shape))
+    assert gp.kron is None
+    Xs, Ys, Yvars = [X, X[1:, :]], [Y, Y[1:, :]], [Yvar, Yvar[1:, :]]
+    # light curves at other redshifts, epochs and noise
+    for i in range(4):
+        X2 = 1 * X
+        X2[:, 1] = np.random.uniform(0.1, 1.0)
+        if i == 3:
+            X2[:, 3] = np.tile(np.sort(np.random.uniform(0, 1, numEpochs)),
+                               numBands)
+        Xs.append(X2[perm, :])
+        Ys.append(np.random.uniform(low=0.5, high=1., size=Y.shape)[perm, :])
+        Yvars.append((Yvar if i < 2 else 2 * Yvar)[perm, :])
+    margLikes = gp.margLikeBatch(Xs, Ys, Yvars)
+    assert gp.kron is None and gp.X is X
+    assert np.allclose(margLikes[0], margLike, rtol=1e-8, atol=0)
+    for X2, Y2, Yvar2, margLike2 in zip(Xs, Ys, Yvars, margLikes):
+        gp.setData(X2, Y2, Yvar2)
+        assert np.allclose(margLike2, gp.margLike(), rtol=1e-10, atol=0)
+
+
+def test_gp_core_store(tmpdir):
+    """Cores read from a binary store must give the same predictions"""
+    from delight.io import createGPCoreStore, openGPCoreStore, writeGPCore
+    redshiftGrid = np.logspace(-2, np.log10(4), num=numZ)
+    gp = PhotozGP(
+        numTemplates,
+        fcoefs_amp, fcoefs_mu, fcoefs_sig,
+        lines_mu, lines_sig,
+        var_C, var_L, alpha_C, alpha_L,
+        redshiftGrid, use_interpolators=True)
+    X2 = 1*X
+    X2[:, 0] = np.arange(nObj) % numBands
+    X2[:, 1:3] = X[0, 1:3]
+    gp.setData(X2, Y, Yvar)
+    mean1, var1 = gp.predictAndInterpolate(redshiftGrid, ell=X2[0, 2])
+
+    fname = str(tmpdir.join('cores.npy'))
+    store = createGPCoreStore(fname, 3, nObj + 1, numTemplates)
+    writeGPCore(store, 1, X2[0, 1], X2[0, 2], X2[:, 0],
+                gp.betas, gp.L, gp.D, gp.beta)
+    store.flush()
+    core = openGPCoreStore(fname)[1]
+    B = int(core['B'])
+    gp.setCore(X2, B, numTemplates, core)
+    mean2, var2 = gp.predictAndInterpolate(redshiftGrid, ell=X2[0, 2])
+    np.testing.assert_allclose(mean1, mean2)
+    np.testing.assert_allclose(var1, var2)
+    np.testing.assert_allclose(gp.beta, core['beta'][:B, None])
+
+
+def test_predictAndInterpolateBatch():
+    """Batched predictions must match the object by object ones"""
+    from delight.io import gpCoreDtype, writeGPCore
+    redshiftGrid = np.logspace(-2, np.log10(4), num=numZ)
+    f_mod_interp = np.zeros((numTemplates, numBands), dtype=object)
+    for it in range(numTemplates):
+        for jf in range(numBands):
+            f_mod_interp[it, jf] = interp1d(redshiftGrid,
+                                            np.random.randn(numZ),
+                                            kind='linear')
+    gp = PhotozGP(
+        f_mod_interp,
+        fcoefs_amp, fcoefs_mu, fcoefs_sig,
+        lines_mu, lines_sig,
+        var_C, var_L, alpha_C, alpha_L,
+        redshiftGrid, use_interpolators=True)
+    redshiftGridFine = np.linspace(redshiftGrid[0], redshiftGrid[-1], 33)
+    numCores = 6
+    cores = np.zeros((numCores, ), dtype=gpCoreDtype(numBands, numTemplates))
+    means, variances = [], []
+    for n in range(numCores):
+        B = 1 + n % numBands
+        X2 = np.zeros((B, 3))
+        X2[:, 0] = np.random.permutation(numBands)[:B]
+        X2[:, 1] = np.random.uniform(0.1, 3.0)
+        X2[:, 2] = np.random.uniform(0.5, 1.0) * 1e6
+        Y2 = np.random.uniform(low=0.5, high=1., size=(B, 1))
+        Yvar2 = np.random.uniform(low=0.05, high=0.1, size=(B, 1))
+        gp.setData(X2, Y2, Yvar2, np.random.randint(numTemplates))
+        writeGPCore(cores, n, X2[0, 1], X2[0, 2], X2[:, 0],
+                    gp.betas, gp.L, gp.D, gp.beta)
+        mean, var = gp.predictAndInterpolate(redshiftGridFine, ell=X2[0, 2])
+        means.append(mean)
+        variances.append(var)
+
+    model_mean, model_var =\
+        gp.predictAndInterpolateBatch(redshiftGridFine, cores)
+    assert model_mean.shape == (redshiftGridFine.size, numCores, numBands)
+    np.testing.assert_allclose(model_mean, np.stack(means, axis=1),
+                               rtol=1e-8)
+    np.testing.assert_allclose(model_var, np.stack(variances, axis=1),
+                               rtol=1e-8)
+
+
+def test_setDataBatch(use_interpolators):
+    """Batched training must give the cores of setData"""
+    from delight.io import gpCoreDtype, writeGPCore
+    redshiftGrid = np.logspace(-2, np.log10(4), num=numZ)
+    f_mod_interp = np.zeros((numTemplates, numBands), dtype=object)
+    for it in range(numTemplates):
+        for jf in range(numBands):
+            f_mod_interp[it, jf] = interp1d(redshiftGrid,
+                                            np.random.randn(numZ),
+                                            kind='linear')
+    gp = PhotozGP(
+        f_mod_interp,
+        fcoefs_amp, fcoefs_mu, fcoefs_sig,
+        lines_mu, lines_sig,
+        var_C, var_L, alpha_C, alpha_L,
+        redshiftGrid, use_interpolators=use_interpolators)
+    numObjects = 7
+    Xs, Ys, Yvars = [], [], []
+    bestTypes = np.random.randint(numTemplates, size=numObjects)
+    cores1 = np.zeros((numObjects, ), dtype=gpCoreDtype(numBands,
+                                                        numTemplates))
+    logdets1 = np.zeros((numObjects, ))
+    for n in range(numObjects):
+        B = 1 + n % numBands
+        X2 = np.zeros((B, 3))
+        X2[:, 0] = np.random.permutation(numBands)[:B]
+        X2[:, 1] = np.random.uniform(0.1, 3.0)
+        X2[:, 2] = np.random.uniform(0.5, 1.0) * 1e6
+        Xs.append(X2)
+        Ys.append(np.random.uniform(low=0.5, high=1., size=(B, 1)))
+        Yvars.append(np.random.uniform(low=0.05, high=0.1, size=(B, 1)))
+        gp.setData(X2, Ys[-1], Yvars[-1], bestTypes[n])
+        writeGPCore(cores1, n, X2[0, 1], X2[0, 2], X2[:, 0],
+                    gp.betas, gp.L, gp.D, gp.beta)
+        logdets1[n] = gp.logdet
+
+    cores2 = np.zeros_like(cores1)
+    logdets2 = gp.setDataBatch(Xs, Ys, Yvars, bestTypes, cores2)
+    np.testing.assert_allclose(logdets2, logdets1, rtol=1e-8)
+    for name in cores1.dtype.names:
+        np.testing.assert_allclose(cores2[name], cores1[name], rtol=1e-8)
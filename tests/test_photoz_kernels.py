@@ -2,9 +2,12 @@
 """Test routines from photoz_kernels.py"""
 
 import numpy as np
+import os
+import pytest
 from delight.utils import *
 from delight.photoz_kernels_cy import kernelparts, kernelparts_diag
-from delight.photoz_kernels import Photoz_mean_function, Photoz_kernel
+from delight.photoz_kernels import Photoz_mean_function, Photoz_kernel,\
+    Photoz_linear_sed_basis, KernelGridCache
 
 size = 5
 NREPEAT = 2
@@ -80,7 +83,7 @@ def test_interpolation():
 
         kern = Photoz_kernel(fcoefs_amp, fcoefs_mu, fcoefs_sig,
                              lines_mu, lines_sig, var_C, var_L,
-                             alpha_C, alpha_L, alpha_T)
+                             alpha_C, alpha_L, alpha_T, grad_needed=True)
 
         for j in range(numBands):
 
@@ -119,3 +122,195 @@ def test_interpolation():
                                rtol=relative_accuracy)
             assert np.allclose(D_alpha_L, kern.D_alpha_L,
                                rtol=relative_accuracy)
+
+
+def test_kernelGridCache(tmpdir):
+    """Check that cached kernel grids are reused, and evicted when full"""
+    fcoefs_amp, fcoefs_mu, fcoefs_sig = random_filtercoefs(numBands, numCoefs)
+    lines_mu, lines_sig = random_linecoefs(numLines)
+    var_C, var_L, alpha_C, alpha_L, alpha_T = random_hyperparams()
+    redshiftGrid = np.logspace(-2, np.log10(3), 40)
+    cache = KernelGridCache(str(tmpdir.join('cache')))
+
+    def kernel(alpha_C, grad_needed=False, gridCache=cache):
+        return Photoz_kernel(fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                             lines_mu, lines_sig, var_C, var_L,
+                             alpha_C, alpha_L, redshiftGrid=redshiftGrid,
+                             grad_needed=grad_needed, gridCache=gridCache)
+
+    kern1 = kernel(alpha_C)
+    key = cache.key(kern1)
+    assert os.path.isfile(cache.fileName(key))
+    kern2 = kernel(alpha_C)
+    kern3 = kernel(alpha_C, gridCache=None)
+    X = random_X_bzl(size, numBands=numBands, redshiftMax=2.0)
+    assert np.allclose(kern2.K(X), kern3.K(X), rtol=1e-10, atol=0)
+    assert np.allclose(kern2.Kdiag(X), kern3.Kdiag(X), rtol=1e-10, atol=0)
+
+    kern4 = kernel(alpha_C, grad_needed=True)
+    assert cache.key(kern4) != key
+    kern4.update_kernelparts(X)
+    kern3.grad_needed = True
+    kern3.construct_interpolators()
+    kern3.update_kernelparts(X)
+    assert np.allclose(kern4.D_alpha_C, kern3.D_alpha_C, rtol=1e-10, atol=0)
+
+    # Only the most recent entry fits: the others are evicted.
+    cache.maxSize = os.path.getsize(cache.fileName(key)) + 1
+    kern5 = kernel(2 * alpha_C)
+    files = os.listdir(cache.cacheDir)
+    assert files == [os.path.basename(cache.fileName(cache.key(kern5)))]
+
+
+def test_sharedGrids():
+    """Check that grids in an MPI shared window match private ones"""
+    MPI = pytest.importorskip('mpi4py.MPI')
+    fcoefs_amp, fcoefs_mu, fcoefs_sig = random_filtercoefs(numBands, numCoefs)
+    lines_mu, lines_sig = random_linecoefs(numLines)
+    var_C, var_L, alpha_C, alpha_L, alpha_T = random_hyperparams()
+    redshiftGrid = np.logspace(-2, np.log10(3), 40)
+    kerns = [Photoz_kernel(fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                           lines_mu, lines_sig, var_C, var_L,
+                           alpha_C, alpha_L, redshiftGrid=redshiftGrid,
+                           grad_needed=True, comm=comm)
+             for comm in [None, MPI.COMM_WORLD]]
+    assert kerns[1].sharedWindow is not None
+    X = random_X_bzl(size, numBands=numBands, redshiftMax=2.0)
+    for name in ['KC', 'KL', 'D_alpha_C', 'D_alpha_L']:
+        np.testing.assert_array_equal(getattr(kerns[0], name + '_grid'),
+                                      getattr(kerns[1], name + '_grid'))
+    assert np.allclose(kerns[0].K(X), kerns[1].K(X), rtol=1e-10, atol=0)
+    assert np.allclose(kerns[0].Kdiag(X), kerns[1].Kdiag(X),
+                       rtol=1e-10, atol=0)
+    # Rebuilding replaces the window.
+    kerns[1].alpha_C = 2 * alpha_C
+    kerns[1].construct_interpolators()
+    assert not np.allclose(kerns[0].K(X), kerns[1].K(X), rtol=1e-3, atol=0)
+
+
+def test_bandSubset():
+    """Check that a kernel built for a band subset matches the full one"""
+    numBandsTotal = 4
+    fcoefs_amp, fcoefs_mu, fcoefs_sig =\
+        random_filtercoefs(numBandsTotal, numCoefs)
+    lines_mu, lines_sig = random_linecoefs(numLines)
+    var_C, var_L, alpha_C, alpha_L, alpha_T = random_hyperparams()
+    redshiftGrid = np.logspace(-2, np.log10(3), 40)
+    kerns = [Photoz_kernel(fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                           lines_mu, lines_sig, var_C, var_L,
+                           alpha_C, alpha_L, redshiftGrid=redshiftGrid,
+                           bands=bands)
+             for bands in [None, [3, 1]]]
+    assert kerns[1].numBands == 2 and kerns[1].KC_grid.shape[0] == 2
+    np.testing.assert_array_equal(kerns[1].compactIndex, [-1, 0, -1, 1])
+    X = random_X_bzl(size, numBands=2, redshiftMax=2.0)
+    X[:, 0] = np.where(X[:, 0] == 0, 1, 3)
+    assert np.allclose(kerns[0].K(X), kerns[1].K(X), rtol=1e-10, atol=0)
+    assert np.allclose(kerns[0].Kdiag(X), kerns[1].Kdiag(X),
+                       rtol=1e-10, atol=0)
+    X[0, 0] = 2
+    with pytest.raises(Exception):
+        kerns[1].K(X)
+
+
+def test_gridCrossKernel():
+    """Check the cross kernel at the grid nodes against the interpolated one"""
+    numBandsTotal = 4
+    fcoefs_amp, fcoefs_mu, fcoefs_sig =\
+        random_filtercoefs(numBandsTotal, numCoefs)
+    lines_mu, lines_sig = random_linecoefs(numLines)
+    var_C, var_L, alpha_C, alpha_L, alpha_T = random_hyperparams()
+    redshiftGrid = np.logspace(-2, np.log10(3), 40)
+    kern = Photoz_kernel(fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                         lines_mu, lines_sig, var_C, var_L,
+                         alpha_C, alpha_L, redshiftGrid=redshiftGrid,
+                         bands=[1, 3])
+    X2 = random_X_bzl(3, numBands=numBandsTotal, redshiftMax=2.0)
+    X2[:, 0] = [1, 3, 3]
+    X2[:, 1] = X2[0, 1]
+    X = np.ones((2*redshiftGrid.size, 3))
+    X[:, 0] = np.repeat([1, 3], redshiftGrid.size)
+    X[:, 1] = np.tile(redshiftGrid, 2)
+    X[:, 2] = 2.0
+    K = kern.K(X, X2)
+    assert np.allclose(kern.K_grid(X2, ell=2.0), K,
+                       rtol=1e-10, atol=1e-10*np.abs(K).max())
+
+
+def test_equalRedshiftKernel():
+    """Check the auto kernels of inputs sharing one redshift"""
+    fcoefs_amp, fcoefs_mu, fcoefs_sig = random_filtercoefs(numBands, numCoefs)
+    lines_mu, lines_sig = random_linecoefs(numLines)
+    var_C, var_L, alpha_C, alpha_L, alpha_T = random_hyperparams()
+    redshiftGrid = np.logspace(-2, np.log10(3), 40)
+    kerns = [Photoz_kernel(fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                           lines_mu, lines_sig, var_C, var_L,
+                           alpha_C, alpha_L, redshiftGrid=redshiftGrid,
+                           use_interpolators=use_interpolators)
+             for use_interpolators in [True, False]]
+    # exact on the grid nodes
+    X = np.ones((2*numBands, 3))
+    X[:, 0] = np.tile(np.arange(numBands), 2)
+    X[:, 1] = redshiftGrid[7]
+    K = kerns[1].K(X)
+    assert np.allclose(kerns[0].K(X), K, rtol=1e-10, atol=1e-10*K.max())
+    # the batched kernels match the individual ones
+    Xs = np.ones((10, numBands, 3))
+    Xs[:, :, 0] = np.arange(numBands)
+    Xs[:, :, 1] = np.random.uniform(0.1, 2.0, 10)[:, None]
+    Xs[:, :, 2] = np.random.uniform(0.5, 2.0, (10, numBands))
+    Ks = kerns[0].K_batch(Xs)
+    for i in range(10):
+        K = kerns[0].K(Xs[i])
+        assert np.allclose(Ks[i], K, rtol=1e-12, atol=1e-12*K.max())
+        # auto kernels are detected by value, not by identity
+        np.testing.assert_array_equal(kerns[0].K(Xs[i], Xs[i].copy()), K)
+
+
+def test_float32Grids():
+    """Check that float32 kernel grids give close interpolated kernels"""
+    fcoefs_amp, fcoefs_mu, fcoefs_sig = random_filtercoefs(numBands, numCoefs)
+    lines_mu, lines_sig = random_linecoefs(numLines)
+    var_C, var_L, alpha_C, alpha_L, alpha_T = random_hyperparams()
+    redshiftGrid = np.logspace(-2, np.log10(3), 40)
+    kerns = [Photoz_kernel(fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                           lines_mu, lines_sig, var_C, var_L,
+                           alpha_C, alpha_L, redshiftGrid=redshiftGrid,
+                           gridDtype=dtype)
+             for dtype in [np.float64, np.float32]]
+    assert kerns[1].KC_grid.dtype == np.float32
+    assert kerns[1].KC_grid.nbytes * 2 == kerns[0].KC_grid.nbytes
+    X = random_X_bzl(size, numBands=numBands, redshiftMax=2.0)
+    assert np.allclose(kerns[0].K(X), kerns[1].K(X), rtol=1e-5, atol=0)
+
+
+def test_templateFluxTable():
+    """Check the flux table against interp1d, with extrapolation"""
+    from scipy.interpolate import interp1d
+    nz, nt, nb = 30, 3, 4
+    redshiftGrid = np.sort(np.random.uniform(0.01, 3, nz))
+    fluxes = np.random.uniform(0, 1, size=(nz, nt, nb))
+    table = TemplateFluxTable(redshiftGrid, fluxes)
+    assert table.shape == (nt, nb)
+    z = np.concatenate((np.random.uniform(0, 4, 20), redshiftGrid[:3]))
+    allFluxes = table(z)
+    assert allFluxes.shape == (z.size, nt, nb)
+    b = np.random.randint(0, nb, z.size)
+    perObject = table.evaluate(z, b)
+    for it in range(nt):
+        for ib in range(nb):
+            f = interp1d(redshiftGrid, fluxes[:, it, ib], kind='linear',
+                         bounds_error=False, fill_value='extrapolate')
+            np.testing.assert_allclose(table[it, ib](z), f(z))
+            np.testing.assert_allclose(allFluxes[:, it, ib], f(z))
+            np.testing.assert_allclose(perObject[b == ib, it], f(z[b == ib]))
+
+    mean_fct = Photoz_linear_sed_basis(table)
+    f_mod_interp = np.zeros((nt, nb), dtype=object)
+    for it in range(nt):
+        for ib in range(nb):
+            f_mod_interp[it, ib] = table[it, ib]
+    X = np.vstack((b, z, np.random.uniform(1, 2, z.size))).T
+    np.testing.assert_allclose(
+        mean_fct.f(X, which=[0, 2]),
+        Photoz_linear_sed_basis(f_mod_interp).f(X, which=[0, 2]))
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+from scipy.interpolate import interp1d
 from delight.utils import *
 from delight.photoz_kernels_cy import \
-    kernelparts, kernelparts_diag, kernel_parts_interp
+    kernelparts, kernelparts_diag, kernel_parts_interp, kernelparts_grid,\
+    kernel_parts_interp_diag,\
+    line_kernel_matrices, line_factors
 from delight.utils_cy import find_positions
 
 size = 50
@@ -59,6 +62,66 @@ def test_diagonalOfKernels():
     np.testing.assert_almost_equal(D_alpha_L_diag, np.diag(D_alpha_L))
 
 
+def test_factorizedLineKernel():
+    """
+    Test that the factorized line kernel matches the direct double sum
+    over filter coefficients and lines.
+    """
+    X = random_X_bzl(size, numBands=numBands)
+    fcoefs_amp, fcoefs_mu, fcoefs_sig = random_filtercoefs(numBands, numCoefs)
+    lines_mu, lines_sig = random_linecoefs(numLines)
+    var_C, var_L, alpha_C, alpha_L, alpha_T = random_hyperparams()
+    b1 = X[:, 0].astype(int)
+    fz1 = 1 + X[:, 1]
+
+    KL_direct = np.zeros((size, size))
+    D_alpha_L_direct = np.zeros((size, size))
+    for l1 in range(numLines):
+        for l2 in range(l1 + 1):
+            weight = 2 if l2 < l1 else 1
+            dmul2 = (lines_mu[l1] - lines_mu[l2])**2
+            f1 = np.sum(fcoefs_amp[b1, :] * np.exp(-0.5*(
+                (fcoefs_mu[b1, :] - fz1[:, None]*lines_mu[l1]) /
+                fcoefs_sig[b1, :])**2), axis=1)
+            f2 = np.sum(fcoefs_amp[b1, :] * np.exp(-0.5*(
+                (fcoefs_mu[b1, :] - fz1[:, None]*lines_mu[l2]) /
+                fcoefs_sig[b1, :])**2), axis=1)
+            term = weight * np.exp(-0.5*dmul2/alpha_L**2) *\
+                f1[:, None] * f2[None, :]
+            KL_direct += term
+            D_alpha_L_direct += term * dmul2 / alpha_L**3
+
+    tol = 1e-10 * np.abs(KL_direct).max()
+    tol_D = 1e-10 * np.abs(D_alpha_L_direct).max()
+
+    F = np.zeros((size, numLines))
+    line_factors(size, numCoefs, numLines,
+                 fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                 lines_mu[:numLines], b1, fz1, F)
+    M, D_alpha_M = np.zeros((numLines, numLines)),\
+        np.zeros((numLines, numLines))
+    line_kernel_matrices(numLines, alpha_L, lines_mu[:numLines], True,
+                         M, D_alpha_M)
+    assert np.allclose(np.dot(F, np.dot(M, F.T)), KL_direct,
+                       rtol=1e-10, atol=tol)
+    assert np.allclose(np.dot(F, np.dot(D_alpha_M, F.T)), D_alpha_L_direct,
+                       rtol=1e-10, atol=tol_D)
+
+    norms = np.ones((numBands, ))
+    KC, KL = np.zeros((size, size)), np.zeros((size, size))
+    D_alpha_C, D_alpha_L, D_alpha_z = np.zeros((size, size)),\
+        np.zeros((size, size)), np.zeros((size, size))
+    kernelparts(size, size, numCoefs, numLines,
+                alpha_C, alpha_L,
+                fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                lines_mu[:numLines], lines_sig[:numLines], norms,
+                b1, fz1, b1, fz1, True,
+                KL, KC,
+                D_alpha_C, D_alpha_L, D_alpha_z)
+    assert np.allclose(KL, KL_direct, rtol=1e-10, atol=tol)
+    assert np.allclose(D_alpha_L, D_alpha_L_direct, rtol=1e-10, atol=tol_D)
+
+
 def test_find_positions():
 
     a = np.array([0., 1., 2., 3., 4.])
@@ -159,3 +222,74 @@ def test_kernel_parts_interp():
         < relative_accuracy
     assert np.max(np.abs(D_alpha_C_interp/D_alpha_C_rand - 1))\
         < relative_accuracy
+
+
+def test_kernel_parts_interp_diag():
+    """
+    Test the diagonal table interpolation against interp1d,
+    including linear extrapolation outside of the grid.
+    """
+    opzgrid = 1 + np.linspace(0.1, 3, num=nz)
+    Kgrid = np.random.uniform(size=(numBands, nz))
+    b1 = np.random.randint(numBands, size=size)
+    fz1 = 1 + np.random.uniform(0, 3.5, size=size)
+    p1s = RedshiftBinLocator(opzgrid, offset=1.0)(fz1)
+    Kinterp = np.zeros((size, ))
+    kernel_parts_interp_diag(size, Kinterp, b1, fz1, p1s, opzgrid, Kgrid)
+    for ib in range(numBands):
+        ind = b1 == ib
+        f = interp1d(opzgrid, Kgrid[ib, :], kind='linear',
+                     bounds_error=False, fill_value='extrapolate')
+        np.testing.assert_allclose(Kinterp[ind], f(fz1[ind]), rtol=1e-10)
+
+
+def test_kernelparts_grid():
+    """
+    Test that the fused grid builder matches kernelparts for all band pairs.
+    """
+    fcoefs_amp, fcoefs_mu, fcoefs_sig = random_filtercoefs(numBands, numCoefs)
+    lines_mu, lines_sig = random_linecoefs(numLines)
+    var_C, var_L, alpha_C, alpha_L, alpha_T = random_hyperparams()
+    norms = np.sqrt(2*np.pi) * np.sum(fcoefs_amp * fcoefs_sig, axis=1)
+    nzg = 30
+    opzgrid = 1 + np.linspace(0, 3, num=nzg)
+
+    ts = (numBands, numBands, nzg, nzg)
+    grids = [np.zeros(ts) for i in range(4)]
+    equalz_grids = [np.zeros(ts[:3]) for i in range(4)]
+    kernelparts_grid(numBands, nzg, numCoefs, numLines, alpha_C, alpha_L,
+                     fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                     lines_mu, lines_sig, norms, opzgrid, True,
+                     *grids, *equalz_grids)
+    KL_grid, KC_grid = np.zeros(ts), np.zeros(ts)
+    kernelparts_grid(numBands, nzg, numCoefs, numLines, alpha_C, alpha_L,
+                     fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                     lines_mu, lines_sig, norms, opzgrid, False,
+                     KL_grid, KC_grid,
+                     np.zeros((0, 0, 0, 0)), np.zeros((0, 0, 0, 0)),
+                     *[np.zeros((0, 0, 0)) for i in range(4)])
+    grids32 = [np.zeros(ts, dtype=np.float32) for i in range(4)]
+    kernelparts_grid(numBands, nzg, numCoefs, numLines, alpha_C, alpha_L,
+                     fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                     lines_mu, lines_sig, norms, opzgrid, True,
+                     *grids32, *[np.zeros((0, 0, 0)) for i in range(4)])
+    for grid, grid32, equalz_grid in zip(grids, grids32, equalz_grids):
+        np.testing.assert_allclose(grid32, grid.astype(np.float32))
+        np.testing.assert_array_equal(
+            equalz_grid, np.diagonal(grid, axis1=2, axis2=3))
+
+    for ib1 in range(numBands):
+        for ib2 in range(numBands):
+            b1 = np.repeat(ib1, nzg)
+            b2 = np.repeat(ib2, nzg)
+            parts = [np.zeros((nzg, nzg)) for i in range(5)]
+            kernelparts(nzg, nzg, numCoefs, numLines, alpha_C, alpha_L,
+                        fcoefs_amp, fcoefs_mu, fcoefs_sig,
+                        lines_mu, lines_sig, norms,
+                        b1, opzgrid, b2, opzgrid, True, *parts)
+            for grid, part in zip(grids, parts[:4]):
+                np.testing.assert_allclose(grid[ib1, ib2], part, rtol=1e-10)
+            np.testing.assert_allclose(KL_grid[ib1, ib2], parts[0],
+                                       rtol=1e-10)
+            np.testing.assert_allclose(KC_grid[ib1, ib2], parts[1],
+                                       rtol=1e-10)
@@ -115,6 +115,42 @@ def test_interp():
     np.allclose(Kinterp, Kinterp2, rtol=relative_accuracy)
 
 
+def test_redshiftBinLocator():
+
+    nz = 50
+    zgrid = np.logspace(np.log10(0.01), np.log10(3.0 * 1.01), nz)
+    for grid, offset in [(1 + zgrid, 1.0), (np.linspace(0., 4., nz), 0.0)]:
+        locator = RedshiftBinLocator(grid, offset=offset)
+        assert locator.logSpaced == (offset == 1.0)
+        values = np.concatenate([np.random.uniform(0.5, 5.5, 1000),
+                                 grid, [-1., grid[0] - 1e-3, 10.]])
+        # reference: largest p in [0, nz-2] with grid[p] < value
+        expected = np.searchsorted(grid, values, side='left') - 1
+        expected = np.clip(expected, 0, nz - 2)
+        np.testing.assert_array_equal(locator(values), expected)
+
+
+def test_linearInterpolationOperator():
+
+    nodes = np.logspace(np.log10(0.01), np.log10(3.0), 30)
+    points = np.concatenate([np.random.uniform(0., 4., 500), nodes])
+    interpolator = LinearInterpolationOperator(points, nodes)
+    y = np.random.randn(nodes.size, 3, 2)
+    res = interpolator(y)
+    for i in range(3):
+        for j in range(2):
+            np.testing.assert_allclose(res[:, i, j],
+                                       np.interp(points, nodes, y[:, i, j]),
+                                       rtol=1e-12, atol=1e-12)
+    for k in [0, 10, nodes.size - 1]:
+        nodes2 = 1 * nodes
+        nodes2[k] = 0.5 * (nodes[k] + nodes[max(k-1, 0)]) if k > 0\
+            else 0.5 * nodes[0]
+        res = interpolator.withNode(k, nodes2[k]).dot(y[:, 0, 0])
+        np.testing.assert_allclose(res, np.interp(points, nodes2, y[:, 0, 0]),
+                                   rtol=1e-12, atol=1e-12)
+
+
 def test_correlatedgaussianfactorization():
 
     mu_ell, mu_lnz, var_ell, var_lnz, rho = np.random.uniform(0, 1, 5)